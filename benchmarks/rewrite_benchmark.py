@@ -0,0 +1,106 @@
+import argparse
+import re
+import time
+from confluence_dump import rewrite
+from confluence_dump.rewrite import PageRewriter, parse_html, serialize_html
+
+"""
+Benchmark of the page rewrite in render_page
+
+Builds a large synthetic page with many embedded images, external images,
+emoticons, expand macros and code blocks, then times the rewrite done
+with one findAll per kind of element (as dump_html used to) against one
+PageRewriter pass, with html.parser and with lxml when it is installed.
+
+    PYTHONPATH=. python benchmarks/rewrite_benchmark.py --sections 500 --repeat 3
+"""
+
+
+def build_page(sections):
+    parts = []
+    for i in range(sections):
+        parts.append(
+            f'<h2>Section {i}</h2>'
+            f'<div class="expand-container"><div class="expand-control"><img class="expand-control-image" src="/wiki/s/grey_arrow_down.png"/>'
+            f'<span class="expand-control-text">Details {i}</span></div><div class="expand-content"><p>Hidden text {i}</p></div></div>'
+            f'<p>Some text with an emoticon <img class="emoticon emoticon-smile" src="/wiki/s/smile.png"/> and <b>bold</b> words.</p>'
+            f'<p><img class="confluence-embedded-image" src="/wiki/download/attachments/1/shot_{i}.png?version=1"/></p>'
+            f'<p><img class="confluence-embedded-image confluence-external-resource" src="https://example.com/img/ext_{i}.png"/></p>'
+            f'<pre class="syntaxhighlighter-pre">print({i})</pre>'
+            f'<table><tr><th>Key</th><th>Value</th></tr><tr><td class="title">k{i}</td><td>v{i}</td></tr></table>'
+        )
+    return "".join(parts)
+
+
+def multi_pass(soup):
+    """The rewrite as dump_html did it before, one search of the page per kind of element"""
+    for div in soup.find_all('div', class_="expand-control"):
+        div.decompose()
+    for pre in soup.find_all('pre'):
+        pre['class'] = [c for c in pre.get('class', []) if c != 'syntaxhighlighter-pre']
+    for embed_ext in soup.find_all('img', class_="confluence-embedded-image confluence-external-resource"):
+        embed_ext['src'] = "_images/" + embed_ext['src'].rsplit('/', 1)[-1]
+    for embed in soup.find_all('img', class_=re.compile("^confluence-embedded-image")):
+        embed['width'] = 600
+        embed['src'] = "_images/" + embed['src'].rsplit('/', 1)[-1].rsplit('?')[0]
+    for emoticon in soup.find_all('img', class_=re.compile("emoticon|expand-control-image")):
+        emoticon['src'] = "_images/" + emoticon['src'].rsplit('/', 1)[-1]
+    return soup
+
+
+def one_pass(soup):
+    """The same rewrite with one PageRewriter pass"""
+    def rewrite_external_embed(embed_ext):
+        embed_ext['src'] = "_images/" + embed_ext['src'].rsplit('/', 1)[-1]
+
+    def rewrite_embed(embed):
+        embed['width'] = 600
+        embed['src'] = "_images/" + embed['src'].rsplit('/', 1)[-1].rsplit('?')[0]
+
+    def rewrite_emoticon(emoticon):
+        emoticon['src'] = "_images/" + emoticon['src'].rsplit('/', 1)[-1]
+
+    def remove_syntaxhighlighter_class(pre):
+        pre['class'] = [c for c in pre.get('class', []) if c != 'syntaxhighlighter-pre']
+
+    rewriter = PageRewriter()
+    rewriter.register('div', lambda div: div.decompose(), class_="expand-control")
+    rewriter.register('pre', remove_syntaxhighlighter_class)
+    rewriter.register('img', rewrite_external_embed, class_="confluence-embedded-image confluence-external-resource")
+    rewriter.register('img', rewrite_embed, class_=re.compile("^confluence-embedded-image"))
+    rewriter.register('img', rewrite_emoticon, class_=re.compile("emoticon|expand-control-image"))
+    return rewriter.rewrite(soup)
+
+
+def run(rewrite_fn, parser, html, repeat):
+    """Best (rewrite, parse + rewrite + serialize) times over repeat runs, and the output"""
+    rewrite.HTML_PARSER = parser
+    rewrite_times, total_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        soup = parse_html(html)
+        parsed = time.perf_counter()
+        rewrite_fn(soup)
+        rewritten = time.perf_counter()
+        result = serialize_html(soup)
+        rewrite_times.append(rewritten - parsed)
+        total_times.append(time.perf_counter() - start)
+    return min(rewrite_times), min(total_times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the page rewrite of render_page")
+    parser.add_argument('--sections', type=int, default=500, help='Sections of the synthetic page, each with 4 images (default 500)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each variant, the best one is reported (default 3)')
+    args = parser.parse_args()
+
+    html = build_page(args.sections)
+    parsers = ["html.parser"] + (["lxml"] if rewrite.HTML_PARSER == "lxml" else [])
+    print(f"Page of {len(html) / 1024:.0f} KiB with {args.sections * 4} images")
+    base_rewrite, base_total, expected = run(multi_pass, "html.parser", html, args.repeat)
+    print(f"multi-pass, html.parser: rewrite {base_rewrite:.3f}s, with parsing and printing {base_total:.3f}s")
+    for name in parsers:
+        rewrite_time, total, result = run(one_pass, name, html, args.repeat)
+        same = "same output" if result == expected else "OUTPUT DIFFERS"
+        print(f"one pass, {name}: rewrite {rewrite_time:.3f}s ({base_rewrite / rewrite_time:.2f}x), "
+              f"with parsing and printing {total:.3f}s ({base_total / total:.2f}x), {same}")
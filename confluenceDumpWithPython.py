@@ -1,17 +1,36 @@
 import os.path
 import argparse
 import confluence_dump.myModules as myModules
+from confluence_dump.shards import parse_shard, merge_shards
+from confluence_dump.confluence_exporter import ConfluenceExporter
 
 """Dump Confluence content using Python
 
 Args:
     mode: Download mode
-    site: Site to export from
+    site: Site to export from (not needed in rerender and merge modes)
     space: Space to export from
     page: Page to export
+    label: Label of the pages to export
     outdir: Folder to export to (optional)
     sphinx: Sphinx compatible folder structure (optional)
     notags: Do not add tags to rst files (optional)
+    workers: Number of pages exported concurrently (optional)
+    backend: Export engine, threads or async (optional)
+    concurrency: Requests in flight with the async backend (optional)
+    max_rate: Requests per second sent to the site at most (optional)
+    incremental: Only export pages changed since the last run (optional)
+    prune_deleted: Remove the files of deleted pages in incremental mode (optional)
+    bulk: Fetch the page bodies together with the page listing (optional)
+    read_ahead: Listing responses fetched ahead of the export (optional)
+    transform_workers: Processes converting the pages, apart from the fetching workers (optional)
+    downloads_per_host: Downloads running against one external image host at most (optional)
+    dedupe_attachments: Store each attachment once by content hash and link it into _images (optional)
+    cache_size_mb: Size of the on-disk cache of API responses, 0 to disable it (optional)
+    offline: Replay the API responses from the cache without any network access (optional)
+    resume: Skip the pages an interrupted export of the space already wrote (optional)
+    shard: Only export the pages of shard K out of N, as K/N (optional)
+    merge_from: Output folders of the shards to merge into outdir, in merge mode
 
 
 Returns:
@@ -22,10 +41,10 @@ Returns:
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--mode', '-m', dest='mode',
-                    choices=['single', 'space', 'bylabel', 'pageprops'],
+                    choices=['single', 'space', 'site', 'bylabel', 'pageprops', 'rerender', 'merge'],
                     help='Chose a download mode', required=True)
 parser.add_argument('--site', '-S', type=str,
-                    help='Atlassian Site', required=True)
+                    help='Atlassian Site, not needed in rerender and merge modes', required=False)
 parser.add_argument('--space', '-s', type=str,
                     help='Space Key')
 parser.add_argument('--page', '-p', type=int,
@@ -44,8 +63,42 @@ parser.add_argument('--no-rst', action='store_false', dest="rst", default=True,
                     help='Disable .rst file in export', required=False)
 parser.add_argument('--showlabels', action='store_true', default=False,
                     help='Export .rst files with the page labels at the bottom', required=False)
+parser.add_argument('--workers', type=int, default=4,
+                    help='Number of pages exported concurrently (default 4)', required=False)
+parser.add_argument('--backend', choices=['threads', 'async'], default='threads',
+                    help='Export engine, "async" needs aiohttp (default threads)', required=False)
+parser.add_argument('--concurrency', type=int, default=100,
+                    help='Requests in flight with the async backend (default 100)', required=False)
+parser.add_argument('--incremental', action='store_true', default=False,
+                    help='Only export pages changed since the last run into the same folder', required=False)
+parser.add_argument('--prune-deleted', action='store_true', default=False, dest='prune_deleted',
+                    help='With --incremental, remove the files of pages deleted in Confluence', required=False)
+parser.add_argument('--bulk', action='store_true', default=False,
+                    help='Fetch the page bodies together with the page listing instead of one request per page', required=False)
+parser.add_argument('--read-ahead', type=int, default=2, dest='read_ahead',
+                    help='Number of page listing responses fetched ahead of the export, 0 to disable (default 2)', required=False)
+parser.add_argument('--transform-workers', type=int, default=0, dest='transform_workers',
+                    help='Processes rewriting and converting the pages while the workers fetch, 0 to convert in the workers (default 0)', required=False)
+parser.add_argument('--downloads-per-host', type=int, default=4, dest='downloads_per_host',
+                    help='Attachments and images downloaded at the same time from one external host (default 4)', required=False)
+parser.add_argument('--no-dedupe-attachments', action='store_false', default=True, dest='dedupe_attachments',
+                    help='Save the attachments straight into _images instead of storing them once by content hash', required=False)
+parser.add_argument('--cache-size', type=int, default=1024, dest='cache_size_mb',
+                    help='Size in MB of the cache of API responses kept in the output folder, 0 to disable it (default 1024)', required=False)
+parser.add_argument('--offline', action='store_true', default=False,
+                    help='Replay the API responses from the cache of an earlier run, without sending any request', required=False)
+parser.add_argument('--resume', action='store_true', default=False,
+                    help='Skip the pages an interrupted export of the space already wrote', required=False)
+parser.add_argument('--shard', type=parse_shard, default=None,
+                    help='Only export the pages of shard K out of N, given as K/N, into a folder of its own', required=False)
+parser.add_argument('--merge-from', nargs='+', dest='merge_from', default=[],
+                    help='Output folders of the shards to merge into the output folder, in merge mode', required=False)
+parser.add_argument('--max-rate', type=float, default=50, dest='max_rate',
+                    help='Requests per second sent to the site at most (default 50)', required=False)
 
 args = parser.parse_args()
+if args.site is None and args.mode not in ('rerender', 'merge'):     # the other modes talk to the site
+    parser.error(f"--site is required in {args.mode} mode")
 atlassian_site = args.site
 if args.mode == 'single':
     print(f"Exporting a single page (Sphinx set to {args.sphinx})")
@@ -53,10 +106,16 @@ if args.mode == 'single':
 elif args.mode == 'space':
     print(f"Exporting a whole space (Sphinx set to {args.sphinx})")
     space_key = args.space
+elif args.mode == 'site':
+    print(f"Exporting all the spaces of the site (Sphinx set to {args.sphinx})")
 elif args.mode == 'bylabel':
     print(f"Exporting all pages with a common label (Sphinx set to {args.sphinx})")
 elif args.mode == 'pageprops':
     print(f"Exporting a Page Properties page with all its children (Sphinx set to {args.sphinx})")
+elif args.mode == 'merge':
+    print("Merging the output folders of the shards of an export")
+elif args.mode == 'rerender':
+    print(f"Rendering the pages archived by earlier space exports again (Sphinx set to {args.sphinx})")
 
 my_attachments = []
 my_embeds = []
@@ -64,8 +123,13 @@ my_embeds_externals = []
 my_emoticons = []
 my_emoticons_list = []
 
-user_name = os.environ["atlassianUserEmail"]
-api_token = os.environ["atlassianAPIToken"]
+if args.mode in ('rerender', 'merge'):     # works from the output folders alone
+    user_name = os.environ.get("atlassianUserEmail")
+    api_token = os.environ.get("atlassianAPIToken")
+else:
+    user_name = os.environ["atlassianUserEmail"]
+    api_token = os.environ["atlassianAPIToken"]
+session = myModules.get_session(args.site,user_name,api_token)
 
 sphinx_compatible = args.sphinx
 sphinx_tags = args.tags
@@ -77,19 +141,10 @@ if args.mode == 'single':
     ## SINGLE ##
     ############
     page_id = args.page
-    page_name = myModules.get_page_name(atlassian_site,page_id,user_name,api_token)
-
-    my_body_export_view = myModules.get_body_export_view(atlassian_site,page_id,
-        user_name,api_token).json()
-    my_body_export_view_html = my_body_export_view['body']['export_view']['value']
-    my_body_export_view_title = my_body_export_view['title'].replace("/","-")\
+    page = myModules.get_page(atlassian_site,page_id,user_name,api_token,session)
+    my_body_export_view_title = page.title.replace("/","-")\
         .replace(",","").replace("&","And").replace(":","-")
 
-    server_url = f"https://{atlassian_site}.atlassian.net/wiki/api/v2/spaces/?limit=250"
-
-    page_url = f"{my_body_export_view['_links']['base']}{my_body_export_view['_links']['webui']}"
-    page_parent = myModules.get_page_parent(atlassian_site,page_id,user_name,api_token)
-
     my_outdir_base = os.path.join(my_outdir_base,f"{page_id}-{my_body_export_view_title}")        # sets outdir to path under page_name
     my_outdir_content = my_outdir_base
 
@@ -100,166 +155,80 @@ if args.mode == 'single':
 #        my_outdir_content = my_outdir_base
     my_outdirs = []
     my_outdirs = myModules.mk_outdirs(my_outdir_base)               # attachments, embeds, scripts
-    my_page_labels = myModules.get_page_labels(atlassian_site,page_id,user_name,api_token)
     print(f"Base export folder is \"{my_outdir_base}\" and the Content goes to \"{my_outdir_content}\"")
-    myModules.dump_html(atlassian_site,my_body_export_view_html,my_body_export_view_title,page_id,my_outdir_base, my_outdir_content,my_page_labels,page_parent,user_name,api_token,sphinx_compatible,sphinx_tags,arg_html_output=args.html,arg_rst_output=args.rst)
+    myModules.dump_html(atlassian_site,page.html,my_body_export_view_title,page_id,my_outdir_base, my_outdir_content,page.labels,page.parent_id,user_name,api_token,sphinx_compatible,sphinx_tags,arg_html_output=args.html,arg_rst_output=args.rst,arg_session=session,arg_page=page)
     print("Done!")
 elif args.mode == 'space':
     ###########
     ## SPACE ##
     ###########
-    all_spaces_full = myModules.get_spaces_all(atlassian_site,user_name,api_token)         # get a dump of all spaces
-    all_spaces_short = []                                                             # initialize list for less detailed list of spaces
-    i = 0
-    for n in all_spaces_full:
-        i = i +1
-        all_spaces_short.append({                                                     # append the list of spaces
-            'space_key' : n['key'],
-            'space_id' : n['id'],
-            'space_name' : n['name'],
-            'homepage_id' : n['homepageId'],
-            'spaceDescription' : n['description'],
-            })
-        if (n['key'] == space_key) or n['key'] == str.upper(space_key) or n['key'] == str.lower(space_key):
-            print("Found space: " + n['key'])
-            space_id = n['id']
-            space_name = n['name']
-            current_parent = n['homepageId']
-    my_outdir_content = os.path.join(my_outdir_base,f"{space_id}-{space_name}")
-    os.makedirs(my_outdir_content, exist_ok=True)
-    if args.sphinx is False:
-        my_outdir_base = my_outdir_content
-
-    #print("my_outdir_base: " + my_outdir_base)
-    #print("my_outdir_content: " + my_outdir_content)
-
-    if space_key == "" or space_key is None:                                          # if the supplied space key can't be found
-        print("Could not find Space Key in this site")
-    else:
-        space_title = myModules.get_space_title(atlassian_site,space_id,user_name,api_token)
-        #
-        # get list of pages from space
-        #
-        all_pages_full = myModules.get_pages_from_space(atlassian_site,space_id,user_name,api_token)
-        all_pages_short = []
-        i = 0
-        for n in all_pages_full:
-            i = i + 1
-            all_pages_short.append({
-                'page_id' : n['id'],
-                'pageTitle' : n['title'],
-                'parentId' : n['parentId'],
-                'space_id' : n['spaceId'],
-                }
-            )
-        # put it all together
-        print(f"{len(all_pages_short)} pages to export")
-        page_counter = 0
-        for p in all_pages_short:
-            page_counter = page_counter + 1
-            my_body_export_view = myModules.get_body_export_view(atlassian_site,p['page_id'],user_name,api_token).json()
-            my_body_export_view_html = my_body_export_view['body']['export_view']['value']
-            my_body_export_view_name = p['pageTitle']
-            my_body_export_view_title = p['pageTitle'].replace("/","-").replace(",","").replace("&","And").replace(" ","_")     # added .replace(" ","_") so that filenames have _ as a separator
-            print()
-            print(f"Getting page #{page_counter}/{len(all_pages_short)}, {my_body_export_view_title}, {p['page_id']}")
-            my_body_export_view_labels = myModules.get_page_labels(atlassian_site,p['page_id'],user_name,api_token)
-            #my_body_export_view_labels = ",".join(myModules.get_page_labels(atlassian_site,p['page_id'],user_name,api_token))
-            mypage_url = f"{my_body_export_view['_links']['base']}{my_body_export_view['_links']['webui']}"
-            print(f"dump_html arg sphinx_compatible = {sphinx_compatible}")
-            myModules.dump_html(atlassian_site,my_body_export_view_html,my_body_export_view_title,p['page_id'],my_outdir_base,my_outdir_content,my_body_export_view_labels,p['parentId'],user_name,api_token,sphinx_compatible,sphinx_tags,arg_html_output=args.html,arg_rst_output=args.rst)
+    exporter = ConfluenceExporter(atlassian_site,args.space,outdir=my_outdir_base,sphinx=sphinx_compatible,tags=sphinx_tags,
+        html=args.html,rst=args.rst,showlabels=args.showlabels,api_username=user_name,api_token=api_token,workers=args.workers,
+        backend=args.backend,concurrency=args.concurrency,max_rate=args.max_rate,
+        incremental=args.incremental,prune_deleted=args.prune_deleted,bulk=args.bulk,
+        read_ahead=args.read_ahead,transform_workers=args.transform_workers,downloads_per_host=args.downloads_per_host,
+        dedupe_attachments=args.dedupe_attachments,cache_size_mb=args.cache_size_mb,offline=args.offline,resume=args.resume,shard=args.shard)
+    exporter.export_space()
+    print("Done!")
+    if exporter.failed_pages:
+        exit(1)
+elif args.mode == 'site':
+    ##########
+    ## SITE ##
+    ##########
+    exporter = ConfluenceExporter(atlassian_site,None,outdir=my_outdir_base,sphinx=sphinx_compatible,tags=sphinx_tags,
+        html=args.html,rst=args.rst,showlabels=args.showlabels,api_username=user_name,api_token=api_token,workers=args.workers,
+        max_rate=args.max_rate,incremental=args.incremental,prune_deleted=args.prune_deleted,bulk=args.bulk,
+        read_ahead=args.read_ahead,transform_workers=args.transform_workers,downloads_per_host=args.downloads_per_host,
+        dedupe_attachments=args.dedupe_attachments,cache_size_mb=args.cache_size_mb,offline=args.offline,resume=args.resume,shard=args.shard)
+    exporter.export_site()
     print("Done!")
+    if exporter.failed_pages:
+        exit(1)
+elif args.mode == 'bylabel':
+    #############
+    ## BYLABEL ##
+    #############
+    exporter = ConfluenceExporter(atlassian_site,args.space,outdir=my_outdir_base,sphinx=sphinx_compatible,tags=sphinx_tags,
+        html=args.html,rst=args.rst,showlabels=args.showlabels,api_username=user_name,api_token=api_token,workers=args.workers,
+        max_rate=args.max_rate,bulk=args.bulk,read_ahead=args.read_ahead,transform_workers=args.transform_workers,
+        downloads_per_host=args.downloads_per_host,dedupe_attachments=args.dedupe_attachments,
+        cache_size_mb=args.cache_size_mb,offline=args.offline,resume=args.resume,shard=args.shard)
+    exporter.export_by_label(args.label)
+    print("Done!")
+    if exporter.failed_pages:
+        exit(1)
 elif args.mode == 'pageprops':
     ###############
     ## PAGEPROPS ##
     ###############
-    my_page_properties_children = []
-    my_page_properties_children_dict = {}
-
-    page_id = args.page
-    #
-    # Get Page Properties REPORT
-    #
-    print("Getting Page Properties Report Details")
-    my_report_export_view = myModules.get_body_export_view(atlassian_site,page_id,user_name,api_token).json()
-    my_report_export_view_title = my_report_export_view['title'].replace("/","-").replace(",","").replace("&","And").replace(":","-")
-    my_report_export_view_html = my_report_export_view['body']['export_view']['value']
-    my_report_export_viewName = myModules.get_page_name(atlassian_site,page_id,user_name,api_token)
-    my_report_export_view_labels = myModules.get_page_labels(atlassian_site,page_id,user_name,api_token)
-    my_report_export_page_url = f"{my_report_export_view['_links']['base']}{my_report_export_view['_links']['webui']}"
-    my_report_export_page_parent = myModules.get_page_parent(atlassian_site,page_id,user_name,api_token)
-    my_report_export_html_filename = f"{my_report_export_view_title}.html"
-        # str(my_report_export_view_title) + '.html'
-    # my outdirs
-    my_outdir_content = os.path.join(my_outdir_base,str(page_id) + "-" + str(my_report_export_view_title))
-    #print("my_outdir_base: " + my_outdir_base)
-    #print("my_outdir_content: " + my_outdir_content)
-    if args.sphinx is False:
-        my_outdir_base = my_outdir_content
-
-    my_outdirs = []
-    my_outdirs = myModules.mk_outdirs(my_outdir_base)               # attachments, embeds, scripts
-    # get info abbout children
-    #my_page_properties_children = myModules.get_page_properties_children(atlassian_site,my_report_export_view_html,my_outdir_content,user_name,api_token)[0]          # list
-    #my_page_properties_children_dict = myModules.get_page_properties_children(atlassian_site,my_report_export_view_html,my_outdir_content,user_name,api_token)[1]      # dict
-    (my_page_properties_children,my_page_properties_children_dict) = myModules.get_page_properties_children(atlassian_site,my_report_export_view_html,my_outdir_content,user_name,api_token)
-    #
-    # Get Page Properties CHILDREN
-    #
-    page_counter = 0
-    for p in my_page_properties_children:
-        page_counter = page_counter + 1
-        #print("Handling child: " + p)
-        my_child_export_view = myModules.get_body_export_view(atlassian_site,p,user_name,api_token).json()
-        my_child_export_view_html = my_child_export_view['body']['export_view']['value']
-        my_child_export_view_name = my_page_properties_children_dict[p]['Name']
-        my_child_export_view_labels = myModules.get_page_labels(atlassian_site,p,user_name,api_token)
-        my_child_export_view_title = my_child_export_view['title']      ##.replace("/","-").replace(":","-").replace(" ","_")
-        print(f"Getting Child page #{page_counter}/{len(my_page_properties_children)}, {my_child_export_view_title}, {my_page_properties_children_dict[str(p)]['ID']}")
-        #print("Getting Child page #" + str(page_counter) + '/' + str(len(my_page_properties_children)) + ', ' + my_child_export_view_title + ', ' + my_page_properties_children_dict[str(p)]['ID'])
-        my_child_export_page_url = f"{my_child_export_view['_links']['base']}{my_child_export_view['_links']['webui']}"
-        #my_child_export_page_url = str(my_child_export_view['_links']['base']) + str(my_child_export_view['_links']['webui'])
-        my_child_export_page_parent = myModules.get_page_parent(atlassian_site,p,user_name,api_token)
-        html_file_name = (f"{my_page_properties_children_dict[p]['Name']}.html").replace(":","-").replace(" ","_")
-        #html_file_name = my_page_properties_children_dict[p]['Name'].replace(":","-").replace(" ","_") + '.html'
-        my_page_properties_children_dict[str(p)].update({"Filename": html_file_name})
-
-        myModules.dump_html(
-                arg_site=atlassian_site,
-                arg_html=my_child_export_view_html,
-                arg_title=my_child_export_view_title,
-                arg_page_id=p,
-                arg_outdir_base=my_outdir_base,
-                arg_outdir_content=my_outdir_content,
-                arg_page_labels=my_child_export_view_labels,
-                arg_page_parent=my_child_export_page_parent,
-                arg_username=user_name,
-                arg_api_token=api_token,
-                arg_sphinx_compatible=sphinx_compatible,
-                arg_sphinx_tags=sphinx_tags,
-                arg_type="reportchild",
-                arg_html_output=args.html,
-                arg_rst_output=args.rst,
-                arg_show_labels=args.showlabels
-            )                  # creates html files for every child
-    myModules.dump_html(
-            arg_site=atlassian_site,
-            arg_html=my_report_export_view_html,
-            arg_title=my_report_export_view_title,
-            arg_page_id=page_id,
-            arg_outdir_base=my_outdir_base,
-            arg_outdir_content=my_outdir_content,
-            arg_page_labels=my_report_export_view_labels,
-            arg_page_parent=my_report_export_page_parent,
-            arg_username=user_name,
-            arg_api_token=api_token,
-            arg_sphinx_compatible=sphinx_compatible,
-            arg_sphinx_tags=sphinx_tags,
-            arg_type="report",
-            arg_html_output=args.html,
-            arg_rst_output=args.rst,
-            arg_show_labels=args.showlabels
-        )         # finally creating the HTML for the report page
+    exporter = ConfluenceExporter(atlassian_site,args.space,outdir=my_outdir_base,sphinx=sphinx_compatible,tags=sphinx_tags,
+        html=args.html,rst=args.rst,showlabels=args.showlabels,api_username=user_name,api_token=api_token,workers=args.workers,
+        max_rate=args.max_rate,read_ahead=args.read_ahead,transform_workers=args.transform_workers,
+        downloads_per_host=args.downloads_per_host,dedupe_attachments=args.dedupe_attachments,
+        cache_size_mb=args.cache_size_mb,offline=args.offline)
+    exporter.export_page_properties(args.page)
+    print("Done!")
+    if exporter.failed_pages:
+        exit(1)
+elif args.mode == 'rerender':
+    ##############
+    ## RERENDER ##
+    ##############
+    exporter = ConfluenceExporter(atlassian_site,args.space,outdir=my_outdir_base,sphinx=sphinx_compatible,tags=sphinx_tags,
+        html=args.html,rst=args.rst,showlabels=args.showlabels,api_username=user_name,api_token=api_token,
+        transform_workers=args.transform_workers,cache_size_mb=0)
+    exporter.rerender()
+    print("Done!")
+    if exporter.failed_pages:
+        exit(1)
+elif args.mode == 'merge':
+    ###########
+    ## MERGE ##
+    ###########
+    merge_result = merge_shards(args.merge_from,my_outdir_base)
     print("Done!")
+    if merge_result.conflicts:
+        exit(1)
 else:
     print("No script mode defined in the command line")
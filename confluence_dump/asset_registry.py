@@ -0,0 +1,66 @@
+import json
+import os.path
+import threading
+
+"""
+Registry of the shared files of each output folder
+
+Emoticons, expand-control icons and the stylesheet are the same for every
+page, but were looked for on disk, and fetched when missing, by each page.
+The registry remembers which of them each output folder already has, for
+the whole process, and keeps the list in a file in the folder so the next
+run doesn't look for them either. The list is checked against one listing
+of the folders when it is loaded, so files removed since are fetched again.
+"""
+
+ASSETS_FILE_NAME = ".confluence_dump_assets.json"
+
+
+class AssetRegistry:
+    def __init__(self):
+        self.roots = {}     # files known to be there, by output folder
+        self.lock = threading.Lock()
+
+    def _files(self, outdir):
+        """Files known to be in an output folder, loaded from its registry file the first time"""
+        root = os.path.abspath(outdir)
+        if root not in self.roots:
+            self.roots[root] = self._load(root)
+        return root, self.roots[root]
+
+    @staticmethod
+    def _load(root):
+        try:
+            with open(os.path.join(root, ASSETS_FILE_NAME)) as f:
+                files = json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return set()
+        listings = {}
+        for file_path in files:
+            folder, name = os.path.split(file_path)
+            if folder not in listings:
+                try:
+                    listings[folder] = set(os.listdir(os.path.join(root, folder)))
+                except OSError:
+                    listings[folder] = set()
+        return {file_path for file_path in files if os.path.basename(file_path) in listings[os.path.dirname(file_path)]}
+
+    def has(self, outdir, file_path):
+        """Check whether a file, relative to the output folder, is known to be there"""
+        with self.lock:
+            return file_path in self._files(outdir)[1]
+
+    def add(self, outdir, file_path):
+        """Remember that a file, relative to the output folder, is there now"""
+        with self.lock:
+            root, files = self._files(outdir)
+            if file_path in files:
+                return
+            files.add(file_path)
+            registry_path = os.path.join(root, ASSETS_FILE_NAME)
+            with open(f"{registry_path}.tmp", 'w') as f:
+                json.dump({'files': sorted(files)}, f, indent=1)
+            os.replace(f"{registry_path}.tmp", registry_path)
+
+
+default_registry = AssetRegistry()
@@ -0,0 +1,375 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, quote
+from humanfriendly import format_timespan
+from confluence_dump.confluence_exporter import ExportProgress
+from confluence_dump.rate_limit import RETRY_STATUSES, MAX_RETRIES, retry_after_seconds
+from confluence_dump.myModules import (
+    DOWNLOAD_CHUNK_SIZE, PAGE_EXPAND, page_record_from_json, mk_outdirs,
+    part_file_resume_from, part_file_range_headers, part_file_complete, part_file_response, finish_part_file,
+)
+
+try:
+    import aiohttp
+except ImportError:     # optional, only needed for backend="async"
+    aiohttp = None
+
+"""
+Asyncio export engine for ConfluenceExporter
+
+All API calls and downloads run on one event loop through aiohttp, with up
+to `concurrency` requests in flight. The HTML rewriting and RST conversion
+of dump_html run in a thread pool of `workers` threads, so they never block
+the loop. fetch_page_assets runs there too, but hands the files of the page
+to the engine, which acts as its downloader: they are downloaded on the
+loop, at most `downloads_per_host` at a time from each external host.
+"""
+
+
+class AsyncConfluenceExporter:
+    def __init__(self, exporter, concurrency=None):
+        if aiohttp is None:
+            raise ImportError("The async backend needs aiohttp, install it with: pip install aiohttp")
+        self.exporter = exporter
+        self.concurrency = concurrency or exporter.concurrency
+        self.host = f"{exporter.site}.atlassian.net"
+        self.base_url = f"https://{self.host}/wiki"
+
+    @contextlib.asynccontextmanager
+    async def _client(self):
+        """Open the aiohttp session and the executor for one export run"""
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.host_semaphores = {}
+        self.file_locks = {}
+        self.auth = aiohttp.BasicAuth(self.exporter.user_name, self.exporter.api_token)
+        self.executor = ThreadPoolExecutor(max_workers=self.exporter.workers)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.http:
+            try:
+                yield
+            finally:
+                # the threads can be waiting on downloads running on this loop, through this session
+                await asyncio.to_thread(self.executor.shutdown)
+
+    def _auth_for(self, url):
+        # only send the Confluence credentials to the site itself
+        return self.auth if urlparse(url).hostname == self.host else None
+
+    @contextlib.asynccontextmanager
+    async def request(self, url, headers=None, raise_for_status=True):
+        """GET url through the shared rate limiter, retrying 429 and 503 responses"""
+        limiter = self.exporter.rate_limiter
+        limited = urlparse(url).hostname == limiter.host
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                if limited:
+                    await limiter.acquire_async()
+                try:
+                    response = await self.http.get(url, auth=self._auth_for(url), headers=headers)
+                except BaseException:
+                    if limited:
+                        limiter.release()
+                    raise
+                if response.status not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                    break
+                retry_after = retry_after_seconds(response.headers.get('Retry-After'), attempt)
+                logging.info(f"Throttled ({response.status}), retrying in {retry_after:.1f}s: {url}")
+                response.release()
+                if limited:
+                    limiter.release(throttled=True, retry_after=retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
+                attempt += 1
+            try:
+                if raise_for_status:
+                    response.raise_for_status()
+                yield response
+            finally:
+                response.release()
+                if limited:
+                    limiter.release()
+
+    async def get_json(self, url):
+        cache = self.exporter.response_cache
+        if cache is None:
+            async with self.request(url) as response:
+                return await response.json()
+        # same cache as myModules.http_get
+        cached = cache.get(url)
+        if cache.offline:
+            if cached is None:
+                raise IOError(f"Offline, and not in the response cache: {url}")
+            return json.loads(cached.body)
+        async with self.request(url, cache.validators(cached)) as response:
+            if response.status == 304 and cached is not None:
+                return json.loads(cached.body)
+            body = await response.read()
+            if response.status == 200:
+                cache.put(url, response.headers, body)
+        return json.loads(body)
+
+    async def download(self, url, file_path, expected_size=None):
+        """Async counterpart of myModules.download_file"""
+        if self.exporter.offline:
+            raise IOError(f"Offline, not downloading: {url}")
+        async with self.file_locks.setdefault(os.path.abspath(file_path), asyncio.Lock()):
+            if os.path.exists(file_path):
+                return      # another page downloaded it meanwhile
+            await self.download_part_file(url, file_path, expected_size)
+
+    async def download_part_file(self, url, file_path, expected_size=None):
+        """Async counterpart of myModules.download_part_file"""
+        part_path = f"{file_path}.part"
+        resume_from = part_file_resume_from(part_path, expected_size)
+        async with self.request(url, part_file_range_headers(resume_from), raise_for_status=False) as response:
+            if not part_file_complete(resume_from, expected_size, response.status):
+                response.raise_for_status()
+                resumed, expected_size = part_file_response(resume_from, expected_size, response.status, response.headers)
+                with open(part_path, 'ab' if resumed else 'wb') as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+        finish_part_file(url, file_path, expected_size)
+
+    async def download_asset(self, url, asset, blob_store):
+        """Async counterpart of myModules.download_asset, the files outside the site limited per host"""
+        host = urlparse(url).hostname
+        downloader = self.exporter.downloader
+        if host in downloader.unlimited_hosts:
+            semaphore = contextlib.nullcontext()
+        else:
+            semaphore = self.host_semaphores.setdefault(host, asyncio.Semaphore(downloader.per_host))
+        async with semaphore:
+            if asset.blob_key is None:
+                await self.download(url, asset.file_path, asset.expected_size)
+                return
+            # not the path blob_store.fetch downloads to, which a sync export may have left behind
+            file_path = f"{blob_store.incoming_path(asset.blob_key)}.async"
+            async with self.file_locks.setdefault(file_path, asyncio.Lock()):
+                if blob_store.lookup(asset.blob_key) is None:
+                    await self.download_part_file(url, file_path, asset.expected_size)
+                    await asyncio.to_thread(blob_store.add, asset.blob_key, file_path)
+
+    def download_all(self, downloads, download_fn):
+        """AssetDownloader.download_all for fetch_page_assets, downloading on the loop instead of download_fn
+
+        Called from the executor threads, it waits for the downloads there.
+        """
+        futures = [
+            asyncio.run_coroutine_threadsafe(self.download_asset(url, asset, blob_store), self.loop)
+            for url, (asset, username, api_token, session, blob_store) in downloads
+        ]
+        return [future.exception() for future in futures]
+
+    async def read_ahead(self, batches):
+        """Async counterpart of myModules.read_ahead, fetching the next batches in a task"""
+        depth = self.exporter.read_ahead
+        if depth < 1:
+            async for batch in batches:
+                yield batch
+            return
+        queue = asyncio.Queue(maxsize=depth)
+        done = object()
+
+        async def fetch():
+            try:
+                async for batch in batches:
+                    await queue.put(batch)
+                await queue.put(done)
+            except Exception as e:
+                await queue.put(e)
+
+        task = asyncio.create_task(fetch())
+        try:
+            while (batch := await queue.get()) is not done:
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            task.cancel()
+
+    async def paginate_batches(self, url):
+        next_url = url
+        while next_url:
+            data = await self.get_json(next_url)
+            yield data['results']
+            next_link = data['_links'].get('next')
+            next_url = f"{url}&cursor{next_link.split('cursor')[1]}" if next_link else None
+
+    async def paginate(self, url):
+        """Yield the results of a cursor-paginated v2 listing as each response arrives"""
+        async for batch in self.read_ahead(self.paginate_batches(url)):
+            for result in batch:
+                yield result
+
+    async def search_batches(self, url):
+        while url:
+            data = await self.get_json(url)
+            for result in data['results']:
+                result.setdefault('_links', {}).setdefault('base', data['_links']['base'])
+            yield data['results']
+            next_link = data['_links'].get('next')
+            url = f"{data['_links']['base']}{next_link}" if next_link else None
+
+    async def search(self, cql, expand=None, limit=100):
+        """Yield the content matching a CQL query, following the result cursors"""
+        url = f"{self.base_url}/rest/api/content/search?cql={quote(cql)}&limit={limit}"
+        if expand:
+            url = f"{url}&expand={expand}"
+        async for batch in self.read_ahead(self.search_batches(url)):
+            for result in batch:
+                yield result
+
+    async def search_pages(self, space_key, space_id):
+        """Async counterpart of ConfluenceExporter._search_pages"""
+        cql = self.exporter._date_range_cql(f'space="{space_key}" and type=page')
+        logging.info(f"Searching pages with CQL: {cql}")
+        results = self.search(cql, expand=self.exporter._search_expand(), limit=250)
+        try:
+            first = await results.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except (aiohttp.ClientError, KeyError, ValueError) as e:
+            logging.warning(f"CQL search failed ({e}), falling back to listing all pages of the space")
+            return None
+
+        async def pages():
+            if first is None:
+                return
+            n = first
+            while True:
+                if self.exporter.bulk:
+                    await self.complete_collections(n)
+                yield self.exporter._short_page_from_content(n, space_id)
+                try:
+                    n = await results.__anext__()
+                except StopAsyncIteration:
+                    return
+        return pages()
+
+    async def list_pages(self, space_key, space_id):
+        """Async counterpart of ConfluenceExporter._list_pages"""
+        exporter = self.exporter
+        if exporter.bulk or exporter.start_date or exporter.end_date:
+            pages = await self.search_pages(space_key, space_id)
+            if pages is not None:
+                async for p in pages:
+                    yield p
+                return
+        async for n in self.paginate(f"{self.base_url}/api/v2/spaces/{space_id}/pages?status=current&limit=250"):
+            yield exporter._short_page(n)
+
+    async def select_pages_to_export(self, pages, space_id):
+        """Async counterpart of ConfluenceExporter._select_pages_to_export"""
+        exporter = self.exporter
+        if exporter.incremental:
+            exporter._open_state()
+        listed_page_ids = []
+        async for p in pages:
+            listed_page_ids.append(p["page_id"])
+            if not exporter._in_shard(p["page_id"]):
+                continue
+            if exporter.incremental and exporter.state.is_current(p["page_id"], p["version"]):
+                continue
+            if exporter.resume and exporter.journal.is_completed(p["page_id"]):
+                continue
+            yield p
+        if exporter.incremental and not exporter.interrupted:
+            exporter._flag_deleted_pages(space_id, listed_page_ids)
+
+    async def complete_collections(self, data):
+        """Fetch the rest of the labels and attachments an expanded page was truncated to"""
+        for collection in (data.get('metadata', {}).get('labels', {}), data.get('children', {}).get('attachment', {})):
+            next_link = collection.get('_links', {}).pop('next', None)
+            while next_link:
+                more = await self.get_json(f"{data['_links']['base']}{next_link}")
+                collection.setdefault('results', []).extend(more['results'])
+                next_link = more.get('_links', {}).get('next')
+
+    async def get_page(self, page_id):
+        """Async counterpart of myModules.get_page"""
+        data = await self.get_json(f"{self.base_url}/rest/api/content/{page_id}?expand={PAGE_EXPAND}")
+        await self.complete_collections(data)
+        return page_record_from_json(data)
+
+    async def run_in_executor(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def export_single_page(self, page_id, start_time):
+        async with self._client():
+            page = await self.get_page(page_id)
+            return await self.run_in_executor(self.exporter._dump_single_page, page_id, page, start_time, self)
+
+    async def _export_space_page(self, p, my_outdir_base, my_outdir_content, progress):
+        try:
+            page = p.get("page") or await self.get_page(p["page_id"])
+            # the date range is checked on the fetched page itself, no extra requests needed
+            if (self.exporter.start_date or self.exporter.end_date) and not self.exporter._in_date_range(page.last_modified):
+                progress.advance("Skipping page")
+                return
+            await self.run_in_executor(self.exporter._dump_space_page, p, page, my_outdir_base, my_outdir_content, progress, self)
+        except Exception as e:
+            progress.fail("Exporting page", p["page_id"], e)
+
+    async def export_space(self, start_time):
+        exporter = self.exporter
+        async with self._client():
+            space = None
+            async for n in self.paginate(f"{self.base_url}/api/v2/spaces/?limit=250"):
+                space = exporter._find_space([n])
+                if space is not None:
+                    break
+            if space is None:  # if the supplied space key can't be found
+                logging.error("Could not find Space Key in this site")
+                return {}
+            space_id, space_name, space_key = space
+            my_outdir_base, my_outdir_content = exporter._space_outdirs(space_id, space_name)
+            exporter._open_journal(space_id)
+            logging.info(f"Starting export with up to {self.concurrency} requests in flight")
+            mk_outdirs(my_outdir_base)
+            progress = ExportProgress(0, exporter.log_interval)
+            # the listing is paginated by one task while the workers export the pages it has queued
+            queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+            async def list_pages():
+                async for p in self.select_pages_to_export(self.list_pages(space_key, space_id), space_id):
+                    if exporter.interrupted:
+                        break
+                    with progress.lock:
+                        progress.total += 1
+                    await queue.put(p)
+                for _ in range(self.concurrency):
+                    await queue.put(None)
+
+            async def worker():
+                while (p := await queue.get()) is not None:
+                    if not exporter.interrupted:
+                        await self._export_space_page(p, my_outdir_base, my_outdir_content, progress)
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            try:
+                await list_pages()
+                await asyncio.gather(*workers)
+            finally:
+                # when the listing fails, the workers are stopped before the session closes
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                exporter.pandoc.close()
+                exporter.downloader.close()
+                exporter._close_blob_stores()
+                exporter._flush_response_cache()
+        if exporter.interrupted:
+            logging.warning(f"Interrupted export of space after {progress.done}/{progress.total} pages")
+        exporter._log_failures(progress)
+        elapsed_time = time.time() - start_time
+        logging.info(f"Done! Exporting space took {format_timespan(elapsed_time)}.")
+        exporter._log_rate_limit_metrics()
+        return progress.results
@@ -0,0 +1,163 @@
+import os.path
+import re
+import shutil
+import sqlite3
+import threading
+from confluence_dump.export_state import file_sha256
+
+"""
+Content-addressed store of the downloaded attachments
+
+Every attachment is downloaded once into `_blobs/`, under the SHA-256 of
+its content, and the `_images/` folder only holds hard links to the blobs
+(copies where the file system can't link). The same file attached to
+many pages is stored once, and downloaded once per Confluence file id.
+
+An index kept next to the blobs remembers the hash of every file id
+downloaded, so later runs link them without downloading them again, and
+the hash behind every name in `_images/`. Two different files with the
+same name don't overwrite or hide each other: the second one is linked
+under its name prefixed with the start of its hash.
+"""
+
+BLOBS_DIR_NAME = "_blobs"
+INDEX_FILE_NAME = "index.sqlite"
+HASH_PREFIX_LENGTH = 12     # of the hash put in front of a file name taken by another file
+
+
+class BlobStore:
+    def __init__(self, outdir):
+        self.root = os.path.join(outdir, BLOBS_DIR_NAME)
+        os.makedirs(os.path.join(self.root, "incoming"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.db = sqlite3.connect(os.path.join(self.root, INDEX_FILE_NAME), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_id TEXT PRIMARY KEY,
+                sha256 TEXT,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS links (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT
+            );
+        """)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def incoming_path(self, file_id):
+        """Where a file id is downloaded to before add() moves it into the store"""
+        return os.path.join(self.root, "incoming", re.sub(r'[^\w.-]', '_', file_id))
+
+    def lookup(self, file_id):
+        """Hash of the content of a file id, or None if it isn't in the store"""
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM files WHERE file_id = ?", (file_id,)).fetchone()
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            return None
+        return row[0]
+
+    def fetch(self, file_id, download):
+        """Hash of the content of a file id, calling download(path) first if it isn't in the store yet
+
+        Returns:
+            SHA-256 of the content
+        """
+        with self.lock:
+            file_lock = self.file_locks.setdefault(file_id, threading.Lock())
+        with file_lock:
+            sha256 = self.lookup(file_id)
+            if sha256 is None:
+                incoming_path = self.incoming_path(file_id)
+                download(incoming_path)
+                sha256 = self.add(file_id, incoming_path)
+            return sha256
+
+    def add(self, file_id, file_path):
+        """Move a downloaded file into the store, dropping it if the same content is there already"""
+        sha256 = file_sha256(file_path)
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            os.remove(file_path)
+        else:
+            os.replace(file_path, blob_path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (file_id, sha256, os.path.getsize(blob_path))
+            )
+            self.db.commit()
+        return sha256
+
+    def linked_files(self):
+        """(path relative to the output folder, hash) of every name linked to a blob"""
+        with self.lock:
+            return self.db.execute("SELECT path, sha256 FROM links").fetchall()
+
+    def import_blob(self, sha256, source_path):
+        """Put a file with this hash into the store, hard linked from source_path, unless it is there already"""
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(blob_path):
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(source_path, blob_path)
+        except OSError:
+            shutil.copyfile(source_path, blob_path)
+
+    def import_file_ids(self, other):
+        """Take in the file ids another store downloaded, for the blobs this store has"""
+        with other.lock:
+            rows = other.db.execute("SELECT file_id, sha256, size FROM files").fetchall()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO files VALUES (?, ?, ?)",
+                [row for row in rows if os.path.exists(self.blob_path(row[1]))],
+            )
+            self.db.commit()
+
+    def _link_key(self, file_path):
+        """Path of a file relative to the output folder, so the output can be moved"""
+        return os.path.relpath(file_path, os.path.dirname(self.root))
+
+    def _linked_hash(self, file_path):
+        """Hash of the content behind a name in the output, None if the name is free"""
+        row = self.db.execute("SELECT sha256 FROM links WHERE path = ?", (self._link_key(file_path),)).fetchone()
+        if os.path.exists(file_path):
+            if row is not None:
+                return row[0]
+            # left by an export made before the store, or by something else
+            sha256 = file_sha256(file_path)
+            self.db.execute("INSERT OR REPLACE INTO links VALUES (?, ?)", (self._link_key(file_path), sha256))
+            return sha256
+        return None
+
+    def link(self, sha256, outdir, file_name):
+        """Show a blob in outdir as file_name, or under a hash-prefixed name if another file has that name
+
+        Returns:
+            file name the blob can be found under in outdir
+        """
+        with self.lock:
+            file_path = os.path.join(outdir, file_name)
+            linked = self._linked_hash(file_path)
+            if linked is not None and linked != sha256:
+                file_name = f"{sha256[:HASH_PREFIX_LENGTH]}-{file_name}"
+                file_path = os.path.join(outdir, file_name)
+                linked = self._linked_hash(file_path)
+            if linked is None:
+                try:
+                    os.link(self.blob_path(sha256), file_path)
+                except OSError:
+                    shutil.copyfile(self.blob_path(sha256), file_path)
+                self.db.execute("INSERT OR REPLACE INTO links VALUES (?, ?)", (self._link_key(file_path), sha256))
+            self.db.commit()
+            return file_name
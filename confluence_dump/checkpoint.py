@@ -0,0 +1,74 @@
+import json
+import os
+import threading
+import time
+
+"""
+Checkpoint journal of a space export, to resume it after an interruption
+
+Each page written to disk is appended to a journal in the output folder,
+one JSON line with its id and output files. The lines are buffered and
+written in batches, flushed to disk at least every few seconds, and once
+more when the export stops, including after Ctrl+C.
+
+export_space(resume=True) skips the pages of the journal whose files are
+still there. A run that goes through the whole space removes its journal,
+so the next one starts from the beginning again.
+"""
+
+JOURNAL_FILE_NAME = ".confluence_dump_checkpoint-{space_id}.jsonl"
+FLUSH_PAGES = 100       # pages buffered before the journal is written
+FLUSH_SECONDS = 5       # longest time a page stays in the buffer
+
+
+class CheckpointJournal:
+    def __init__(self, outdir, space_id, resume=False):
+        self.path = os.path.join(outdir, JOURNAL_FILE_NAME.format(space_id=space_id))
+        self.completed = self._load(self.path) if resume else {}
+        self.file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        self.pending = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _load(path):
+        completed = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue        # cut short when the process was killed
+                    completed[entry['page_id']] = entry['paths']
+        except FileNotFoundError:
+            pass
+        return completed
+
+    def is_completed(self, page_id):
+        """Check whether the journal has the page, with all its files still there"""
+        paths = self.completed.get(str(page_id))
+        return paths is not None and all(os.path.exists(p) for p in paths)
+
+    def record(self, page_id, paths):
+        """Add a page written to disk, flushing the buffer when it is full or old enough"""
+        with self.lock:
+            self.pending.append(json.dumps({'page_id': str(page_id), 'paths': paths}))
+            if len(self.pending) >= FLUSH_PAGES or time.time() - self.last_flush >= FLUSH_SECONDS:
+                self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.file.write("".join(f"{line}\n" for line in self.pending))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = []
+        self.last_flush = time.time()
+
+    def close(self, complete=False):
+        """Write the buffered pages, and remove the journal if the whole space went through"""
+        with self.lock:
+            self._flush()
+            self.file.close()
+            if complete:
+                os.remove(self.path)
@@ -1,14 +1,84 @@
+import asyncio
 import os.path
 import json
 import signal
 import time
 import logging
+import multiprocessing
+import threading
+from collections import deque
 from dateutil import parser
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+import requests
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from humanfriendly import format_timespan
 from datetime import timezone
-from confluence_dump.myModules import get_page_last_modified, get_page_name, get_body_export_view, get_page_parent, mk_outdirs, get_page_labels, dump_html, get_spaces_all, get_space_title, get_pages_from_space, get_page_properties_children
+from confluence_dump.rate_limit import RateLimiter
+from confluence_dump.export_state import ExportState
+from confluence_dump.pandoc_worker import PandocPool
+from confluence_dump.downloads import AssetDownloader
+from confluence_dump.blob_store import BlobStore
+from confluence_dump.http_cache import ResponseCache
+from confluence_dump.checkpoint import CheckpointJournal
+from confluence_dump.shards import ShardManifest, page_shard
+from confluence_dump.page_archive import PageArchive, existing_archive_path, page_archive_record, read_page_archive
+from confluence_dump.myModules import get_page, get_pages_by_id, get_page_properties_children, report_child_ids, mk_outdirs, set_dirs, dump_html, fetch_page_assets, render_page, get_spaces_all, get_pages_from_space, get_session, search_content_by_cql, cql_date, page_record_from_json, PageAssets, PageRecord, PAGE_EXPAND, READ_AHEAD
+
+# The PandocPool of a transform process, set up by init_transform_process
+transform_pandoc = None
+
+
+def init_transform_process():
+    global transform_pandoc
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the exporter in the main process
+    transform_pandoc = PandocPool(1)
+
+
+def render_page_in_process(render_args):
+    """Run render_page in a transform process"""
+    return render_page(**render_args, arg_pandoc=transform_pandoc)
+
+
+class ExportProgress:
+    """Thread-safe page counter that logs progress and ETA and collects results
+
+    When the pages are exported while they are still being listed, total
+    starts at 0 and grows with each listed page (see track).
+    """
+    def __init__(self, total, log_interval):
+        self.total = total
+        self.log_interval = log_interval
+        self.done = 0
+        self.failed = 0
+        self.results = {}
+        self.start_time = time.time()
+        self.last_log_time = self.start_time
+        self.lock = threading.Lock()
+
+    def advance(self, action, key=None, result=None):
+        with self.lock:
+            self.done += 1
+            if key is not None:
+                self.results[key] = result
+            now = time.time()
+            if now - self.last_log_time >= self.log_interval:
+                estimated_time_remaining = (now - self.start_time) / self.done * (self.total - self.done)
+                logging.info(f"{action} {self.done}/{self.total} - Time elapsed: {format_timespan(now - self.start_time)}, estimated time remaining: {format_timespan(estimated_time_remaining)}")
+                self.last_log_time = now
+
+    def fail(self, action, page_id, error):
+        """Count a page that went wrong, logging why"""
+        logging.error(f"Error {action.lower()} {page_id}: {error}")
+        with self.lock:
+            self.failed += 1
+        self.advance(action)
+
+    def track(self, items):
+        """Yield items, counting each of them in total as it is listed"""
+        for item in items:
+            with self.lock:
+                self.total += 1
+            yield item
 
 
 class ConfluenceExporter:
@@ -27,7 +97,21 @@ class ConfluenceExporter:
         log_interval=5,  # Log progress every 5 seconds
         start_date: datetime = None,
         end_date: datetime = None,
-        workers: int = 4
+        workers: int = 4,
+        backend: str = "threads",  # "threads" or "async"
+        concurrency: int = 100,  # Requests in flight with the async backend
+        max_rate: float = 50,  # Requests per second sent to the site at most
+        incremental: bool = False,  # Only export pages whose version changed since the last run
+        bulk: bool = False,  # Get the page bodies with the page listing instead of one request per page
+        read_ahead: int = READ_AHEAD,  # Listing responses fetched ahead of the export, 0 to disable
+        transform_workers: int = 0,  # Processes rewriting and converting the pages, 0 to do it in the fetching threads
+        downloads_per_host: int = 4,  # Downloads running against one external host at most
+        dedupe_attachments: bool = True,  # Store each attachment once by content hash and link it into _images
+        cache_size_mb: int = 1024,  # Size of the on-disk cache of API responses, 0 to disable it
+        offline: bool = False,  # Replay the API responses from the cache without sending any request
+        resume: bool = False,  # Skip the pages an interrupted export of the space already wrote
+        shard: tuple = None,  # (K, N) to only export the pages of shard K out of N, see confluence_dump.shards
+        prune_deleted: bool = False  # Remove the output of pages deleted in Confluence (incremental only)
     ):
         self.site = site
         self.space = space
@@ -39,27 +123,330 @@ class ConfluenceExporter:
         self.showlabels = showlabels
         self.log_interval = log_interval
         self.interrupted = False
+        self.failed_pages = 0  # pages that went wrong in the last export
         self.start_date = start_date
         self.end_date = end_date
         self.workers = workers
+        self.backend = backend
+        self.concurrency = concurrency
+        self.incremental = incremental
+        self.bulk = bulk
+        self.read_ahead = read_ahead
+        self.transform_workers = transform_workers
+        self.transform_pool = None
+        self.prune_deleted = prune_deleted
+        self.state = None
+        self.archive = None
+        self.resume = resume
+        self.journal = None
+        self.shard = shard
+        self.shard_manifest = ShardManifest(self.outdir, *shard) if shard else None
+        self.dedupe_attachments = dedupe_attachments
+        self.blob_stores = {}  # by base output folder
+        self.blob_stores_lock = threading.Lock()
         signal.signal(signal.SIGINT, self.signal_handler)
-        
-        global interrupted
-        interrupted = False
 
         # Get API credentials from arguments or environment variables
         self.user_name = api_username or os.environ.get("atlassianUserEmail")
         self.api_token = api_token or os.environ.get("atlassianAPIToken")
 
+        # One rate limiter and one pooled keep-alive session per exporter, shared by every API call and download
+        self.rate_limiter = RateLimiter(
+            f"{self.site}.atlassian.net",
+            max_rate=max_rate,
+            max_concurrency=self.concurrency if self.backend == "async" else self.workers,
+        )
+        # API responses kept under the output folder, revalidated on the next run or replayed offline
+        if offline and cache_size_mb <= 0:
+            raise ValueError("Offline mode replays the response cache, which cache_size_mb=0 disables")
+        self.offline = offline
+        self.response_cache = None
+        if cache_size_mb > 0:
+            self.response_cache = ResponseCache(self.outdir, cache_size_mb * 1024 * 1024, offline)
+        download_workers = self.workers * 2
+        # a connection for each thread sharing the session, the workers and the downloader threads
+        self.session = get_session(
+            self.site, self.user_name, self.api_token, self.workers + download_workers, self.rate_limiter, self.response_cache
+        )
+        # pandoc processes kept running for the RST conversion, one per worker at most
+        self.pandoc = PandocPool(self.workers)
+        # threads downloading the attachments and images of the pages, the site itself is paced by the rate limiter
+        self.downloader = AssetDownloader(
+            max_workers=download_workers,
+            per_host=downloads_per_host,
+            unlimited_hosts={f"{self.site}.atlassian.net"},
+        )
+
         # Set up logging
         logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
     def signal_handler(self, signal, frame):
-        print('Ctrl+C caught! Exiting gracefully...')
-        global interrupted
-        interrupted = True
+        if self.interrupted:
+            print('Ctrl+C caught again! Exiting now...')
+            exit(1)
+        print('Ctrl+C caught! Finishing the pages in progress, press Ctrl+C again to exit now...')
         self.interrupted = True
-        exit(1)
+
+    def _async_engine(self):
+        from confluence_dump.async_exporter import AsyncConfluenceExporter
+        return AsyncConfluenceExporter(self)
+
+    def _log_rate_limit_metrics(self):
+        metrics = self.rate_limiter.metrics()
+        logging.info(
+            f"{metrics['requests']} API requests, {metrics['throttled_responses']} throttled by the site, "
+            f"{format_timespan(metrics['throttled_seconds'])} spent waiting on the rate limiter across requests "
+            f"(ended at {metrics['rate']} requests/s, {metrics['concurrency']} in flight)"
+        )
+
+    def _in_date_range(self, last_modified):
+        """Check a last-modified timestamp against start_date and end_date"""
+        last_modified = parser.isoparse(last_modified).replace(tzinfo=timezone.utc)
+        return (not self.start_date or last_modified >= self.start_date) and (not self.end_date or last_modified <= self.end_date)
+
+    def _find_space(self, all_spaces_full):
+        """Return (space_id, space_name, space_key) of self.space, or None if it isn't in the list"""
+        space_key = self.space
+        for n in all_spaces_full:
+            if (
+                (n["key"] == space_key)
+                or n["key"] == str.upper(space_key)
+                or n["key"] == str.lower(space_key)
+            ):
+                logging.info("Found space: " + n["key"])
+                return n["id"], n["name"], n["key"]
+        return None
+
+    def _space_outdirs(self, space_id, space_name):
+        my_outdir_content = os.path.join(
+            self.outdir, f"{space_id}-{space_name}")
+        os.makedirs(my_outdir_content, exist_ok=True)
+        my_outdir_base = self.outdir
+        if self.sphinx is False:
+            my_outdir_base = my_outdir_content
+        return my_outdir_base, my_outdir_content
+
+    @staticmethod
+    def _short_page(n):
+        return {
+            "page_id": n["id"],
+            "pageTitle": n["title"],
+            "parentId": n["parentId"],
+            "space_id": n["spaceId"],
+            "version": n.get("version", {}).get("number"),
+        }
+
+    def _date_range_cql(self, cql):
+        """Narrow a CQL query down to the pages modified in the date range
+
+        CQL compares dates in the user's timezone at minute precision, so the
+        range is widened by a day on both sides; the exact check is made on
+        each fetched page.
+        """
+        if self.start_date:
+            cql += f' and lastmodified >= "{cql_date(self.start_date - timedelta(days=1))}"'
+        if self.end_date:
+            cql += f' and lastmodified <= "{cql_date(self.end_date + timedelta(days=1))}"'
+        return cql
+
+    def _search_expand(self):
+        """Expansions for the CQL page search: the full page record in bulk mode"""
+        return PAGE_EXPAND if self.bulk else "ancestors,version"
+
+    def _short_page_from_content(self, n, space_id=None):
+        """Same as _short_page, for a content object of the v1 API expanded with ancestors and version
+
+        In bulk mode the content also carries the body and the rest of the page
+        record, which is kept under "page" so the page isn't fetched again.
+        Without space_id, the space is read from the content (expanded with space).
+        """
+        if space_id is None:
+            space_id = str(n["space"]["id"])
+        ancestors = n.get("ancestors") or []
+        short_page = {
+            "page_id": str(n["id"]),
+            "pageTitle": n["title"],
+            "parentId": ancestors[-1]["id"] if ancestors else None,
+            "space_id": space_id,
+            "version": n.get("version", {}).get("number"),
+        }
+        if self.bulk and "export_view" in n.get("body", {}):
+            short_page["page"] = page_record_from_json(n, self.user_name, self.api_token, self.session)
+        return short_page
+
+    def _search_pages(self, space_key, space_id, read_ahead):
+        """Yield the pages of a space listed with CQL (in the date range, if any)
+
+        Returns None instead if the search fails right away, so the caller
+        can fall back to listing the space.
+        """
+        cql = self._date_range_cql(f'space="{space_key}" and type=page')
+        logging.info(f"Searching pages with CQL: {cql}")
+        results = search_content_by_cql(
+            self.site, cql, self.user_name, self.api_token, self.session,
+            arg_expand=self._search_expand(), arg_limit=250, arg_read_ahead=read_ahead
+        )
+        try:
+            first = next(results, None)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logging.warning(f"CQL search failed ({e}), falling back to listing the space")
+            return None
+
+        def pages():
+            if first is None:
+                return
+            yield self._short_page_from_content(first, space_id)
+            for n in results:
+                yield self._short_page_from_content(n, space_id)
+        return pages()
+
+    def _list_pages(self, space_key, space_id, read_ahead=None):
+        """Yield the pages of a space as the listing responses arrive
+
+        With a date range, the search API lists only the matching pages. In
+        bulk mode the search also returns the page bodies, many pages per request.
+        read_ahead defaults to the one of the exporter.
+        """
+        if read_ahead is None:
+            read_ahead = self.read_ahead
+        pages = None
+        if self.bulk or self.start_date or self.end_date:
+            pages = self._search_pages(space_key, space_id, read_ahead)
+        if pages is None:
+            if self.start_date or self.end_date:
+                logging.info("The date range is checked on each page as it is fetched")
+            pages = (self._short_page(n) for n in get_pages_from_space(
+                self.site, space_id, self.user_name, self.api_token, self.session, read_ahead
+            ))
+        return pages
+
+    def _blob_store(self, outdir_base):
+        """BlobStore of a base output folder, None when attachments aren't deduplicated"""
+        if not self.dedupe_attachments:
+            return None
+        with self.blob_stores_lock:
+            if outdir_base not in self.blob_stores:
+                self.blob_stores[outdir_base] = BlobStore(outdir_base)
+            return self.blob_stores[outdir_base]
+
+    def _close_blob_stores(self):
+        with self.blob_stores_lock:
+            for blob_store in self.blob_stores.values():
+                blob_store.close()
+            self.blob_stores = {}
+
+    def _flush_response_cache(self):
+        if self.response_cache is not None:
+            self.response_cache.flush()
+
+    def _open_archive(self, keep_previous=False):
+        """Start the page archive the rerender mode works from
+
+        keep_previous keeps the archived pages of the spaces the run goes
+        through, for runs that don't export whole spaces: incremental,
+        resumed and date range runs skip pages that are still there.
+        """
+        self.archive = PageArchive(
+            self.outdir,
+            keep_previous=bool(keep_previous or self.incremental or self.resume or self.start_date or self.end_date),
+        )
+
+    def _close_archive(self):
+        if self.archive is not None:
+            self.archive.close(interrupted=self.interrupted)
+            self.archive = None
+
+    def _open_journal(self, space_id):
+        """Start the checkpoint journal of the space, reading the one of the interrupted run when resuming"""
+        self.journal = CheckpointJournal(self.outdir, space_id, resume=self.resume)
+
+    def _close_journal(self):
+        if self.journal is not None:
+            self.journal.close(complete=not self.interrupted)
+            self.journal = None
+            if self.interrupted:
+                logging.warning("Run the export again with resume to continue where it stopped")
+
+    def _in_shard(self, page_id):
+        """Check whether a page is exported by this shard, always true without sharding"""
+        return self.shard is None or page_shard(page_id, self.shard[1]) == self.shard[0]
+
+    def _write_shard_manifest(self):
+        if self.shard_manifest is not None:
+            self.shard_manifest.write()
+
+    def _open_state(self):
+        if self.state is None:
+            self.state = ExportState(self.outdir)
+        return self.state
+
+    def _flag_deleted_pages(self, space_id, listed_page_ids):
+        """Flag the pages exported by an earlier run that are not in the space anymore
+
+        They are removed with their files and their archived record instead
+        when prune_deleted is set, so a rerender doesn't bring them back.
+        """
+        for page_id, output_paths in self.state.missing_pages(space_id, listed_page_ids):
+            if self.prune_deleted:
+                logging.info(f"Page {page_id} was deleted in Confluence, removing {', '.join(output_paths)}")
+            else:
+                logging.warning(f"Page {page_id} was deleted in Confluence, its files are kept: {', '.join(output_paths)}")
+            self.state.mark_deleted(page_id, remove_files=self.prune_deleted)
+            if self.prune_deleted and self.archive is not None:
+                self.archive.discard(page_id)
+
+    def _select_pages_to_export(self, pages, space_id):
+        """Skip the pages of other shards, and the ones already exported at their current version (incremental) or by the interrupted run (resume)
+
+        Deleted pages can only be told apart once the whole space was listed,
+        so they are flagged after the last page went through. Pages listed from
+        several spaces (space_id None) are never flagged.
+        """
+        if not self.incremental and not self.resume and self.shard is None:
+            yield from pages
+            return
+        if self.incremental:
+            self._open_state()
+        listed_page_ids = []
+        changed = 0
+        resumed = 0
+        other_shards = 0
+        for p in pages:
+            listed_page_ids.append(p["page_id"])
+            if not self._in_shard(p["page_id"]):
+                other_shards += 1
+                continue
+            if self.incremental and self.state.is_current(p["page_id"], p["version"]):
+                continue
+            if self.resume and self.journal.is_completed(p["page_id"]):
+                resumed += 1
+                continue
+            changed += 1
+            yield p
+        if self.shard is not None:
+            logging.info(f"{other_shards} pages left to the other shards")
+        if self.resume:
+            logging.info(f"{resumed} pages were already exported by the interrupted run")
+        if self.interrupted or not self.incremental:
+            return
+        if space_id is not None:
+            self._flag_deleted_pages(space_id, listed_page_ids)
+        logging.info(f"{len(listed_page_ids) - changed - resumed - other_shards} pages unchanged since the last export, {changed} to update")
+
+    @staticmethod
+    def _single_page_title(page):
+        return (
+            page.title
+            .replace("/", "-")
+            .replace(",", "")
+            .replace("&", "And")
+            .replace(":", "-")
+        )
+
+    def _single_page_outdir(self, page_id, page):
+        return os.path.join(
+            self.outdir, f"{page_id}-{self._single_page_title(page)}"
+        )  # sets outdir to path under page_name
 
     def export_single_page(self, page_id, **kwargs):
         start_time = time.time()
@@ -68,275 +455,651 @@ class ConfluenceExporter:
             setattr(self, key, value)
 
         logging.info(f"Exporting a single page (Sphinx set to {self.sphinx})")
-        page_id = page_id
-        
-        last_modified = get_page_last_modified(
-            self.site, page_id, self.user_name, self.api_token
+        if self.backend == "async":
+            return asyncio.run(self._async_engine().export_single_page(page_id, start_time))
+
+        try:
+            page = get_page(
+                self.site, page_id, self.user_name, self.api_token, self.session
+            )
+        except BaseException:
+            self._close_single_page()
+            raise
+        return self._dump_single_page(page_id, page, start_time)
+
+    def _dump_single_page(self, page_id, page, start_time, downloader=None):
+        """Write a fetched single page to disk, unless it is outside the date range
+
+        downloader replaces the one of the exporter, for the async backend.
+        """
+        try:
+            last_modified_date = datetime.fromisoformat(page.last_modified)
+
+            if self.start_date and last_modified_date < self.start_date:
+                logging.info(f"Page {page_id} was last modified on {last_modified_date}, which is before the start date {self.start_date}. Skipping.")
+                return
+
+            if self.end_date and last_modified_date > self.end_date:
+                logging.info(f"Page {page_id} was last modified on {last_modified_date}, which is after the end date {self.end_date}. Skipping.")
+                return
+
+            my_body_export_view_title = self._single_page_title(page)
+            my_outdir_base = self._single_page_outdir(page_id, page)
+            my_outdir_content = my_outdir_base
+
+            #    if args.sphinx is False:
+            #        my_outdir_base = os.path.join(my_outdir_base,f"{page_id}-{my_body_export_view_title}")        # sets outdir to path under page_name
+            #        my_outdir_content = my_outdir_base
+            #    else:
+            #        my_outdir_content = my_outdir_base
+            my_outdirs = []
+            my_outdirs = mk_outdirs(
+                my_outdir_base
+            )  # attachments, embeds, scripts
+            logging.info(
+                f'Base export folder is "{my_outdir_base}" and the Content goes to "{my_outdir_content}"'
+            )
+            try:
+                url, dumped_file_path = dump_html(
+                    self.site,
+                    page.html,
+                    my_body_export_view_title,
+                    page_id,
+                    my_outdir_base,
+                    my_outdir_content,
+                    page.labels,
+                    page.parent_id,
+                    self.user_name,
+                    self.api_token,
+                    self.sphinx,
+                    self.tags,
+                    arg_html_output=self.html,
+                    arg_rst_output=self.rst,
+                    arg_show_labels=self.showlabels,
+                    arg_session=self.session,
+                    arg_page=page,
+                    arg_pandoc=self.pandoc,
+                    arg_downloader=downloader or self.downloader,
+                    arg_blob_store=self._blob_store(my_outdir_base),
+                )
+            except Exception as e:
+                logging.error(f"Error exporting page {page_id}: {e}")
+                return None, None, None, None, None, None
+        finally:
+            self._close_single_page()
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        logging.info(f"Done! Exporting single page took {format_timespan(elapsed_time)}.")
+        self._log_rate_limit_metrics()
+        return my_body_export_view_title, page_id, url, dumped_file_path, self.space, self.site
+
+    def _close_single_page(self):
+        """Stop what a single page export started, whether the page was written or not"""
+        self.pandoc.close()
+        self.downloader.close()
+        self._close_blob_stores()
+        self._flush_response_cache()
+
+    def _run_concurrently(self, items, export_fn, progress, page_id_of=lambda item: item):
+        """Run export_fn over items on a bounded worker pool
+
+        At most two tasks per worker are queued at any time, so long page
+        lists don't turn into thousands of pending futures. On interruption
+        the queued tasks are cancelled and the running ones are left to finish.
+        When export_fn raises, the page of the item counts as failed in progress.
+        """
+        max_in_flight = self.workers * 2
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        in_flight = {}  # item of each future
+
+        def collect(done):
+            for future in done:
+                item = in_flight.pop(future)
+                if not future.cancelled() and future.exception() is not None:
+                    progress.fail("Exporting page", page_id_of(item), future.exception())
+
+        try:
+            for item in items:
+                if self.interrupted:
+                    break
+                in_flight[executor.submit(export_fn, item)] = item
+                if len(in_flight) >= max_in_flight:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            collect(wait(in_flight).done)
+        except BaseException:
+            self.interrupted = True
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
+
+    def _start_transform_pool(self, transform_workers=None):
+        """Start the transform processes, if any, before any other thread of the export runs
+
+        The processes are forked where possible, which is only safe while no
+        other thread holds a lock, and doesn't need a __main__ guard in the
+        calling script. The pages waiting for a process are bounded by
+        transform_slots, so the fetching threads pause when it is full.
+        """
+        transform_workers = transform_workers or self.transform_workers
+        if transform_workers < 1:
+            return
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        self.transform_pool = ProcessPoolExecutor(
+            max_workers=transform_workers, mp_context=context, initializer=init_transform_process
         )
-        last_modified_date = datetime.fromisoformat(last_modified)
-        
-        if self.start_date and last_modified_date < self.start_date:
-            logging.info(f"Page {page_id} was last modified on {last_modified_date}, which is before the start date {self.start_date}. Skipping.")
+        self.transform_slots = threading.BoundedSemaphore(transform_workers * 2)
+        self.transform_pool.submit(int).result()  # forks all the processes now
+
+    def _stop_transform_pool(self):
+        """Wait for the queued pages to be written, or drop them when interrupted"""
+        if self.transform_pool is None:
             return
-        
-        if self.end_date and last_modified_date > self.end_date:
-            logging.info(f"Page {page_id} was last modified on {last_modified_date}, which is after the end date {self.end_date}. Skipping.")
+        self.transform_pool.shutdown(wait=True, cancel_futures=self.interrupted)
+        self.transform_pool = None
+
+    def _export_space_page(self, p, my_outdir_base, my_outdir_content, progress):
+        """Export one page of a space, recording the result in progress"""
+        if self.interrupted:
             return
-        
-        page_name = get_page_name(
-            self.site, page_id, self.user_name, self.api_token
-        )
+        try:
+            page = p.get("page") or get_page(
+                self.site, p["page_id"], self.user_name, self.api_token, self.session
+            )
+        except Exception as e:
+            progress.fail("Exporting page", p["page_id"], e)
+            return
+        if (self.start_date or self.end_date) and not self._in_date_range(page.last_modified):
+            progress.advance("Skipping page")
+            return
+        self._dump_space_page(p, page, my_outdir_base, my_outdir_content, progress)
+
+    def _dump_space_page(self, p, page, my_outdir_base, my_outdir_content, progress, downloader=None):
+        """Write a fetched page of a space to disk, recording the result in progress
 
-        my_body_export_view = get_body_export_view(
-            self.site, page_id, self.user_name, self.api_token
-        ).json()
-        my_body_export_view_html = my_body_export_view["body"]["export_view"]["value"]
+        downloader replaces the one of the exporter, for the async backend.
+        """
         my_body_export_view_title = (
-            my_body_export_view["title"]
+            p["pageTitle"]
             .replace("/", "-")
             .replace(",", "")
             .replace("&", "And")
-            .replace(":", "-")
+            .replace(" ", "_")
+            # added .replace(" ","_") so that filenames have _ as a separator
         )
+        logging.debug(f"Getting page {my_body_export_view_title}, {p['page_id']}")
+        logging.debug(f"dump_html arg sphinx_compatible = {self.sphinx}")
+        try:
+            assets = fetch_page_assets(
+                self.site, page.html, p["page_id"], my_outdir_base, my_outdir_content,
+                self.user_name, self.api_token, arg_session=self.session, arg_page=page,
+                arg_downloader=downloader or self.downloader,
+                arg_blob_store=self._blob_store(my_outdir_base),
+            )
+        except Exception as e:
+            progress.fail("Exporting page", p["page_id"], e)
+            return
+        if self.archive is not None:
+            self.archive.add(page_archive_record(
+                page, p["space_id"], os.path.relpath(my_outdir_content, self.outdir),
+                my_body_export_view_title, p["parentId"], assets, self.sphinx,
+            ))
+        render_args = self._render_args(page, my_body_export_view_title, my_outdir_content, p["parentId"], assets)
 
-        server_url = f"https://{self.site}.atlassian.net/wiki/api/v2/spaces/?limit=250"
+        def rendered(result, error):
+            if error is not None:
+                progress.fail("Exporting page", p["page_id"], error)
+                return
+            url, dumped_file_path = result
+            self._record_space_page(p, page, my_body_export_view_title, my_outdir_base, assets, url, dumped_file_path, progress)
 
-        page_url = f"{my_body_export_view['_links']['base']}"
-        page_parent = get_page_parent(
-            self.site, page_id, self.user_name, self.api_token
-        )
+        self._render(render_args, rendered)
 
-        my_outdir_base = os.path.join(
-            self.outdir, f"{page_id}-{my_body_export_view_title}"
-        )  # sets outdir to path under page_name
-        my_outdir_content = my_outdir_base
-
-        #    if args.sphinx is False:
-        #        my_outdir_base = os.path.join(my_outdir_base,f"{page_id}-{my_body_export_view_title}")        # sets outdir to path under page_name
-        #        my_outdir_content = my_outdir_base
-        #    else:
-        #        my_outdir_content = my_outdir_base
-        my_outdirs = []
-        my_outdirs = mk_outdirs(
-            my_outdir_base
-        )  # attachments, embeds, scripts
-        my_page_labels = get_page_labels(
-            self.site, page_id, self.user_name, self.api_token
-        )
-        logging.info(
-            f'Base export folder is "{my_outdir_base}" and the Content goes to "{my_outdir_content}"'
+    def _render_args(self, page, title, outdir_content, parent_id, assets, page_type=""):
+        """Arguments of render_page for a page, with the output options of the exporter"""
+        return dict(
+            arg_type=page_type,
+            arg_html=page.html,
+            arg_title=title,
+            arg_page_id=page.id,
+            arg_outdir_content=outdir_content,
+            arg_page_labels=page.labels,
+            arg_page_parent=parent_id,
+            arg_assets=assets,
+            arg_sphinx_compatible=self.sphinx,
+            arg_html_output=self.html,
+            arg_rst_output=self.rst,
+            arg_show_labels=self.showlabels,
         )
+
+    def _render(self, render_args, rendered):
+        """Run render_page on a transform process, or in this thread without them, then call rendered(result, error)"""
+        if self.transform_pool is None:
+            try:
+                result = render_page(**render_args, arg_pandoc=self.pandoc)
+            except Exception as e:
+                rendered(None, e)
+                return
+            self._call_rendered(rendered, result)
+            return
+
+        def done(future):
+            self.transform_slots.release()
+            if future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                rendered(None, e)
+                return
+            self._call_rendered(rendered, result)
+
+        self.transform_slots.acquire()
         try:
-            url, dumped_file_path = dump_html(
-                self.site,
-                my_body_export_view_html,
-                my_body_export_view_title,
-                page_id,
-                my_outdir_base,
-                my_outdir_content,
-                my_page_labels,
-                page_parent,
-                self.user_name,
-                self.api_token,
-                self.sphinx,
-                self.tags,
-                arg_html_output=self.html,
-                arg_rst_output=self.rst,
-            )
+            future = self.transform_pool.submit(render_page_in_process, render_args)
+        except BaseException:
+            self.transform_slots.release()
+            raise
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _call_rendered(rendered, result):
+        """Call rendered with the result of a page, or with the error if writing down the page raised"""
+        try:
+            rendered(result, None)
         except Exception as e:
-            logging.error(f"Error exporting page {page_id}: {e}")
-            return None, None, None, None, None, None
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        logging.info(f"Done! Exporting single page took {format_timespan(elapsed_time)}.")
-        return my_body_export_view_title, page_id, url, dumped_file_path, self.space, self.site
+            rendered(None, e)
+
+    def _log_failures(self, progress):
+        """Keep the number of pages that went wrong in failed_pages, and log it"""
+        self.failed_pages = progress.failed
+        if progress.failed:
+            logging.error(f"{progress.failed} pages could not be exported, see the errors above")
+
+    def _record_space_page(self, p, page, my_body_export_view_title, my_outdir_base, assets, url, dumped_file_path, progress):
+        output_paths = [dumped_file_path]
+        if self.html and self.rst:
+            output_paths.append(f"{os.path.splitext(dumped_file_path)[0]}.html")
+        if self.state is not None:
+            self.state.record_page(page, p["space_id"], output_paths, set_dirs(my_outdir_base)[0], assets.renamed)
+        if self.journal is not None:
+            self.journal.record(p["page_id"], output_paths)
+        if self.shard_manifest is not None:
+            self.shard_manifest.record(p["page_id"], p["space_id"], output_paths)
+        progress.advance("Exporting page", my_body_export_view_title, (p["page_id"], url, dumped_file_path, page.space_key or self.space, self.site))
 
     def export_space(self, **kwargs):
-        global last_log_time
         start_time = time.time()
-        last_log_time = start_time
-        global filtered_pages_count
-        filtered_pages_count = 0
-        global page_counter
-        page_counter = 0
-        global interrupted
         # Update attributes with kwargs if provided
         for key, value in kwargs.items():
             setattr(self, key, value)
 
         logging.info(f"Exporting a whole space (Sphinx set to {self.sphinx})")
-        space_key = self.space
-        all_spaces_full = get_spaces_all(
-            self.site, self.user_name, self.api_token
-        )  # get a dump of all spaces
-        all_spaces_short = []  # initialize list for less detailed list of spaces
-        i = 0
-        for n in all_spaces_full:
-            global interrupted
-            if interrupted or self.interrupted:
-                logging.warning("Interrupting export of space")
+        self._start_transform_pool()
+        self._open_archive()
+        if self.backend == "async":
+            try:
+                return asyncio.run(self._async_engine().export_space(start_time))
+            finally:
+                self._stop_transform_pool()
+                self._close_archive()
+                self._close_journal()
+                self._write_shard_manifest()
+
+        progress = ExportProgress(0, self.log_interval)
+        try:
+            all_spaces = get_spaces_all(
+                self.site, self.user_name, self.api_token, self.session, self.read_ahead
+            )  # stream the spaces, stopping at the one we look for
+            space = self._find_space(all_spaces)
+            if space is None:  # if the supplied space key can't be found
+                logging.error("Could not find Space Key in this site")
+                return {}
+            space_id, space_name, space_key = space
+            my_outdir_base, my_outdir_content = self._space_outdirs(space_id, space_name)
+            self._open_journal(space_id)
+
+            # The pages are exported while the listing is still being paginated
+            logging.info(f"Starting export with {self.workers} workers")
+            mk_outdirs(my_outdir_base)  # create the shared folders once, before the workers race for them
+            pages = self._select_pages_to_export(self._list_pages(space_key, space_id), space_id)
+            self._run_concurrently(
+                progress.track(pages),
+                lambda p: self._export_space_page(p, my_outdir_base, my_outdir_content, progress),
+                progress,
+                lambda p: p["page_id"],
+            )
+        finally:
+            self._stop_transform_pool()
+            self.pandoc.close()
+            self.downloader.close()
+            self._close_blob_stores()
+            self._flush_response_cache()
+            self._close_archive()
+            self._close_journal()
+            self._write_shard_manifest()
+        if self.interrupted:
+            logging.warning(f"Interrupted export of space after {progress.done}/{progress.total} pages")
+        else:
+            logging.info(f"{progress.done} pages went through the export")
+        self._log_failures(progress)
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        logging.info(f"Done! Exporting space took {format_timespan(elapsed_time)}.")
+        self._log_rate_limit_metrics()
+        return progress.results
+
+    def _dump_report_page(self, page, title, page_type, my_outdir_base, my_outdir_content, progress, report_children=None):
+        """Write a page of a Page Properties export to disk, recording the result in progress"""
+        try:
+            assets = fetch_page_assets(
+                self.site, page.html, page.id, my_outdir_base, my_outdir_content,
+                self.user_name, self.api_token, arg_type=page_type, arg_session=self.session, arg_page=page,
+                arg_downloader=self.downloader,
+                arg_blob_store=self._blob_store(my_outdir_base),
+                arg_report_children=report_children,
+            )
+        except Exception as e:
+            progress.fail("Exporting page", page.id, e)
+            return
+        render_args = self._render_args(page, title, my_outdir_content, page.parent_id, assets, page_type)
+
+        def rendered(result, error):
+            if error is not None:
+                progress.fail("Exporting page", page.id, error)
                 return
-            i = i + 1
-            all_spaces_short.append(
-                {  # append the list of spaces
-                    "space_key": n["key"],
-                    "space_id": n["id"],
-                    "space_name": n["name"],
-                    "homepage_id": n["homepageId"],
-                    "spaceDescription": n["description"],
-                }
+            url, dumped_file_path = result
+            progress.advance("Exporting page", title, (page.id, url, dumped_file_path, page.space_key, self.site))
+
+        self._render(render_args, rendered)
+
+    def _export_report_child(self, page_id, children, my_outdir_base, my_outdir_content, progress):
+        if self.interrupted:
+            return
+        try:
+            page = children.get(page_id) or get_page(
+                self.site, page_id, self.user_name, self.api_token, self.session
             )
-            if (
-                (n["key"] == space_key)
-                or n["key"] == str.upper(space_key)
-                or n["key"] == str.lower(space_key)
-            ):
-                logging.info("Found space: " + n["key"])
-                space_id = n["id"]
-                space_name = n["name"]
-                current_parent = n["homepageId"]
-        my_outdir_content = os.path.join(
-            self.outdir, f"{space_id}-{space_name}")
-        os.makedirs(my_outdir_content, exist_ok=True)
-        if self.sphinx is False:
-            my_outdir_base = my_outdir_content
+        except Exception as e:
+            progress.fail("Exporting page", page_id, e)
+            return
+        self._dump_report_page(page, page.title, "reportchild", my_outdir_base, my_outdir_content, progress)
 
-        # print("my_outdir_base: " + my_outdir_base)
-        # print("my_outdir_content: " + my_outdir_content)
+    def export_page_properties(self, page_id, **kwargs):
+        """Export a Page Properties report page and the pages it lists
 
-        if (
-            space_key == "" or space_key is None
-        ):  # if the supplied space key can't be found
-            logging.error("Could not find Space Key in this site")
-        else:
-            space_title = get_space_title(
-                self.site, space_id, self.user_name, self.api_token
+        The child pages are fetched together, a batch of them per CQL search
+        request, and exported on the worker pool. The report is written last,
+        linking to the children by the names found in that same batch.
+        """
+        start_time = time.time()
+        # Update attributes with kwargs if provided
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        logging.info(f"Exporting a Page Properties page with all its children (Sphinx set to {self.sphinx})")
+        self._start_transform_pool()  # before the read-ahead threads fetching the children
+        try:
+            report_page = get_page(self.site, page_id, self.user_name, self.api_token, self.session)
+            report_title = report_page.title.replace("/", "-").replace(",", "").replace("&", "And").replace(":", "-")
+            my_outdir_content = os.path.join(self.outdir, f"{page_id}-{report_title}")
+            os.makedirs(my_outdir_content, exist_ok=True)
+            my_outdir_base = self.outdir if self.sphinx else my_outdir_content
+            mk_outdirs(my_outdir_base)  # create the shared folders once, before the workers race for them
+
+            child_ids = list(dict.fromkeys(report_child_ids(report_page.html)))  # a page listed twice is exported once
+            logging.info(f"Getting the {len(child_ids)} Page Properties children")
+            children = get_pages_by_id(
+                self.site, child_ids, self.user_name, self.api_token, self.session, arg_read_ahead=self.read_ahead
             )
-            #
-            # get list of pages from space
-            #
-            all_pages_full = get_pages_from_space(
-                self.site, space_id, self.user_name, self.api_token
+            report_children = get_page_properties_children(
+                self.site, report_page.html, my_outdir_content, self.user_name, self.api_token, self.session,
+                arg_titles={child_id: child.title for child_id, child in children.items()},
+            )[1]
+        except BaseException:
+            self._stop_transform_pool()
+            raise
+
+        logging.info(f"Starting export with {self.workers} workers")
+        progress = ExportProgress(len(child_ids) + 1, self.log_interval)
+        try:
+            self._run_concurrently(
+                child_ids,
+                lambda child_id: self._export_report_child(child_id, children, my_outdir_base, my_outdir_content, progress),
+                progress,
             )
-            all_pages_short = []
-            i = 0
-            for n in all_pages_full:
-                if self.interrupted:
-                    logging.warning("Interrupting export of space")
-                    return
-                i = i + 1
-                all_pages_short.append(
-                    {
-                        "page_id": n["id"],
-                        "pageTitle": n["title"],
-                        "parentId": n["parentId"],
-                        "space_id": n["spaceId"],
-                    }
+            if not self.interrupted:
+                self._dump_report_page(
+                    report_page, report_title, "report", my_outdir_base, my_outdir_content, progress, report_children
                 )
-            # put it all together
-            logging.info(f"{len(all_pages_short)} pages to export")
-            
-            page_counter = 0
-            total_pages = len(all_pages_short)
-            dumped_file_paths = {}
-            # Filter pages based on date criteria if start_date or end_date are provided
-            start_time = time.time()
-            last_log_time = start_time
-            page_counter = 0
-            filtered_pages_count = 0
-
-            def filter_page(p):
-                global last_log_time
-                global filtered_pages_count
-                global page_counter
-                global interrupted
-                if interrupted or self.interrupted:
-                    return None
-                now = time.time()
-                if now - last_log_time >= self.log_interval:
-                    estimated_time_remaining = (now - start_time) / (page_counter + 1) * (total_pages - page_counter - 1)
-                    logging.info(f"Processing page {page_counter}/{total_pages} for {filtered_pages_count} filtered pages so far. Time elapsed: {format_timespan(now - start_time)}, estimated time remaining: {format_timespan(estimated_time_remaining)}.")
-                    last_log_time = now
-
-                last_modified_str = get_page_last_modified(
-                    self.site, p["page_id"], self.user_name, self.api_token
-                )
-                last_modified = parser.isoparse(last_modified_str).replace(tzinfo=timezone.utc)
-                
-                page_counter += 1
-                if (not self.start_date or last_modified >= self.start_date) and (not self.end_date or last_modified <= self.end_date):
-                    filtered_pages_count += 1
-                    return p
-                return None
+        finally:
+            self._stop_transform_pool()
+            self.pandoc.close()
+            self.downloader.close()
+            self._close_blob_stores()
+            self._flush_response_cache()
+        if self.interrupted:
+            logging.warning(f"Interrupted export of Page Properties after {progress.done}/{progress.total} pages")
+        else:
+            logging.info(f"{progress.done} pages went through the export")
+        self._log_failures(progress)
+        elapsed_time = time.time() - start_time
+        logging.info(f"Done! Exporting Page Properties took {format_timespan(elapsed_time)}.")
+        self._log_rate_limit_metrics()
+        return progress.results
 
-            if self.start_date or self.end_date:
-                with ThreadPoolExecutor(max_workers=self.workers) as executor:
-                    results = list(executor.map(filter_page, all_pages_short))
-                filtered_pages = [page for page in results if page is not None]
-                total_pages = len(filtered_pages)
-                logging.info(f"{total_pages} pages meet the date criteria and will be processed.")
-            else:
-                filtered_pages = all_pages_short
-                logging.info("No date filtering applied.")
+    def _search_label(self, label):
+        """Yield the pages with a label, in every space, as the CQL search responses arrive"""
+        cql = self._date_range_cql(f'label="{label}" and type=page')
+        logging.info(f"Searching pages with CQL: {cql}")
+        results = search_content_by_cql(
+            self.site, cql, self.user_name, self.api_token, self.session,
+            arg_expand=PAGE_EXPAND if self.bulk else "ancestors,version,space", arg_limit=250, arg_read_ahead=self.read_ahead
+        )
+        return (self._short_page_from_content(n) for n in results)
+
+    def export_by_label(self, label, **kwargs):
+        """Export the pages with a label, from all the spaces, into a folder named after the label
+
+        The search results are streamed across pages of the CQL search, and
+        the pages go through the same worker pipeline as a space export while
+        the search is still running. The async backend isn't used here.
+        """
+        start_time = time.time()
+        # Update attributes with kwargs if provided
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        logging.info(f"Exporting all pages with the label {label} (Sphinx set to {self.sphinx})")
+        my_outdir_content = os.path.join(self.outdir, label)
+        os.makedirs(my_outdir_content, exist_ok=True)
+        my_outdir_base = self.outdir if self.sphinx else my_outdir_content
+        self._start_transform_pool()
+        self._open_archive(keep_previous=True)
+        self._open_journal(f"label-{label}")
+
+        logging.info(f"Starting export with {self.workers} workers")
+        mk_outdirs(my_outdir_base)  # create the shared folders once, before the workers race for them
+        progress = ExportProgress(0, self.log_interval)
+        pages = self._select_pages_to_export(self._search_label(label), None)
+        try:
+            self._run_concurrently(
+                progress.track(pages),
+                lambda p: self._export_space_page(p, my_outdir_base, my_outdir_content, progress),
+                progress,
+                lambda p: p["page_id"],
+            )
+        finally:
+            self._stop_transform_pool()
+            self.pandoc.close()
+            self.downloader.close()
+            self._close_blob_stores()
+            self._flush_response_cache()
+            self._close_archive()
+            self._close_journal()
+            self._write_shard_manifest()
+        if self.interrupted:
+            logging.warning(f"Interrupted export of label after {progress.done}/{progress.total} pages")
+        else:
+            logging.info(f"{progress.done} pages went through the export")
+        self._log_failures(progress)
+        elapsed_time = time.time() - start_time
+        logging.info(f"Done! Exporting label took {format_timespan(elapsed_time)}.")
+        self._log_rate_limit_metrics()
+        return progress.results
+
+    @staticmethod
+    def _round_robin(iterators):
+        """Yield one item of each iterator in turn, dropping the iterators as they run out"""
+        iterators = deque(iterators)
+        while iterators:
+            iterator = iterators.popleft()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                continue
+            iterators.append(iterator)
+            yield item
+
+    def _site_space_pages(self, space, outdirs):
+        """Yield the pages of one space of a site export, with the output folders of the space
+
+        A space whose listing fails is logged and left out, the other spaces
+        go on. The listing is read without read-ahead, as all the spaces are
+        listed at once.
+        """
+        space_id, space_name, space_key = space
+        try:
+            for p in self._select_pages_to_export(self._list_pages(space_key, space_id, read_ahead=0), space_id):
+                yield p, outdirs
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logging.error(f"Error listing the pages of space {space_key}: {e}")
 
-            logging.info(f"Starting export of {len(filtered_pages)} pages")
-            page_counter = 0
-            for p in filtered_pages:
+    def export_site(self, **kwargs):
+        """Export every space of the site in one run
+
+        The spaces are listed once, then the pages of all the spaces go
+        through the same worker pool: the listings are read in turn, one page
+        of each space at a time, so a large space doesn't hold back the small
+        ones and workers never wait for a space to finish. The workers and
+        max_rate limits apply to the whole site. The async backend isn't used here.
+        """
+        start_time = time.time()
+        # Update attributes with kwargs if provided
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        logging.info(f"Exporting all the spaces of the site (Sphinx set to {self.sphinx})")
+        self._start_transform_pool()  # before the read-ahead threads of the space listing
+        try:
+            spaces = [(n["id"], n["name"], n["key"]) for n in get_spaces_all(
+                self.site, self.user_name, self.api_token, self.session, self.read_ahead
+            )]
+            logging.info(f"Found {len(spaces)} spaces")
+            space_pages = []
+            for space in spaces:
+                my_outdir_base, my_outdir_content = self._space_outdirs(space[0], space[1])
+                mk_outdirs(my_outdir_base)  # create the shared folders once, before the workers race for them
+                space_pages.append(self._site_space_pages(space, (my_outdir_base, my_outdir_content)))
+        except BaseException:
+            self._stop_transform_pool()
+            raise
+        self._open_archive()
+        self._open_journal("site")
+
+        logging.info(f"Starting export with {self.workers} workers")
+        progress = ExportProgress(0, self.log_interval)
+        try:
+            self._run_concurrently(
+                progress.track(self._round_robin(space_pages)),
+                lambda item: self._export_space_page(item[0], *item[1], progress),
+                progress,
+                lambda item: item[0]["page_id"],
+            )
+        finally:
+            self._stop_transform_pool()
+            self.pandoc.close()
+            self.downloader.close()
+            self._close_blob_stores()
+            self._flush_response_cache()
+            self._close_archive()
+            self._close_journal()
+            self._write_shard_manifest()
+        if self.interrupted:
+            logging.warning(f"Interrupted export of site after {progress.done}/{progress.total} pages")
+        else:
+            logging.info(f"{progress.done} pages of {len(spaces)} spaces went through the export")
+        self._log_failures(progress)
+        elapsed_time = time.time() - start_time
+        logging.info(f"Done! Exporting site took {format_timespan(elapsed_time)}.")
+        self._log_rate_limit_metrics()
+        return progress.results
+
+    def rerender(self, **kwargs):
+        """Render the pages of the page archive again, with the current output options
+
+        Reads the archive written by earlier space exports into the output
+        folder and runs render_page for each page on transform_workers
+        processes, or one per CPU, without any request to the site. The
+        downloaded files are used as they are, so a page exported with another
+        sphinx setting can't be rendered and counts as failed.
+        """
+        start_time = time.time()
+        # Update attributes with kwargs if provided
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        if existing_archive_path(self.outdir) is None:
+            logging.error(f"No page archive in {self.outdir}, export the space first")
+            return {}
+        logging.info(f"Rendering the archived pages again (Sphinx set to {self.sphinx})")
+        mk_outdirs(self.outdir)  # the stylesheet, in case only the archive was kept
+        self._start_transform_pool(self.transform_workers or os.cpu_count())
+        progress = ExportProgress(0, self.log_interval)
+        try:
+            for record in progress.track(read_page_archive(self.outdir)):
                 if self.interrupted:
-                    logging.warning("Interrupting export of space")
-                    return
-                try:
-                    page_counter += 1
-                    now = time.time()
-                    
-                    if now - last_log_time >= self.log_interval:
-                        estimated_time_remaining = (
-                            now - start_time) / page_counter * (total_pages - page_counter)
-                        logging.info(f"Exporting page {page_counter}/{total_pages} - Estimated time remaining: {format_timespan(estimated_time_remaining)}")
-                        last_log_time = now
-
-                    my_body_export_view = get_body_export_view(
-                        self.site, p["page_id"], self.user_name, self.api_token
-                    ).json()
-                    my_body_export_view_html = my_body_export_view["body"]["export_view"]["value"]
-                    my_body_export_view_name = p["pageTitle"]
-                    my_body_export_view_title = (
-                        p["pageTitle"]
-                        .replace("/", "-")
-                        .replace(",", "")
-                        .replace("&", "And")
-                        .replace(" ", "_")
-                        # added .replace(" ","_") so that filenames have _ as a separator
-                    )
-                    logging.debug(f"Getting page #{page_counter}/{len(all_pages_short)}, {my_body_export_view_title}, {p['page_id']}")
-                    my_body_export_view_labels = get_page_labels(
-                        self.site, p["page_id"], self.user_name, self.api_token
-                    )
-                    # my_body_export_view_labels = ",".join(myModules.get_page_labels(atlassian_site,p['page_id'],user_name,api_token))
-                    my_page_url = f"{my_body_export_view['_links']['base']}"
-
-                    logging.debug(f"dump_html arg sphinx_compatible = {self.sphinx}")
-                    url, dumped_file_path = dump_html(
-                        self.site,
-                        my_body_export_view_html,
-                        my_body_export_view_title,
-                        p["page_id"],
-                        my_outdir_base,
-                        my_outdir_content,
-                        my_body_export_view_labels,
-                        p["parentId"],
-                        self.user_name,
-                        self.api_token,
-                        self.sphinx,
-                        self.tags,
-                        arg_html_output=self.html,
-                        arg_rst_output=self.rst,
-                    )
-                    dumped_file_paths[my_body_export_view_title] = (p["page_id"], url, dumped_file_path, self.space, self.site)
-                except Exception as e:
-                    logging.error(f"Error exporting page {p['page_id']}: {e}")
-                    continue
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        logging.info(f"Done! Exporting space took {format_timespan(elapsed_time)}.")
-        return dumped_file_paths
+                    break
+                self._rerender_page(record, progress)
+        finally:
+            self._stop_transform_pool()
+        if self.interrupted:
+            logging.warning(f"Interrupted rendering after {progress.done}/{progress.total} pages")
+        else:
+            logging.info(f"{progress.done} pages went through the rendering")
+        self._log_failures(progress)
+        elapsed_time = time.time() - start_time
+        logging.info(f"Done! Rendering took {format_timespan(elapsed_time)}.")
+        return progress.results
+
+    @staticmethod
+    def _archived_sphinx(record, outdir_content):
+        """Whether an archived page was exported with sphinx, from the record or, for older archives, its folders"""
+        if "sphinx" in record:
+            return record["sphinx"]
+        return not os.path.isdir(set_dirs(outdir_content)[0])
+
+    def _rerender_page(self, record, progress):
+        page = PageRecord(**record["page"])
+        assets = PageAssets(**record["assets"])
+        outdir_content = os.path.join(self.outdir, record["outdir_content"])
+        exported_sphinx = self._archived_sphinx(record, outdir_content)
+        if exported_sphinx != self.sphinx:
+            # the links would point to _images and _static folders the files aren't in
+            progress.fail("Rendering page", page.id, (
+                f"it was exported {'with' if exported_sphinx else 'without'} --sphinx, "
+                f"render it again {'with' if exported_sphinx else 'without'} --sphinx too"
+            ))
+            return
+        os.makedirs(outdir_content, exist_ok=True)
+        render_args = self._render_args(page, record["title"], outdir_content, record["parent_id"], assets)
+
+        def rendered(result, error):
+            if error is not None:
+                progress.fail("Rendering page", page.id, error)
+                return
+            url, dumped_file_path = result
+            progress.advance("Rendering page", record["title"], (page.id, url, dumped_file_path, page.space_key, self.site))
+
+        self._render(render_args, rendered)
@@ -0,0 +1,101 @@
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+"""
+Concurrent downloads of the files a page shows
+
+fetch_page_assets first collects the attachments, embedded images and
+emoticons of a page, then hands them all to an AssetDownloader, which
+downloads them on a thread pool shared by the whole export.
+
+At most `per_host` downloads run against the same host at any time,
+whichever page they are for, so external image hosts aren't flooded when
+many pages embed their images. Downloads over the limit wait in a queue
+for their host instead of holding a thread, so one slow host doesn't hold
+up the others. The Confluence site itself is left to the rate limiter of
+the session.
+"""
+
+
+class AssetDownloader:
+    def __init__(self, max_workers=8, per_host=4, unlimited_hosts=()):
+        self.max_workers = max_workers
+        self.executor = None        # started with the first download, and again after close()
+        self.per_host = per_host
+        self.unlimited_hosts = set(unlimited_hosts)
+        self.running = collections.Counter()    # downloads running, by host
+        self.waiting = {}                       # downloads queued, by host
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, url, download_fn, *args):
+        """Run download_fn(url, *args) on the pool, once its host has a free slot
+
+        Returns:
+            Future of the download
+        """
+        future = Future()
+        host = urlparse(url).hostname
+        if host in self.unlimited_hosts:
+            self._start(None, future, url, download_fn, args)
+            return future
+        with self.lock:
+            if self.running[host] >= self.per_host:
+                self.waiting.setdefault(host, collections.deque()).append((future, url, download_fn, args))
+                return future
+            self.running[host] += 1
+        self._start(host, future, url, download_fn, args)
+        return future
+
+    def _start(self, host, future, url, download_fn, args):
+        if not future.set_running_or_notify_cancel():
+            self._finished(host)
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            executor = self.executor
+        executor.submit(self._run, host, future, url, download_fn, args)
+
+    def _run(self, host, future, url, download_fn, args):
+        try:
+            future.set_result(download_fn(url, *args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._finished(host)
+
+    def _finished(self, host):
+        """Free the slot of host, or hand it to the next download queued for it"""
+        if host is None:
+            return
+        with self.lock:
+            waiting = self.waiting.get(host)
+            if not waiting:
+                self.running[host] -= 1
+                return
+            next_download = waiting.popleft()
+        self._start(host, *next_download)
+
+    def download_all(self, downloads, download_fn):
+        """Run download_fn(url, *args) for every (url, args) of downloads and wait for them
+
+        Returns:
+            list with, for each download in order, None or the exception it raised
+        """
+        futures = [self.submit(url, download_fn, *args) for url, args in downloads]
+        return [future.exception() for future in futures]
+
+    def close(self):
+        """Stop the download threads, once the running downloads are done"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
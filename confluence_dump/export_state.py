@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os.path
+import sqlite3
+import threading
+import time
+from confluence_dump.myModules import attachment_file_name
+
+"""
+Local manifest of what an export has written, used for incremental runs
+
+For every exported page it keeps the page version, last-modified time and
+output files, and for every attachment its local path and SHA-256. The next
+run compares the versions from the space listing with the manifest and only
+exports the pages that changed; pages that are no longer in the space are
+flagged, or removed together with their output files.
+"""
+
+STATE_FILE_NAME = ".confluence_dump_state.sqlite"
+
+
+def file_sha256(arg_file_path):
+    """SHA-256 of a file, read in chunks"""
+    sha = hashlib.sha256()
+    with open(arg_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ExportState:
+    def __init__(self, outdir):
+        os.makedirs(outdir, exist_ok=True)
+        self.path = os.path.join(outdir, STATE_FILE_NAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                page_id TEXT PRIMARY KEY,
+                space_id TEXT,
+                version INTEGER,
+                last_modified TEXT,
+                title TEXT,
+                output_paths TEXT,
+                exported_at REAL,
+                deleted INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS attachments (
+                attachment_id TEXT PRIMARY KEY,
+                page_id TEXT,
+                file_path TEXT,
+                sha256 TEXT,
+                version INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS pages_space ON pages (space_id);
+        """)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def is_current(self, page_id, version):
+        """Check whether a page was exported at this version and its output files are still there"""
+        if version is None:
+            return False
+        with self.lock:
+            row = self.db.execute(
+                "SELECT version, output_paths FROM pages WHERE page_id = ? AND deleted = 0", (str(page_id),)
+            ).fetchone()
+        if row is None or row[0] != version:
+            return False
+        return all(os.path.exists(p) for p in json.loads(row[1]))
+
+    def record_page(self, page, space_id, output_paths, attachments_dir, renamed=None):
+        """Remember an exported page, its output files and the hashes of its attachments
+
+        Args:
+            page: PageRecord of the exported page
+            space_id: ID of the space the page was exported from
+            output_paths: Files written for the page
+            attachments_dir: Folder the attachments were saved to
+            renamed: Attachments linked under another name, as in PageAssets.renamed (optional)
+        """
+        renamed = renamed or {}
+        attachment_rows = []
+        for attachment in page.attachments:
+            name = attachment_file_name(attachment)
+            file_path = os.path.join(attachments_dir, renamed.get(name, name))
+            if os.path.exists(file_path):
+                attachment_rows.append((
+                    str(attachment['id']), page.id, file_path, file_sha256(file_path),
+                    attachment.get('version', {}).get('number'),
+                ))
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (page.id, str(space_id), page.version, page.last_modified, page.title, json.dumps(output_paths), time.time()),
+            )
+            self.db.executemany("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?)", attachment_rows)
+            self.db.commit()
+
+    def missing_pages(self, space_id, current_page_ids):
+        """Pages exported from a space before that are not in it anymore"""
+        current_page_ids = {str(i) for i in current_page_ids}
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT page_id, output_paths FROM pages WHERE space_id = ? AND deleted = 0", (str(space_id),)
+            ).fetchall()
+        return [(page_id, json.loads(paths)) for page_id, paths in rows if page_id not in current_page_ids]
+
+    def mark_deleted(self, page_id, remove_files=False):
+        """Flag a page as deleted in Confluence, optionally removing its output files"""
+        with self.lock:
+            row = self.db.execute("SELECT output_paths FROM pages WHERE page_id = ?", (str(page_id),)).fetchone()
+            if remove_files and row is not None:
+                for file_path in json.loads(row[0]):
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                self.db.execute("DELETE FROM pages WHERE page_id = ?", (str(page_id),))
+                self.db.execute("DELETE FROM attachments WHERE page_id = ?", (str(page_id),))
+            else:
+                self.db.execute("UPDATE pages SET deleted = 1 WHERE page_id = ?", (str(page_id),))
+            self.db.commit()
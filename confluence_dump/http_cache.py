@@ -0,0 +1,124 @@
+import json
+import os.path
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+"""
+On-disk cache of the API responses of an export
+
+The JSON responses of the site (page bodies, labels, attachment metadata,
+space and page listings) are kept in an SQLite file under the output
+folder. When an export runs again, each request is sent with the ETag and
+Last-Modified of the cached response, and a 304 answer is served from the
+cache. Responses without validators are fetched again, so an online run
+never uses stale data.
+
+The cache is kept under `max_size` bytes by evicting the least recently
+used responses. The times a response was used are kept in memory and
+written with the next response put in the cache, or when it is closed, so
+a cache hit doesn't write to the file. In offline mode no request leaves
+the machine: responses are replayed from the cache, and requests missing
+from it fail.
+"""
+
+CACHE_DIR_NAME = ".confluence_dump_cache"
+CACHE_FILE_NAME = "responses.sqlite"
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+@dataclass
+class CachedResponse:
+    headers: dict
+    body: bytes
+
+
+class ResponseCache:
+    def __init__(self, outdir, max_size=DEFAULT_MAX_SIZE, offline=False):
+        self.root = os.path.join(outdir, CACHE_DIR_NAME)
+        os.makedirs(self.root, exist_ok=True)
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.last_used = {}     # URLs served since the last write, with when
+        self.db = sqlite3.connect(os.path.join(self.root, CACHE_FILE_NAME), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")    # a crash can lose the last responses, not corrupt the file
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                headers TEXT,
+                body BLOB,
+                size INTEGER,
+                last_used REAL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+        """)
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def flush(self):
+        """Write the times the responses were used to the file"""
+        with self.lock:
+            self._write_last_used()
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+    def _write_last_used(self):
+        """Write the times the responses were used since the last write, with the lock held"""
+        if self.last_used:
+            self.db.executemany(
+                "UPDATE responses SET last_used = ? WHERE url = ?",
+                [(used, url) for url, used in self.last_used.items()],
+            )
+            self.last_used.clear()
+
+    def get(self, url):
+        """Cached response of a URL, or None"""
+        with self.lock:
+            row = self.db.execute("SELECT headers, body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            self.last_used[url] = time.time()
+        return CachedResponse(json.loads(row[0]), row[1])
+
+    @staticmethod
+    def validators(cached):
+        """Request headers asking the server to answer 304 if the cached response is still current"""
+        headers = {}
+        if cached is not None:
+            if 'ETag' in cached.headers:
+                headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        return headers
+
+    def put(self, url, headers, body):
+        """Cache a 200 response, evicting the least recently used ones beyond max_size"""
+        kept_headers = {name: headers[name] for name in KEPT_HEADERS if name in headers}
+        with self.lock:
+            self._write_last_used()
+            previous = self.db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(kept_headers), body, len(body), time.time()),
+            )
+            self.size += len(body) - (previous[0] if previous else 0)
+            while self.size > self.max_size:
+                oldest = self.db.execute(
+                    "SELECT url, size FROM responses ORDER BY last_used LIMIT 100"
+                ).fetchall()
+                if not oldest:
+                    break
+                for oldest_url, size in oldest:
+                    self.db.execute("DELETE FROM responses WHERE url = ?", (oldest_url,))
+                    self.size -= size
+                    if self.size <= self.max_size:
+                        break
+            self.db.commit()
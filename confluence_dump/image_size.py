@@ -0,0 +1,154 @@
+import hashlib
+import os
+import re
+import struct
+import threading
+from PIL import Image
+
+"""
+Image dimensions read from the file headers
+
+dump_html only needs the width of each embedded image. image_size reads
+it from the first bytes of PNG, GIF, JPEG and WebP files and from the root
+element of SVG files, without decoding anything; other formats go through
+Pillow, which also stops at the header.
+
+Sizes are cached by SHA-256 of the content, so an image that appears on
+many pages (under one or several file names) is sniffed once, and by
+path, size and modification time, so an unchanged file isn't hashed again.
+"""
+
+HEADER_SIZE = 64 * 1024     # enough for the JPEG markers before the frame header, and for an SVG root element
+SVG_LENGTH = re.compile(r'^\s*([0-9.]+)\s*(px)?\s*$')
+
+
+def _png_size(data):
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        return struct.unpack('>II', data[16:24])
+    return None
+
+
+def _gif_size(data):
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', data[6:10])
+    return None
+
+
+def _jpeg_size(data):
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:      # fill byte
+            i += 1
+            continue
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:   # markers without a length
+            i += 2
+            continue
+        segment_length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        # start of frame markers, except DHT (c4), JPG (c8) and DAC (cc)
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + segment_length
+    return None
+
+
+def _webp_size(data):
+    if data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L' and data[20:21] == b'\x2f':
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+    return None
+
+
+def _svg_size(data):
+    text = data.decode('utf-8', errors='ignore')
+    root = re.search(r'<svg\b[^>]*>', text)
+    if root is None:
+        return None
+    attributes = dict(re.findall(r'([\w:-]+)\s*=\s*["\']([^"\']*)["\']', root.group(0)))
+    width = SVG_LENGTH.match(attributes.get('width', ''))
+    height = SVG_LENGTH.match(attributes.get('height', ''))
+    if width and height:
+        return round(float(width.group(1))), round(float(height.group(1)))
+    view_box = attributes.get('viewBox', '').replace(',', ' ').split()
+    if len(view_box) == 4:
+        return round(float(view_box[2])), round(float(view_box[3]))
+    return None
+
+
+def sniff_image_size(data):
+    """(width, height) from the first bytes of an image, or None if the format isn't recognized"""
+    for sniff in (_png_size, _jpeg_size, _gif_size, _webp_size):
+        size = sniff(data)
+        if size is not None:
+            return size
+    if b'<svg' in data:
+        try:
+            return _svg_size(data)
+        except ValueError:
+            return None
+    return None
+
+
+class ImageSizeCache:
+    def __init__(self):
+        self.by_hash = {}
+        self.by_file = {}
+        self.lock = threading.Lock()
+
+    def size_of_file(self, file_path):
+        """(width, height) of an image file
+
+        Raises:
+            ValueError: The file isn't an image whose size can be read
+        """
+        stat = os.stat(file_path)
+        file_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if file_key in self.by_file:
+                return self.by_file[file_key]
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            sha.update(header)
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        content_hash = sha.hexdigest()
+        with self.lock:
+            size = self.by_hash.get(content_hash)
+        if size is None:
+            size = sniff_image_size(header)
+            if size is None:
+                size = self._size_with_pillow(file_path)
+        with self.lock:
+            self.by_hash[content_hash] = size
+            self.by_file[file_key] = size
+        return size
+
+    @staticmethod
+    def _size_with_pillow(file_path):
+        try:
+            with Image.open(file_path) as img:
+                return img.size
+        except Exception as e:
+            raise ValueError(f"Can't read the size of image {file_path}: {e}") from e
+
+
+default_cache = ImageSizeCache()
+
+
+def image_size(file_path):
+    """(width, height) of an image file, using the cache shared by the whole export"""
+    return default_cache.size_of_file(file_path)
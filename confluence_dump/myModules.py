@@ -2,12 +2,22 @@ import shutil
 import requests
 import os.path
 import json
-from requests.auth import HTTPBasicAuth
-from bs4 import BeautifulSoup as bs
+from urllib.parse import urlparse, quote
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPBasicAuth
+from bs4 import SoupStrainer
 import sys
-import pypandoc
-from PIL import Image
 import re
+import time
+import queue
+import threading
+from dataclasses import dataclass, field
+from confluence_dump.rate_limit import RETRY_STATUSES, MAX_RETRIES, retry_after_seconds
+from confluence_dump.pandoc_worker import convert_with_pandoc
+from confluence_dump.rewrite import PageRewriter, class_matches, parse_html, serialize_html
+from confluence_dump.image_size import image_size
+from confluence_dump.downloads import AssetDownloader
+from confluence_dump.asset_registry import default_registry as asset_registry
 
 """
 Arguments needed to run these functions centrally:
@@ -61,11 +71,220 @@ def mk_outdirs(arg_outdir="output"):       # setting default to output
     os.makedirs(outdir_attach, exist_ok=True)
     os.makedirs(outdir_emoticons, exist_ok=True)
     os.makedirs(outdir_styles, exist_ok=True)
-    if not os.path.exists(os.path.join(outdir_styles, 'confluence.css')):
-        shutil.copy(os.path.join(script_dir, "styles", "confluence.css"), os.path.join(outdir_styles, "confluence.css"))
+    my_css = f"{my_vars['styles_dir']}confluence.css"
+    if not asset_registry.has(arg_outdir, my_css):
+        if not os.path.exists(os.path.join(outdir_styles, 'confluence.css')):
+            shutil.copy(os.path.join(script_dir, "styles", "confluence.css"), os.path.join(outdir_styles, "confluence.css"))
+        asset_registry.add(arg_outdir, my_css)
     return(outdir_list)
 
-def get_space_title(arg_site,arg_space_id,arg_username,arg_api_token):
+prepared_outdirs = set()        # output folders mk_outdirs already ran for in this process
+prepared_outdirs_lock = threading.Lock()
+
+def prepare_outdirs(arg_outdir="output"):
+    """mk_outdirs, only run the first time an output folder is used by the process"""
+    with prepared_outdirs_lock:
+        if os.path.abspath(arg_outdir) not in prepared_outdirs:
+            mk_outdirs(arg_outdir)
+            prepared_outdirs.add(os.path.abspath(arg_outdir))
+    return(set_dirs(arg_outdir))
+
+class SiteAuth(AuthBase):
+    """Basic auth that is only sent to the Atlassian site itself
+
+    A shared session also downloads external embeds, which must not receive
+    the Confluence credentials.
+    """
+    def __init__(self, arg_site, arg_username, arg_api_token):
+        self.host = f"{arg_site}.atlassian.net"
+        self.basic = HTTPBasicAuth(arg_username, arg_api_token)
+
+    def __call__(self, r):
+        if urlparse(r.url).hostname == self.host:
+            return self.basic(r)
+        return r
+
+def get_session(arg_site,arg_username,arg_api_token,arg_pool_size=10,arg_rate_limiter=None,arg_response_cache=None):
+    """Create the HTTP session shared by all API calls of an export
+
+    Args:
+        arg_site: The site name
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_pool_size: Number of keep-alive connections kept per host
+        arg_rate_limiter: RateLimiter applied to the requests sent to the site (optional)
+        arg_response_cache: ResponseCache the API responses are revalidated against, or replayed from offline (optional)
+
+    Returns:
+        session (requests.Session): Pooled session with the site auth attached
+    """
+    session = requests.Session()
+    session.auth = SiteAuth(arg_site, arg_username, arg_api_token)
+    session.rate_limiter = arg_rate_limiter
+    session.response_cache = arg_response_cache
+    adapter = HTTPAdapter(pool_connections=arg_pool_size, pool_maxsize=arg_pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return(session)
+
+def http_get(arg_url,arg_username=None,arg_api_token=None,arg_session=None,**kwargs):
+    """GET a URL, through the shared session when one is given
+
+    Responses with status 429 or 503 are retried after the Retry-After delay.
+    When the session has a rate limiter for the URL's host, every attempt
+    goes through it and the throttled ones shrink its limits.
+
+    When the session has a response cache, API responses are revalidated
+    against it, or replayed from it in offline mode. Streamed downloads
+    aren't cached, and fail in offline mode.
+
+    Through a session, the credentials are the ones of its SiteAuth, which
+    only sends them to the site; without one, they go with the request.
+    """
+    cache = getattr(arg_session, 'response_cache', None)
+    if cache is not None:
+        if kwargs.get('stream') or 'Range' in (kwargs.get('headers') or {}):
+            if cache.offline:
+                raise requests.ConnectionError(f"Offline, not downloading: {arg_url}")
+        else:
+            return(cached_http_get(arg_url,cache,arg_username,arg_api_token,arg_session,**kwargs))
+    return(http_get_with_retries(arg_url,arg_username,arg_api_token,arg_session,**kwargs))
+
+def cached_http_get(arg_url,arg_cache,arg_username=None,arg_api_token=None,arg_session=None,**kwargs):
+    cached = arg_cache.get(arg_url)
+    if arg_cache.offline:
+        if cached is None:
+            raise requests.ConnectionError(f"Offline, and not in the response cache: {arg_url}")
+        return(response_from_cache(arg_url,cached))
+    kwargs['headers'] = {**(kwargs.get('headers') or {}), **arg_cache.validators(cached)}
+    response = http_get_with_retries(arg_url,arg_username,arg_api_token,arg_session,**kwargs)
+    if response.status_code == 304 and cached is not None:
+        return(response_from_cache(arg_url,cached))
+    if response.status_code == 200:
+        arg_cache.put(arg_url,response.headers,response.content)
+    return(response)
+
+def response_from_cache(arg_url,arg_cached):
+    """A requests.Response for a CachedResponse"""
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = "OK"
+    response.url = arg_url
+    response.headers = requests.structures.CaseInsensitiveDict(arg_cached.headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = arg_cached.body
+    return(response)
+
+def http_get_with_retries(arg_url,arg_username=None,arg_api_token=None,arg_session=None,**kwargs):
+    kwargs.setdefault('timeout', 30)
+    if arg_session is None and arg_username is not None:
+        kwargs.setdefault('auth', (arg_username, arg_api_token))     # a session sends its SiteAuth to the site only
+    http = requests if arg_session is None else arg_session
+    limiter = getattr(arg_session, 'rate_limiter', None)
+    if limiter is not None and urlparse(arg_url).hostname != limiter.host:
+        limiter = None
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = http.get(arg_url, **kwargs)
+        except BaseException:
+            if limiter is not None:
+                limiter.release()
+            raise
+        if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+            if limiter is not None:
+                limiter.release()
+            return(response)
+        retry_after = retry_after_seconds(response.headers.get('Retry-After'), attempt)
+        print(f"Throttled ({response.status_code}), retrying in {retry_after:.1f}s: {arg_url}")
+        response.close()
+        if limiter is not None:
+            limiter.release(throttled=True, retry_after=retry_after)
+        else:
+            time.sleep(retry_after)
+        attempt += 1
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+download_locks = {}             # one lock per file being downloaded, so two pages never write the same .part file
+download_locks_lock = threading.Lock()
+
+def download_file(arg_url,arg_file_path,arg_username=None,arg_api_token=None,arg_session=None,arg_expected_size=None):
+    """Stream a download to disk, only showing the file once it is complete
+
+    The content is written in chunks to "<file>.part", which is renamed to
+    the file name at the end. When a ".part" file is left over from an
+    interrupted download, the rest is requested with an HTTP Range header.
+
+    Args:
+        arg_url: URL to download
+        arg_file_path: Local file to create
+        arg_username: Username for auth (optional)
+        arg_api_token: API token for auth (optional)
+        arg_session: Shared HTTP session (optional)
+        arg_expected_size: Size in bytes from the attachment metadata, checked at the end (optional)
+
+    Raises:
+        requests.HTTPError: The server answered with an error status
+        IOError: The downloaded file doesn't have the expected size; the .part file is kept for a resume
+    """
+    with download_locks_lock:
+        file_lock = download_locks.setdefault(os.path.abspath(arg_file_path), threading.Lock())
+    with file_lock:
+        if os.path.exists(arg_file_path):
+            return      # another page downloaded it meanwhile
+        download_part_file(arg_url,arg_file_path,arg_username,arg_api_token,arg_session,arg_expected_size)
+
+def download_part_file(arg_url,arg_file_path,arg_username=None,arg_api_token=None,arg_session=None,arg_expected_size=None):
+    part_path = f"{arg_file_path}.part"
+    resume_from = part_file_resume_from(part_path,arg_expected_size)
+    headers = part_file_range_headers(resume_from)
+    with http_get(arg_url,arg_username,arg_api_token,arg_session,allow_redirects=True,stream=True,headers=headers) as response:
+        if not part_file_complete(resume_from,arg_expected_size,response.status_code):
+            response.raise_for_status()
+            resumed, arg_expected_size = part_file_response(resume_from,arg_expected_size,response.status_code,response.headers)
+            with open(part_path, 'ab' if resumed else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+    finish_part_file(arg_url,arg_file_path,arg_expected_size)
+
+# The steps of a .part download that don't depend on the HTTP client, shared with the async backend
+
+def part_file_resume_from(arg_part_path,arg_expected_size=None):
+    """Number of bytes of a leftover .part file to resume from, 0 to download from the start"""
+    resume_from = os.path.getsize(arg_part_path) if os.path.exists(arg_part_path) else 0
+    if arg_expected_size is not None and resume_from > arg_expected_size:
+        resume_from = 0
+    return(resume_from)
+
+def part_file_range_headers(arg_resume_from):
+    return({'Range': f"bytes={arg_resume_from}-"} if arg_resume_from else {})
+
+def part_file_complete(arg_resume_from,arg_expected_size,arg_status):
+    """Whether the server refused the Range (416) because the .part file was complete, only the rename was missing"""
+    return(bool(arg_resume_from) and arg_status == 416 and arg_resume_from == arg_expected_size)
+
+def part_file_response(arg_resume_from,arg_expected_size,arg_status,arg_headers):
+    """Whether a response continues the .part file or starts it over, and the size the file should end up with
+
+    Returns:
+        (resumed, expected size or None if unknown)
+    """
+    resumed = arg_status == 206 and arg_headers.get('Content-Range', '').startswith(f"bytes {arg_resume_from}-")
+    if arg_expected_size is None and 'Content-Length' in arg_headers and 'Content-Encoding' not in arg_headers:
+        arg_expected_size = int(arg_headers['Content-Length']) + (arg_resume_from if resumed else 0)
+    return(resumed,arg_expected_size)
+
+def finish_part_file(arg_url,arg_file_path,arg_expected_size):
+    """Check the size of the .part file and rename it to the file name"""
+    part_path = f"{arg_file_path}.part"
+    size = os.path.getsize(part_path)
+    if arg_expected_size is not None and size != arg_expected_size:
+        raise IOError(f"Downloaded {size} bytes instead of {arg_expected_size}: {arg_url}")
+    os.replace(part_path, arg_file_path)
+
+def get_space_title(arg_site,arg_space_id,arg_username,arg_api_token,arg_session=None):
     """Get Title of a space
 
     Args:
@@ -73,55 +292,164 @@ def get_space_title(arg_site,arg_space_id,arg_username,arg_api_token):
         arg_space_id: ID of the space
         arg_username: Username for auth
         arg_api_token: API token for auth
+        arg_session: Shared HTTP session (optional)
 
     Returns:
         response (string): The title of the space
     """
     server_url = (f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/{arg_space_id}")
 
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30).json()['name']
+    response = http_get(server_url,arg_username,arg_api_token,arg_session).json()['name']
     return(response)
 
-def get_spaces_all(arg_site,arg_username,arg_api_token):
+READ_AHEAD = 2          # listing responses fetched ahead of the consumer by default
+
+def read_ahead(arg_batches,arg_depth=READ_AHEAD):
+    """Iterate a generator of batches in a background thread, up to arg_depth batches ahead
+
+    The thread fetches cursor N+1 while the consumer still works on batch N.
+    At most arg_depth batches wait in memory; when the consumer stops early,
+    the thread stops at the next batch. Errors are raised in the consumer.
+
+    Args:
+        arg_batches: Generator of batches, e.g. one list of results per listing response
+        arg_depth: Number of batches fetched ahead of the consumer, 0 to fetch in the consumer
+
+    Returns:
+        generator of batches
+    """
+    if arg_depth < 1:
+        yield from arg_batches
+        return
+    batches = queue.Queue(maxsize=arg_depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for batch in arg_batches:
+                if not put(batch):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    threading.Thread(target=fetch, daemon=True).start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is done:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+
+def get_paginated_batches(arg_url,arg_username,arg_api_token,arg_session=None):
+    """Yield the results of a cursor-paginated v2 listing, one list per response"""
+    server_url = arg_url
+    while server_url:
+        response = http_get(server_url,arg_username,arg_api_token,arg_session)
+        response.raise_for_status()  # raises exception when not a 2xx response
+        data = response.json()
+        yield data['results']
+        next_link = data['_links'].get('next')
+        server_url = f"{arg_url}&cursor{next_link.split('cursor')[1]}" if next_link else None
+
+def get_paginated_results(arg_url,arg_username,arg_api_token,arg_session=None,arg_read_ahead=READ_AHEAD):
+    """Yield the results of a cursor-paginated v2 listing as each response arrives
+
+    Args:
+        arg_url: URL of the first page of the listing
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_session: Shared HTTP session (optional)
+        arg_read_ahead: Number of responses fetched ahead of the consumer
+
+    Returns:
+        generator of result JSON objects
+    """
+    for batch in read_ahead(get_paginated_batches(arg_url,arg_username,arg_api_token,arg_session),arg_read_ahead):
+        yield from batch
+
+def get_spaces_all(arg_site,arg_username,arg_api_token,arg_session=None,arg_read_ahead=READ_AHEAD):
+    """Yield all spaces of a site, one listing response at a time"""
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/?limit=250"
-    response = requests.get(server_url, auth=(arg_username,arg_api_token),timeout=30)
-    response.raise_for_status()  # raises exception when not a 2xx response
-    space_list = response.json()['results']
-    while 'next' in response.json()['_links'].keys():
-        cursorserver_url = f"{server_url}&cursor{response.json()['_links']['next'].split('cursor')[1]}"
-        response = requests.get(cursorserver_url, auth=(arg_username,arg_api_token),timeout=30)
-        space_list = space_list + response.json()['results']
-    return(space_list)
-
-def get_pages_from_space(arg_site,arg_space_id,arg_username,arg_api_token):
-    page_list = []
+    return(get_paginated_results(server_url,arg_username,arg_api_token,arg_session,arg_read_ahead))
+
+def get_pages_from_space(arg_site,arg_space_id,arg_username,arg_api_token,arg_session=None,arg_read_ahead=READ_AHEAD):
+    """Yield the current pages of a space, one listing response at a time"""
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/{arg_space_id}/pages?status=current&limit=250"
-    response = requests.get(server_url, auth=(arg_username,arg_api_token),timeout=30)
-    page_list = response.json()['results']
-    while 'next' in response.json()['_links'].keys():
-        cursorserver_url = f"{server_url}&cursor{response.json()['_links']['next'].split('cursor')[1]}"
-        response = requests.get(cursorserver_url, auth=(arg_username,arg_api_token),timeout=30)
-        page_list = page_list + response.json()['results']
-    return(page_list)
-
-def get_body_export_view(arg_site,arg_page_id,arg_username,arg_api_token):
+    return(get_paginated_results(server_url,arg_username,arg_api_token,arg_session,arg_read_ahead))
+
+def cql_date(arg_date):
+    """Format a datetime for a CQL date comparison"""
+    return(arg_date.strftime("%Y-%m-%d %H:%M"))
+
+def search_batches_by_cql(arg_server_url,arg_username,arg_api_token,arg_session=None):
+    """Yield the results of a CQL content search, one list per response"""
+    server_url = arg_server_url
+    while server_url:
+        response = http_get(server_url,arg_username,arg_api_token,arg_session)
+        response.raise_for_status()
+        data = response.json()
+        for result in data['results']:
+            # the base URL is only given once per response, page_record_from_json needs it on every result
+            result.setdefault('_links', {}).setdefault('base', data['_links']['base'])
+        yield data['results']
+        next_link = data['_links'].get('next')
+        server_url = f"{data['_links']['base']}{next_link}" if next_link else None
+
+def search_content_by_cql(arg_site,arg_cql,arg_username,arg_api_token,arg_session=None,arg_expand=None,arg_limit=100,arg_read_ahead=READ_AHEAD):
+    """Yield the content matching a CQL query, following the result cursors
+
+    Args:
+        arg_site: The site name
+        arg_cql: The CQL query
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_session: Shared HTTP session (optional)
+        arg_expand: Properties to expand on every result (optional)
+        arg_limit: Results per request
+        arg_read_ahead: Number of responses fetched ahead of the consumer
+
+    Returns:
+        generator of content JSON objects
+    """
+    server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/search?cql={quote(arg_cql)}&limit={arg_limit}"
+    if arg_expand:
+        server_url = f"{server_url}&expand={arg_expand}"
+    for batch in read_ahead(search_batches_by_cql(server_url,arg_username,arg_api_token,arg_session),arg_read_ahead):
+        yield from batch
+
+def get_body_export_view(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=body.export_view"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token))
+    response = http_get(server_url,arg_username,arg_api_token,arg_session)
     return(response)
 
-def get_page_name(arg_site,arg_page_id,arg_username,arg_api_token):
+def get_page_name(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}"
-    r_pagetree = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
+    r_pagetree = http_get(server_url,arg_username,arg_api_token,arg_session)
     return(r_pagetree.json()['id'] + "_" + r_pagetree.json()['title'])
 
-def get_page_parent(arg_site,arg_page_id,arg_username,arg_api_token):
+def get_page_parent(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/pages/{arg_page_id}"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
+    response = http_get(server_url,arg_username,arg_api_token,arg_session)
     return(response.json()['parentId'])
 
-def get_page_last_modified(arg_site,arg_page_id,arg_username,arg_api_token):
+def get_page_last_modified(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=history.lastUpdated"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
+    response = http_get(server_url,arg_username,arg_api_token,arg_session)
     data = response.json()
     # Check if 'lastUpdated' exists and is not empty
     last_updated = data.get('history', {}).get('lastUpdated')
@@ -130,234 +458,555 @@ def get_page_last_modified(arg_site,arg_page_id,arg_username,arg_api_token):
     # Fallback to 'createdDate' if 'lastUpdated' is not available
     return data['history']['createdDate']
 
+PAGE_EXPAND = "body.export_view,history.lastUpdated,ancestors,metadata.labels,children.attachment,version,space"
+
+@dataclass
+class PageRecord:
+    """Everything an export needs to know about a page"""
+    id: str
+    title: str
+    html: str
+    url: str
+    parent_id: str = None
+    labels: str = ""
+    last_modified: str = None
+    version: int = None
+    space_key: str = None
+    attachments: list = field(default_factory=list)
+
+def get_remaining_results(arg_base_url,arg_collection,arg_username,arg_api_token,arg_session=None):
+    """Follow the 'next' links of an expanded collection and return all its results"""
+    results = list(arg_collection.get('results', []))
+    next_link = arg_collection.get('_links', {}).get('next')
+    while next_link:
+        response = http_get(f"{arg_base_url}{next_link}",arg_username,arg_api_token,arg_session)
+        response.raise_for_status()
+        data = response.json()
+        results.extend(data['results'])
+        next_link = data.get('_links', {}).get('next')
+    return(results)
+
+def page_record_from_json(arg_data,arg_username=None,arg_api_token=None,arg_session=None):
+    """Build a PageRecord from a content JSON expanded with PAGE_EXPAND
+
+    Collections that were truncated by the expansion (more than 25 attachments,
+    many labels) are completed with follow-up requests.
+    """
+    base_url = arg_data['_links']['base']
+    history = arg_data.get('history', {})
+    last_updated = history.get('lastUpdated')
+    ancestors = arg_data.get('ancestors') or []
+    labels = arg_data.get('metadata', {}).get('labels', {})
+    attachments = arg_data.get('children', {}).get('attachment', {})
+    return(PageRecord(
+        id=str(arg_data['id']),
+        title=arg_data['title'],
+        html=arg_data['body']['export_view']['value'],
+        url=f"{base_url}{arg_data['_links']['webui']}",
+        parent_id=ancestors[-1]['id'] if ancestors else None,
+        labels=", ".join(l['name'] for l in get_remaining_results(base_url,labels,arg_username,arg_api_token,arg_session)),
+        last_modified=last_updated['when'] if last_updated else history.get('createdDate'),
+        version=arg_data.get('version', {}).get('number'),
+        space_key=arg_data.get('space', {}).get('key'),
+        attachments=get_remaining_results(base_url,attachments,arg_username,arg_api_token,arg_session),
+    ))
+
+def get_pages_by_id(arg_site,arg_page_ids,arg_username,arg_api_token,arg_session=None,arg_batch_size=100,arg_read_ahead=READ_AHEAD):
+    """Get many pages with a CQL search on their IDs, a batch of them per request
+
+    Args:
+        arg_site: The site name
+        arg_page_ids: IDs of the pages
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_session: Shared HTTP session (optional)
+        arg_batch_size: Page IDs per search request
+        arg_read_ahead: Number of responses fetched ahead of the consumer
+
+    Returns:
+        dict of PageRecord by page ID. Pages the search doesn't return (not
+        indexed yet, restricted) are left out, to be fetched with get_page.
+    """
+    pages = {}
+    page_ids = list(dict.fromkeys(str(i) for i in arg_page_ids))
+    for start in range(0, len(page_ids), arg_batch_size):
+        cql = f"id in ({','.join(page_ids[start:start + arg_batch_size])})"
+        for content in search_content_by_cql(arg_site,cql,arg_username,arg_api_token,arg_session,
+                PAGE_EXPAND,arg_batch_size,arg_read_ahead):
+            page = page_record_from_json(content,arg_username,arg_api_token,arg_session)
+            pages[page.id] = page
+    return(pages)
+
+def get_page(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
+    """Get a page with its body, history, ancestors, labels and attachments in one request
+
+    Args:
+        arg_site: The site name
+        arg_page_id: ID of the page
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_session: Shared HTTP session (optional)
+
+    Returns:
+        page (PageRecord): The page record
+    """
+    server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand={PAGE_EXPAND}"
+    response = http_get(server_url,arg_username,arg_api_token,arg_session)
+    response.raise_for_status()
+    page = page_record_from_json(response.json(),arg_username,arg_api_token,arg_session)
+    return(page)
+
+@dataclass
+class AssetDownload:
+    """A file a page shows, to download to the _images folder"""
+    url: str
+    file_path: str
+    kind: str                       # "attachment", "embed" or "emoticon", for the messages
+    expected_size: int = None
+    authenticated: bool = True      # False for external images, which get no Confluence credentials
+    blob_key: str = None            # file id to download into the blob store instead of file_path
+
+def download_asset(arg_url,arg_asset,arg_username=None,arg_api_token=None,arg_session=None,arg_blob_store=None):
+    """Download one AssetDownload, to its file or into the blob store"""
+    if not arg_asset.authenticated:
+        arg_username = arg_api_token = None
+    if arg_asset.blob_key is None:
+        download_file(arg_url,arg_asset.file_path,arg_username,arg_api_token,arg_session,arg_asset.expected_size)
+    else:
+        arg_blob_store.fetch(arg_asset.blob_key,
+            lambda path: download_file(arg_url,path,arg_username,arg_api_token,arg_session,arg_asset.expected_size))
+
+def download_assets(arg_downloads,arg_username=None,arg_api_token=None,arg_session=None,arg_downloader=None,arg_blob_store=None):
+    """Download files concurrently, at most a few at a time from each external host
+
+    Args:
+        arg_downloads: AssetDownload of each file
+        arg_username: Username for auth (optional)
+        arg_api_token: API token for auth (optional)
+        arg_session: Shared HTTP session (optional)
+        arg_downloader: AssetDownloader shared by the export; one is started for these files without it (optional)
+        arg_blob_store: BlobStore for the downloads with a blob_key (optional)
+
+    Returns:
+        set of the file paths whose download failed
+    """
+    if not arg_downloads:
+        return(set())
+    if arg_downloader is None:
+        with AssetDownloader() as downloader:
+            return(download_assets(arg_downloads,arg_username,arg_api_token,arg_session,downloader,arg_blob_store))
+    errors = arg_downloader.download_all(
+        [(d.url, (d, arg_username, arg_api_token, arg_session, arg_blob_store)) for d in arg_downloads],
+        download_asset,
+    )
+    failed = set()
+    for d, error in zip(arg_downloads, errors):
+        if error is not None:
+            print(f"WARNING: Skipping {d.kind} file {d.file_path} due to issues. url: {d.url}")
+            failed.add(d.file_path)
+    return(failed)
+
 def remove_illegal_characters(input):
     return re.sub(r'[^\w_\.\- ]+', '_', input)
 
-def get_attachments(arg_site,arg_page_id,arg_outdir_attach,arg_username,arg_api_token):
+def attachment_file_name(arg_attachment):
+    """Local file name of an attachment"""
+    return(remove_illegal_characters(requests.utils.unquote(arg_attachment['title']).replace(" ","_").replace(":","-")))         # I want attachments without spaces
+
+def attachment_file_id(arg_attachment):
+    """Key of the content of an attachment in the blob store: its Confluence file id, or its id and version"""
+    file_id = arg_attachment.get('extensions', {}).get('fileId')
+    if file_id:
+        return(str(file_id))
+    return(f"{arg_attachment['id']}-v{arg_attachment.get('version', {}).get('number')}")
+
+def collect_attachments(arg_site,arg_page_id,arg_outdir_attach,arg_username,arg_api_token,arg_session=None,arg_attachments=None,arg_blob_store=None):
+    """Local file names of the attachments of a page, and the downloads of the ones not on disk yet
+
+    With a blob store, the attachments missing from the store are downloaded
+    into it, and all of them are then linked into the folder by link_attachments.
+
+    Returns:
+        list of file names, list of AssetDownload, list of (file name, file id) to link
+    """
     my_attachments_list = []
-    server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=children.attachment"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
-    my_attachments = response.json()['children']['attachment']['results']
+    my_downloads = []
+    my_blobs = []
+    if arg_attachments is None:
+        server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=children.attachment"
+        response = http_get(server_url,arg_username,arg_api_token,arg_session)
+        arg_attachments = response.json()['children']['attachment']['results']
+    my_attachments = arg_attachments
     for attachment in my_attachments:
-        attachment_title = remove_illegal_characters(requests.utils.unquote(attachment['title']).replace(" ","_").replace(":","-"))         # I want attachments without spaces
+        attachment_title = attachment_file_name(attachment)
         attachment_file_path = os.path.join(arg_outdir_attach,attachment_title)
-        if not os.path.exists(attachment_file_path):
+        attachment_url = f"https://{arg_site}.atlassian.net/wiki{attachment['_links']['download']}"
+        if arg_blob_store is not None:
+            file_id = attachment_file_id(attachment)
+            if arg_blob_store.lookup(file_id) is None:
+                print(f"Downloading: {attachment_title}")
+                my_downloads.append(AssetDownload(attachment_url,attachment_file_path,"attachment",
+                    attachment.get('extensions', {}).get('fileSize'),blob_key=file_id))
+            my_blobs.append((attachment_title,file_id))
+        elif not os.path.exists(attachment_file_path):
             print(f"Downloading: {attachment_title}")
-            try:
-                attachment_url = f"https://{arg_site}.atlassian.net/wiki{attachment['_links']['download']}"
-                request_attachment = requests.get(attachment_url, auth=(arg_username, arg_api_token),allow_redirects=True,timeout=30)
-                open(attachment_file_path, 'wb').write(request_attachment.content)
-            except:
-                print(f"WARNING: Skipping attachment file {attachment_file_path} due to issues. url: {attachment_url}")
+            my_downloads.append(AssetDownload(attachment_url,attachment_file_path,"attachment",
+                attachment.get('extensions', {}).get('fileSize')))
         my_attachments_list.append(attachment_title)
+    return(my_attachments_list,my_downloads,my_blobs)
+
+def link_attachments(arg_blob_store,arg_blobs,arg_outdir_attach):
+    """Link the attachments in the blob store into the folder
+
+    Returns:
+        dict of the file names taken by another file, with the name each attachment got instead
+    """
+    my_renamed = {}
+    for attachment_title, file_id in arg_blobs:
+        sha256 = arg_blob_store.lookup(file_id)
+        if sha256 is None:
+            continue        # its download failed
+        linked_title = arg_blob_store.link(sha256,arg_outdir_attach,attachment_title)
+        if linked_title != attachment_title:
+            my_renamed[attachment_title] = linked_title
+    return(my_renamed)
+
+def get_attachments(arg_site,arg_page_id,arg_outdir_attach,arg_username,arg_api_token,arg_session=None,arg_attachments=None,arg_downloader=None,arg_blob_store=None):
+    my_attachments_list, my_downloads, my_blobs = collect_attachments(arg_site,arg_page_id,arg_outdir_attach,arg_username,arg_api_token,
+        arg_session,arg_attachments,arg_blob_store)
+    download_assets(my_downloads,arg_username,arg_api_token,arg_session,arg_downloader,arg_blob_store)
+    if arg_blob_store is not None:
+        my_renamed = link_attachments(arg_blob_store,my_blobs,arg_outdir_attach)
+        my_attachments_list = [my_renamed.get(title, title) for title in my_attachments_list]
     return(my_attachments_list)
 
 # get page labels
-def get_page_labels(arg_site,arg_page_id,arg_username,arg_api_token):
+def get_page_labels(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
     html_labels = []
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/pages/{arg_page_id}/labels"
-    response = requests.get(server_url, auth=(arg_username,arg_api_token),timeout=30).json()
+    response = http_get(server_url,arg_username,arg_api_token,arg_session).json()
     for l in response['results']:
         html_labels.append(l['name'])
-        print(f"Label: {l['name']}")
     html_labels = ", ".join(html_labels)
-    print(f"Page labels: {html_labels}")
     return(html_labels)
 
-def get_page_properties_children(arg_site,arg_html,arg_outdir,arg_username,arg_api_token):
+def report_child_ids(arg_html):
+    """IDs of the pages listed by a Page Properties report, in report order"""
+    soup = parse_html(arg_html, parse_only=SoupStrainer('td'))
+    return([str(n['data-content-id']) for n in soup.findAll('td',class_="title")])
+
+def report_child_name(arg_page_id,arg_title):
+    """File name (without extension) a Page Properties report links its child page to"""
+    return((f"{arg_page_id}_{arg_title}").rsplit('_',1)[1].replace(":","-").replace(" ","_").replace("%20","_"))          # replace offending characters from file name
+
+def get_page_properties_children(arg_site,arg_html,arg_outdir,arg_username,arg_api_token,arg_session=None,arg_titles=None):
+    """Pages listed by a Page Properties report
+
+    Args:
+        arg_titles: Titles of the children already fetched, by page ID, so their names aren't looked up again (optional)
+
+    Returns:
+        [list of child page IDs, dict of {"ID", "Name"} by child page ID]
+    """
     my_page_properties_children = []
     my_page_properties_children_dict = {}
-    soup = bs(arg_html, "html.parser")
-    my_page_properties_items = soup.findAll('td',class_="title")
     my_page_properties_items_counter = 0
-    for n in my_page_properties_items:
-        my_page_id = str(n['data-content-id'])
-        my_page_properties_children.append(str(n['data-content-id']))
+    for my_page_id in report_child_ids(arg_html):
+        my_page_properties_children.append(my_page_id)
         my_page_properties_items_counter = my_page_properties_items_counter + 1
-        my_page_name = get_page_name(arg_site,int(my_page_id),arg_username,arg_api_token).rsplit('_',1)[1].replace(":","-").replace(" ","_").replace("%20","_")          # replace offending characters from file name
+        if arg_titles is not None and my_page_id in arg_titles:
+            my_page_name = report_child_name(my_page_id,arg_titles[my_page_id])
+        else:
+            my_page_name = report_child_name(*get_page_name(arg_site,int(my_page_id),arg_username,arg_api_token,arg_session).split('_',1))
         my_page_properties_children_dict.update({ my_page_id:{}})
         my_page_properties_children_dict[my_page_id].update({"ID": my_page_id})
         my_page_properties_children_dict[my_page_id].update({"Name": my_page_name})
     print( f"{my_page_properties_items_counter} Page Properties Children Pages")
     return[my_page_properties_children,my_page_properties_children_dict]
 
-def get_editor_version(arg_site,arg_page_id,arg_username,arg_api_token):
+def get_editor_version(arg_site,arg_page_id,arg_username,arg_api_token,arg_session=None):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=metadata.properties.editor"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token))
+    response = http_get(server_url,arg_username,arg_api_token,arg_session)
     return(response)
 
-def dump_html(
+@dataclass
+class PageAssets:
+    """What the network part of dump_html fetched for a page, handed to render_page"""
+    page_url: str
+    attachments: list = field(default_factory=list)         # local file names of the attachments
+    external_embeds: list = field(default_factory=list)     # (local file name, width) of each external image, None if it failed
+    embed_widths: dict = field(default_factory=dict)        # width of each embedded image, by local file name
+    report_children: dict = None                            # page properties children, for a "report" page
+    renamed: dict = field(default_factory=dict)             # attachments saved under another name, as their name was taken
+
+def embed_width(arg_file_path):
+    """Width for an embedded image, at most 600 pixels"""
+    return(min(image_size(arg_file_path)[0], 600))
+
+def external_embed_name(arg_page_id,arg_counter,arg_src):
+    orig_embed_external_name = arg_src.rsplit('/',1)[-1].rsplit('?')[0]      # just the file name
+    return(remove_illegal_characters((f"{arg_page_id}-{arg_counter}-{requests.utils.unquote(orig_embed_external_name)}").replace(" ", "_").replace(":","-")))    # local filename
+
+def embed_name(arg_src):
+    orig_embed_name = arg_src.rsplit('/',1)[-1].rsplit('?')[0]      # online file name
+    return(remove_illegal_characters(requests.utils.unquote(orig_embed_name).replace(" ", "_")))    # local file name
+
+def fetch_page_assets(
     arg_site,
     arg_html,
-    arg_title,
     arg_page_id,
     arg_outdir_base,
     arg_outdir_content,
-    arg_page_labels,
-    arg_page_parent,
     arg_username,
     arg_api_token,
+    arg_type="",
+    arg_session=None,
+    arg_page=None,
+    arg_downloader=None,
+    arg_blob_store=None,
+    arg_report_children=None
+    ):
+    """Network part of dump_html: download everything a page shows
+
+    Collects the attachments, embedded images and emoticons of the page
+    first, then downloads them to the _images folder all at once, and looks
+    up what render_page needs from the API.
+
+    Args:
+        arg_site: Name of the Confluence Site
+        arg_html: HTML Content of the page
+        arg_page_id: Page ID
+        arg_outdir_base: Base output folder
+        arg_outdir_content: Output folder for Content
+        arg_username: Username for authentication
+        arg_api_token: API Token for authentication
+        arg_type: For Page Properties, the type of page: "report", "child" or "common" if it's not for Page Properties
+        arg_session: Shared HTTP session used for the API calls and downloads (optional)
+        arg_page: PageRecord of the page, used instead of fetching the URL and attachments again (optional)
+        arg_downloader: AssetDownloader shared by the export, limiting the downloads per host (optional)
+        arg_blob_store: BlobStore the attachments are downloaded to once and linked from (optional)
+        arg_report_children: For a "report" page, its children as returned by get_page_properties_children, instead of looking them up (optional)
+
+    Returns:
+        PageAssets for render_page
+    """
+    os.makedirs(arg_outdir_content, exist_ok=True)
+    my_outdirs = prepare_outdirs(arg_outdir_base)       # this is for everything for _images and _static
+    # only the images are needed here, the whole page is parsed by render_page
+    soup = parse_html(arg_html, parse_only=SoupStrainer('img'))
+    if arg_page is not None:
+        page_url = arg_page.url
+    else:
+        my_body_export_view = get_body_export_view(arg_site,arg_page_id,arg_username,arg_api_token,arg_session).json()
+        page_url = f"{my_body_export_view['_links']['base']}{my_body_export_view['_links']['webui']}"
+    assets = PageAssets(page_url)
+    assets.attachments, my_downloads, my_blobs = collect_attachments(arg_site,arg_page_id,str(my_outdirs[0]),arg_username,arg_api_token,
+        arg_session,arg_page.attachments if arg_page is not None else None,arg_blob_store)
+    my_linked_attachments = {title for title, file_id in my_blobs}
+    if (arg_type == "report"):
+        assets.report_children = arg_report_children
+        if assets.report_children is None:
+            assets.report_children = get_page_properties_children(arg_site,arg_html,arg_outdir_content,arg_username,arg_api_token,arg_session)[1]      # dict
+    #
+    # dealing with "confluence-embedded-image confluence-external-resource"
+    #
+    my_embeds_externals = []        # local file name of each external image, numbered in page order
+    my_embeds_externals_tags = set()
+    for my_embeds_externals_counter, embed_ext in enumerate(soup.findAll('img',class_="confluence-embedded-image confluence-external-resource")):
+        orig_embed_external_path = embed_ext['src']     # online link to file
+        my_embed_external_name = external_embed_name(arg_page_id,my_embeds_externals_counter,orig_embed_external_path)
+        my_embed_external_path = os.path.join(my_outdirs[0],my_embed_external_name)        # local filename and path
+        if not os.path.exists(my_embed_external_path):
+            my_downloads.append(AssetDownload(orig_embed_external_path,my_embed_external_path,"embed",authenticated=False))
+        my_embeds_externals.append((my_embed_external_name,my_embed_external_path,orig_embed_external_path))
+        my_embeds_externals_tags.add(id(embed_ext))
+    #
+    # dealing with "confluence-embedded-image"
+    #
+    my_embeds = {}      # local file path of each embedded image, by local file name
+    for embed in soup.findAll('img',class_=re.compile("^confluence-embedded-image")):
+        if id(embed) in my_embeds_externals_tags:
+            continue        # render_page will point this one to the external image
+        orig_embed_path = embed['src']        # online link to file
+        my_embed_name = embed_name(orig_embed_path)
+        if my_embed_name in my_embeds:
+            continue
+        my_embed_path = my_outdirs[0] + my_embed_name                            # local file path
+        if my_embed_name not in my_linked_attachments and not os.path.exists(my_embed_path):
+            my_downloads.append(AssetDownload(orig_embed_path,my_embed_path,"embed"))
+        my_embeds[my_embed_name] = (my_embed_path,orig_embed_path)
+    #
+    # dealing with "emoticon" and expands' "grey_arrow_down.png"
+    #
+    # the registry knows the ones any page of this output folder got, in this run or an earlier one
+    my_vars = set_variables()
+    my_emoticons = {}       # emoticons to get, by file path relative to the output folder
+    for emoticon in soup.findAll('img',class_=re.compile("emoticon|expand-control-image")):
+        my_emoticon_title = emoticon['src'].rsplit('/',1)[-1]     # just filename
+        my_emoticon = f"{my_vars['emoticons_dir']}{remove_illegal_characters(my_emoticon_title)}"
+        if my_emoticon not in my_emoticons and not asset_registry.has(arg_outdir_base,my_emoticon):
+            file_path = os.path.join(my_outdirs[1],remove_illegal_characters(my_emoticon_title))
+            my_emoticons[my_emoticon] = file_path
+            if not os.path.exists(file_path):
+                print(f"Getting emoticon: {my_emoticon_title}")
+                my_downloads.append(AssetDownload(emoticon['src'],file_path,"emoticon"))
+    #
+    # every file is known now, download them together
+    #
+    failed = download_assets(my_downloads,arg_username,arg_api_token,arg_session,arg_downloader,arg_blob_store)
+    for my_emoticon, file_path in my_emoticons.items():
+        if file_path not in failed:
+            asset_registry.add(arg_outdir_base,my_emoticon)
+    if arg_blob_store is not None:
+        assets.renamed = link_attachments(arg_blob_store,my_blobs,str(my_outdirs[0]))
+        assets.attachments = [assets.renamed.get(title, title) for title in assets.attachments]
+    for my_embed_external_name, my_embed_external_path, orig_embed_external_path in my_embeds_externals:
+        if my_embed_external_path in failed:
+            assets.external_embeds.append(None)
+            continue
+        try:
+            width = embed_width(my_embed_external_path)
+        except:
+            print(f"WARNING: Skipping embed file {my_embed_external_path} due to issues. url: {orig_embed_external_path}")
+            assets.external_embeds.append(None)
+        else:
+            assets.external_embeds.append((my_embed_external_name, width))
+            assets.embed_widths[my_embed_external_name] = width
+    for my_embed_name, (my_embed_path, orig_embed_path) in my_embeds.items():
+        if my_embed_name in assets.renamed:
+            my_embed_name = assets.renamed[my_embed_name]
+            my_embed_path = my_outdirs[0] + my_embed_name
+        if my_embed_path in failed:
+            continue
+        try:
+            assets.embed_widths[my_embed_name] = embed_width(my_embed_path)
+        except:
+            print(f"WARNING: Skipping embed file {my_embed_path} due to issues. url: {orig_embed_path}")
+    return(assets)
+
+def render_page(
+    arg_html,
+    arg_title,
+    arg_page_id,
+    arg_outdir_content,
+    arg_page_labels,
+    arg_page_parent,
+    arg_assets,
     arg_sphinx_compatible=True,
-    arg_sphinx_tags=False,
     arg_type="",
     arg_html_output=False,
     arg_rst_output=True,
-    arg_show_labels=False
+    arg_show_labels=False,
+    arg_pandoc=None
     ):
-    """Create HTML and RST files
+    """CPU part of dump_html: rewrite the page HTML and write the HTML and RST files
+
+    Makes no network calls, so it can run in another process.
 
     Args:
-        arg_site: Name of the Confluence Site
         arg_html: HTML Content to use for page
         arg_title: Title of the page
         arg_page_id: Page ID
-        arg_outdir_base: Base output folder
         arg_outdir_content: Output folder for Content
         arg_page_labels: Labels of the page
         arg_page_parent: Parent of the page
-        arg_username: Username for authentication
-        arg_api_token: API Token for authentication
+        arg_assets: PageAssets from fetch_page_assets
         arg_sphinx_compatible: Place _static and _images folder at root of output folder
-        arg_sphinx_tags: Add tags to output RST
         arg_type: For Page Properties, the type of page: "report", "child" or "common" if it's not for Page Properties
+        arg_pandoc: PandocPool converting the page to RST, instead of starting pandoc for it (optional)
 
     Returns:
-        HTML, RST and all attachments, embeds and emoticons
+        page_url, path of the RST file (or of the HTML file without RST output)
     """
-    my_vars = set_variables()
-    my_emoticons_list = []
-    my_outdir_content = arg_outdir_content
-    #my_outdir_content = os.path.join(arg_outdir_base,str(arg_page_id) + "-" + str(arg_title))      # this is for html and rst files
-    os.makedirs(my_outdir_content, exist_ok=True)
-    #myOutdir = os.path.join(arg_outdir,str(arg_page_id) + "-" + str(arg_title))
-    my_outdirs = mk_outdirs(arg_outdir_base)        # this is for everything for _images and _static
     my_vars = set_variables()     # create a dict with the 3 folder paths: attach, emoticons, styles
+    my_outdir_content = arg_outdir_content
+    page_url = arg_assets.page_url
 
-    soup = bs(arg_html, "html.parser")
+    if arg_sphinx_compatible == True:
+        attach_dir_relative = f"../{my_vars['attach_dir']}"
+        emoticons_dir_relative = f"../{my_vars['emoticons_dir']}"
+    else:
+        attach_dir_relative = my_vars['attach_dir']
+        emoticons_dir_relative = my_vars['emoticons_dir']
+    html_file_name = (f"{arg_title}.html").replace("/","-").replace(":","-").replace(" ","_")
+    html_file_path = os.path.join(my_outdir_content,html_file_name)
+    my_attachments = arg_assets.attachments
+    external_embeds = iter(arg_assets.external_embeds)
+    counts = {'embeds': 0, 'emoticons': 0}
 
     #
     # removing elements we don't need like
     # * <div class="expand-control"...
     # * <pre class="syntaxhighlighter-pre"...
     #
-    my_undesirables = soup.findAll('div',class_="expand-control")
-    for div in my_undesirables:
-        div.decompose()
-
-    # Find all pre tags
-    pre_tags = soup.find_all('pre')
-    # Remove the class 'syntaxhighlighter-pre' from each pre tag
-    for pre in pre_tags:
+    def remove(element):
+        element.decompose()
+
+    def remove_syntaxhighlighter_class(pre):
         pre['class'] = [c for c in pre.get('class', []) if c != 'syntaxhighlighter-pre']
 
-    # continuing
-    html_file_name = (f"{arg_title}.html").replace("/","-").replace(":","-").replace(" ","_")
-    html_file_path = os.path.join(my_outdir_content,html_file_name)
-    my_attachments = get_attachments(arg_site,arg_page_id,str(my_outdirs[0]),arg_username,arg_api_token)
     #
     # used for pageprops mode
     #
-    #if (arg_type == "child"):
-        #my_report_children_dict = get_page_properties_children(arg_site,arg_html,arg_outdir,arg_username,arg_api_token)[1]              # get list of all page properties children
-        #my_report_children_dict[arg_page_id].update({"Filename": arg_html_file_name})
-    if (arg_type == "report"):
-        my_report_children_dict= get_page_properties_children(arg_site,arg_html,my_outdir_content,arg_username,arg_api_token)[1]      # dict
-        my_page_properties_items = soup.findAll('td',class_="title")       # list
-        for item in my_page_properties_items:
-            id = item['data-content-id']
-            item.a['href'] = (f"{my_report_children_dict[id]['Name']}.html")
+    def link_report_child(item):
+        id = item['data-content-id']
+        item.a['href'] = (f"{arg_assets.report_children[id]['Name']}.html")
+
     #
     # dealing with "confluence-embedded-image confluence-external-resource"
     #
-    my_embeds_externals = soup.findAll('img',class_="confluence-embedded-image confluence-external-resource")
-    my_embeds_externals_counter = 0
-    for embed_ext in my_embeds_externals:
-        orig_embed_external_path = embed_ext['src']     # online link to file
-        orig_embed_external_name = orig_embed_external_path.rsplit('/',1)[-1].rsplit('?')[0]      # just the file name
-        my_embed_external_name = remove_illegal_characters((f"{arg_page_id}-{my_embeds_externals_counter}-{requests.utils.unquote(orig_embed_external_name)}").replace(" ", "_").replace(":","-"))    # local filename
-        my_embed_external_path = os.path.join(my_outdirs[0],my_embed_external_name)        # local filename and path
-        if arg_sphinx_compatible == True:
-            my_embed_external_path_relative = os.path.join(str('../' + my_vars['attach_dir']),my_embed_external_name)
-        else:
-            my_embed_external_path_relative = os.path.join(my_vars['attach_dir'],my_embed_external_name)
-        try:
-            if not os.path.exists(my_embed_external_path):
-                to_download = requests.get(orig_embed_external_path, allow_redirects=True)
-                open(my_embed_external_path,'wb').write(to_download.content)
-            img = Image.open(my_embed_external_path)
-        except:
-            print(f"WARNING: Skipping embed file {my_embed_external_path} due to issues. url: {orig_embed_external_path}")
-        else:
-            if img is not None:
-                if img.width < 600:
-                    embed_ext['width'] = img.width
-                else:
-                    embed_ext['width'] = 600
-                img.close
-                embed_ext['height'] = "auto"
-                embed_ext['onclick'] = f"window.open(\"{my_embed_external_path_relative}\")"
-                embed_ext['src'] = str(my_embed_external_path_relative)
-                embed_ext['data-image-src'] = str(my_embed_external_path_relative)
-                my_embeds_externals_counter = my_embeds_externals_counter + 1
+    def rewrite_external_embed(embed_ext):
+        counts['embeds'] += 1
+        downloaded = next(external_embeds, None)
+        if downloaded is not None:
+            my_embed_external_name, width = downloaded
+            if arg_sphinx_compatible == True:
+                my_embed_external_path_relative = os.path.join(str('../' + my_vars['attach_dir']),my_embed_external_name)
+            else:
+                my_embed_external_path_relative = os.path.join(my_vars['attach_dir'],my_embed_external_name)
+            embed_ext['width'] = width
+            embed_ext['height'] = "auto"
+            embed_ext['onclick'] = f"window.open(\"{my_embed_external_path_relative}\")"
+            embed_ext['src'] = str(my_embed_external_path_relative)
+            embed_ext['data-image-src'] = str(my_embed_external_path_relative)
 
     #
     # dealing with "confluence-embedded-image"
     #
-    my_embeds = soup.findAll('img',class_=re.compile("^confluence-embedded-image"))
-    print(str(len(my_embeds)) + " embedded images.")
-    for embed in my_embeds:
-        orig_embed_path = embed['src']        # online link to file
-        orig_embed_name = orig_embed_path.rsplit('/',1)[-1].rsplit('?')[0]      # online file name
-        my_embed_name = remove_illegal_characters(requests.utils.unquote(orig_embed_name).replace(" ", "_"))    # local file name
-        my_embed_path = my_outdirs[0] + my_embed_name                            # local file path
-        if arg_sphinx_compatible == True:
-            my_embed_path_relative = f"../{my_vars['attach_dir']}{my_embed_name}"
-        else:
-            my_embed_path_relative = f"{my_vars['attach_dir']}{my_embed_name}"
-        img = None
-        try:
-            if not os.path.exists(my_embed_path):
-                to_download = requests.get(orig_embed_path, allow_redirects=True, auth=(arg_username, arg_api_token))
-                open(my_embed_path,'wb').write(to_download.content)
-            img = Image.open(my_embed_path)
-        except:
-            print(f"WARNING: Skipping embed file {my_embed_path} due to issues. url: {orig_embed_path}")
-        else:
-            if img is not None:
-                if img.width < 600:
-                    embed['width'] = img.width
-                else:
-                    embed['width'] = 600
-                img.close
-                embed['height'] = "auto"
-                embed['onclick'] = f"window.open(\"{my_embed_path_relative}\")"
-            embed['src'] = my_embed_path_relative
+    def rewrite_embed(embed):
+        if class_matches(embed, external_embed_class):
+            return      # rewrite_external_embed points this one to the downloaded external image
+        counts['embeds'] += 1
+        my_embed_name = embed_name(embed['src'])
+        my_embed_name = arg_assets.renamed.get(my_embed_name, my_embed_name)
+        my_embed_path_relative = f"{attach_dir_relative}{my_embed_name}"
+        if my_embed_name in arg_assets.embed_widths:
+            embed['width'] = arg_assets.embed_widths[my_embed_name]
+            embed['height'] = "auto"
+            embed['onclick'] = f"window.open(\"{my_embed_path_relative}\")"
+        embed['src'] = my_embed_path_relative
+
     #
     # dealing with "emoticon" and expands' "grey_arrow_down.png"
     #
-    my_emoticons = soup.findAll('img',class_=re.compile("emoticon|expand-control-image"))
-    print(f"{len(my_emoticons)} emoticons.")
-    for emoticon in my_emoticons:
+    def rewrite_emoticon(emoticon):
+        counts['emoticons'] += 1
         my_emoticon_title = emoticon['src'].rsplit('/',1)[-1]     # just filename
-        if arg_sphinx_compatible == True:
-            my_emoticon_path = f"../{my_vars['emoticons_dir']}{my_emoticon_title}"
-        else:
-            my_emoticon_path = f"{my_vars['emoticons_dir']}{my_emoticon_title}"
-        if my_emoticon_title not in my_emoticons_list:
-            my_emoticons_list.append(my_emoticon_title)
-            print(f"Getting emoticon: {my_emoticon_title}")
-            file_path = os.path.join(my_outdirs[1],remove_illegal_characters(my_emoticon_title))
-            if not os.path.exists(file_path):
-                emoticon_src = emoticon['src']
-                try:
-                    request_emoticons = requests.get(emoticon_src, auth=(arg_username, arg_api_token))
-                    open(file_path, 'wb').write(request_emoticons.content)
-                except:
-                    print(f"WARNING: Skipping emoticon file {file_path} due to issues. url: {emoticon_src}")
-        emoticon['src'] = my_emoticon_path
-
-    my_body_export_view = get_body_export_view(arg_site,arg_page_id,arg_username,arg_api_token).json()
-    page_url = f"{my_body_export_view['_links']['base']}{my_body_export_view['_links']['webui']}"
+        emoticon['src'] = f"{emoticons_dir_relative}{my_emoticon_title}"
+
+    rewriter = PageRewriter()
+    rewriter.register('div', remove, class_="expand-control")
+    rewriter.register('pre', remove_syntaxhighlighter_class)
+    if (arg_type == "report"):
+        rewriter.register('td', link_report_child, class_="title")
+    external_embed_class = "confluence-embedded-image confluence-external-resource"
+    rewriter.register('img', rewrite_external_embed, class_=external_embed_class)
+    rewriter.register('img', rewrite_embed, class_=re.compile("^confluence-embedded-image"))
+    rewriter.register('img', rewrite_emoticon, class_=re.compile("emoticon|expand-control-image"))
+    soup = rewriter.rewrite(parse_html(arg_html))
+    print(f"{counts['embeds']} embedded images.")
+    print(f"{counts['emoticons']} emoticons.")
+
     if arg_sphinx_compatible == True:
         styles_dir_relative = f"../{my_vars['styles_dir']}"
     else:
@@ -398,14 +1047,16 @@ def dump_html(
     #
     # Putting HTML together
     #
-    pretty_html = soup.prettify()
-    html_file = open(html_file_path, 'w', encoding='utf-8')
-    html_file.write(my_header)
-    html_file.write(pretty_html)
+    pretty_html = serialize_html(soup)
+    html_document = my_header + pretty_html
     if len(my_attachments) > 0:
-        html_file.write(my_pre_footer)
-    html_file.write(myFooter)
-    html_file.close()
+        html_document += my_pre_footer
+    html_document += myFooter
+    # the HTML file is only written when it is wanted, pandoc converts the page from memory
+    if arg_html_output == True or not arg_rst_output:
+        html_file = open(html_file_path, 'w', encoding='utf-8')
+        html_file.write(html_document)
+        html_file.close()
     if arg_html_output == True:
         print(f"Exported HTML file {html_file_path}")
     #
@@ -417,10 +1068,18 @@ def dump_html(
     rst_file_name = f"{html_file_name.replace('html','rst')}"
     rst_file_path = os.path.join(my_outdir_content,rst_file_name)
     try:
-        output_rst = pypandoc.convert_file(str(html_file_path), 'rst', format='html',extra_args=['--standalone','--wrap=none','--list-tables'])
+        if arg_pandoc is not None:
+            output_rst = arg_pandoc.convert(html_document)
+        else:
+            output_rst = convert_with_pandoc(html_document)
     except Exception as e:
         print("There was an issue generating an RST file from the page.")
         print(e)
+        if arg_html_output == False:
+            # keep the HTML of the page rather than nothing
+            html_file = open(html_file_path, 'w', encoding='utf-8')
+            html_file.write(html_document)
+            html_file.close()
     else:
         ##
         ## RST Header with Page Metadata
@@ -454,6 +1113,61 @@ def dump_html(
         rst_file.write(footer_rst)
         rst_file.close()
         print(f"Exported RST file: {rst_file_path}")
-        if arg_html_output == False:
-            os.remove(html_file_path)
         return page_url, rst_file_path
+
+def dump_html(
+    arg_site,
+    arg_html,
+    arg_title,
+    arg_page_id,
+    arg_outdir_base,
+    arg_outdir_content,
+    arg_page_labels,
+    arg_page_parent,
+    arg_username,
+    arg_api_token,
+    arg_sphinx_compatible=True,
+    arg_sphinx_tags=False,
+    arg_type="",
+    arg_html_output=False,
+    arg_rst_output=True,
+    arg_show_labels=False,
+    arg_session=None,
+    arg_page=None,
+    arg_pandoc=None,
+    arg_downloader=None,
+    arg_blob_store=None,
+    arg_report_children=None
+    ):
+    """Create HTML and RST files
+
+    Runs fetch_page_assets and then render_page for the page.
+
+    Args:
+        arg_site: Name of the Confluence Site
+        arg_html: HTML Content to use for page
+        arg_title: Title of the page
+        arg_page_id: Page ID
+        arg_outdir_base: Base output folder
+        arg_outdir_content: Output folder for Content
+        arg_page_labels: Labels of the page
+        arg_page_parent: Parent of the page
+        arg_username: Username for authentication
+        arg_api_token: API Token for authentication
+        arg_sphinx_compatible: Place _static and _images folder at root of output folder
+        arg_sphinx_tags: Add tags to output RST
+        arg_type: For Page Properties, the type of page: "report", "child" or "common" if it's not for Page Properties
+        arg_session: Shared HTTP session used for the API calls and downloads (optional)
+        arg_page: PageRecord of the page, used instead of fetching the URL and attachments again (optional)
+        arg_pandoc: PandocPool converting the page to RST, instead of starting pandoc for it (optional)
+        arg_downloader: AssetDownloader shared by the export, limiting the downloads per host (optional)
+        arg_blob_store: BlobStore the attachments are downloaded to once and linked from (optional)
+        arg_report_children: For a "report" page, its children as returned by get_page_properties_children (optional)
+
+    Returns:
+        HTML, RST and all attachments, embeds and emoticons
+    """
+    assets = fetch_page_assets(arg_site,arg_html,arg_page_id,arg_outdir_base,arg_outdir_content,arg_username,arg_api_token,
+        arg_type,arg_session,arg_page,arg_downloader,arg_blob_store,arg_report_children)
+    return(render_page(arg_html,arg_title,arg_page_id,arg_outdir_content,arg_page_labels,arg_page_parent,assets,
+        arg_sphinx_compatible,arg_type,arg_html_output,arg_rst_output,arg_show_labels,arg_pandoc))
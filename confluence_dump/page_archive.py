@@ -0,0 +1,128 @@
+import dataclasses
+import gzip
+import io
+import json
+import os.path
+import threading
+
+try:
+    import zstandard
+except ImportError:     # optional, the archive is gzipped without it
+    zstandard = None
+
+"""
+Archive of the pages of an export, for rendering them again offline
+
+For every page a space export writes, one JSON line keeps the page as
+fetched (body, labels, attachments) and what fetch_page_assets found out
+about its files. The `rerender` mode reads the archive back and runs
+render_page for each page, so output options can be changed without
+contacting the site.
+
+The archive is compressed with zstandard when it is installed, gzip
+otherwise. It is written next to the old one while the export runs and
+replaces it at the end; pages of the old archive that the run didn't
+export are carried over when the run only covered part of the space, or
+was for another space, unless the run pruned them as deleted.
+"""
+
+ARCHIVE_FILE_NAME = ".confluence_dump_pages.jsonl"
+ZSTD_SUFFIX = ".zst"
+GZIP_SUFFIX = ".gz"
+
+
+def existing_archive_path(outdir):
+    """Path of the page archive of an output folder, or None if there is none"""
+    for suffix in (ZSTD_SUFFIX, GZIP_SUFFIX):
+        path = os.path.join(outdir, f"{ARCHIVE_FILE_NAME}{suffix}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _open_for_reading(path):
+    f = open(path, 'rb')
+    if path.endswith(ZSTD_SUFFIX):
+        if zstandard is None:
+            f.close()
+            raise ImportError(f"Reading {path} needs zstandard, install it with: pip install zstandard")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f, closefd=True), encoding='utf-8')
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode='rb'), encoding='utf-8')
+
+
+def read_page_archive(outdir):
+    """Yield the records of the page archive of an output folder, if it has one"""
+    path = existing_archive_path(outdir)
+    if path is None:
+        return
+    with _open_for_reading(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def page_archive_record(page, space_id, outdir_content, title, parent_id, assets, sphinx):
+    """Archive record of an exported page, from its PageRecord and PageAssets
+
+    outdir_content is relative to the output folder, so the output can be moved.
+    sphinx tells where the files of the page were put: the `_images` and
+    `_static` folders of the output folder, or the ones of outdir_content.
+    """
+    return {
+        'page_id': page.id,
+        'space_id': space_id,
+        'outdir_content': outdir_content,
+        'title': title,
+        'parent_id': parent_id,
+        'sphinx': sphinx,
+        'page': dataclasses.asdict(page),
+        'assets': dataclasses.asdict(assets),
+    }
+
+
+class PageArchive:
+    def __init__(self, outdir, keep_previous=False):
+        suffix = ZSTD_SUFFIX if zstandard is not None else GZIP_SUFFIX
+        self.outdir = outdir
+        self.path = os.path.join(outdir, f"{ARCHIVE_FILE_NAME}{suffix}")
+        self.part_path = f"{self.path}.part"
+        self.keep_previous = keep_previous
+        self.page_ids = set()
+        self.space_ids = set()
+        self.discarded_page_ids = set()
+        self.lock = threading.Lock()
+        os.makedirs(outdir, exist_ok=True)
+        f = open(self.part_path, 'wb')
+        if zstandard is not None:
+            self.file = zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+        else:
+            self.file = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+            self.raw_file = f
+
+    def add(self, record):
+        line = f"{json.dumps(record)}\n".encode('utf-8')
+        with self.lock:
+            self.file.write(line)
+            self.page_ids.add(record['page_id'])
+            self.space_ids.add(record['space_id'])
+
+    def discard(self, page_id):
+        """Leave a page of the old archive out, for pages removed from the output folder"""
+        with self.lock:
+            self.discarded_page_ids.add(str(page_id))
+
+    def close(self, interrupted=False):
+        """Replace the old archive, carrying over the pages of other spaces, and the other pages of a partial or interrupted run"""
+        with self.lock:
+            for record in read_page_archive(self.outdir):
+                if record['page_id'] in self.page_ids or str(record['page_id']) in self.discarded_page_ids:
+                    continue
+                if self.keep_previous or interrupted or record['space_id'] not in self.space_ids:
+                    self.file.write(f"{json.dumps(record)}\n".encode('utf-8'))
+            self.file.close()
+            if zstandard is None:
+                self.raw_file.close()
+            previous_path = existing_archive_path(self.outdir)
+            os.replace(self.part_path, self.path)
+            if previous_path is not None and previous_path != self.path:
+                os.remove(previous_path)
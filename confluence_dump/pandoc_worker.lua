@@ -0,0 +1,24 @@
+-- Converts HTML documents to RST for confluence_dump.pandoc_worker.
+-- Run with `pandoc lua`; each request on stdin is "<byte count>\n<html>",
+-- each answer on stdout is "ok <byte count>\n<rst>" or "error <byte count>\n<message>".
+
+local options = {
+  template = pandoc.template.compile(pandoc.template.default('rst')),
+  wrap_text = 'none',
+  list_tables = true,
+}
+
+local function answer(status, text)
+  io.stdout:write(status, ' ', #text, '\n', text)
+  io.stdout:flush()
+end
+
+while true do
+  local size = io.stdin:read('l')
+  if not size then break end
+  local html = io.stdin:read(tonumber(size)) or ''
+  local ok, result = pcall(function()
+    return pandoc.write(pandoc.read(html, 'html'), 'rst', options)
+  end)
+  answer(ok and 'ok' or 'error', tostring(result))
+end
@@ -0,0 +1,138 @@
+import os.path
+import queue
+import subprocess
+import threading
+import pypandoc
+
+"""
+Long-lived pandoc processes converting the exported pages to RST
+
+Starting pandoc for every page costs more CPU than the conversion itself.
+A PandocPool keeps up to `size` `pandoc lua` processes running
+pandoc_worker.lua, each converting one HTML string at a time, and hands
+them out to the export threads. When the pandoc in use has no Lua
+interpreter (before pandoc 3.0), pages are converted with one pandoc
+run each, from memory as well.
+"""
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pandoc_worker.lua")
+PANDOC_ARGS = ['--standalone', '--wrap=none', '--list-tables']
+
+
+class PandocError(Exception):
+    pass
+
+
+def convert_with_pandoc(html):
+    """Convert an HTML string to RST with one pandoc run"""
+    return pypandoc.convert_text(html, 'rst', format='html', extra_args=PANDOC_ARGS)
+
+
+class PandocWorker:
+    """One `pandoc lua` process converting a page at a time"""
+    def __init__(self, pandoc_path):
+        self.process = subprocess.Popen(
+            [pandoc_path, "lua", WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            start_new_session=True,  # Ctrl+C stops the export, which still needs pandoc for the pages in progress
+        )
+
+    def convert(self, html):
+        data = html.encode('utf-8')
+        try:
+            self.process.stdin.write(f"{len(data)}\n".encode('ascii') + data)
+            self.process.stdin.flush()
+            status, size = self.process.stdout.readline().decode('ascii').split()
+            result = self.process.stdout.read(int(size)).decode('utf-8')
+        except (OSError, ValueError) as e:
+            raise BrokenPipeError(f"pandoc worker stopped: {e}") from e
+        if status != "ok":
+            raise PandocError(result)
+        return result
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class PandocPool:
+    def __init__(self, size=4):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.started = 0
+        self.available = None       # unknown until the first worker was started
+        self.lock = threading.Lock()
+
+    def _start_worker(self):
+        worker = PandocWorker(pypandoc.get_pandoc_path())
+        try:
+            worker.convert("<p></p>")
+        except (BrokenPipeError, PandocError):
+            worker.close()
+            raise
+        return worker
+
+    def _checkout(self):
+        """An idle worker, a new one if the pool isn't full, or None if pandoc can't run workers"""
+        while True:
+            with self.lock:
+                if self.available is False:
+                    return None
+                try:
+                    return self.idle.get_nowait()
+                except queue.Empty:
+                    pass
+                start = self.started < self.size
+                if start:
+                    self.started += 1
+            if start:
+                break
+            try:
+                return self.idle.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        try:
+            worker = self._start_worker()
+        except (OSError, BrokenPipeError, PandocError):
+            with self.lock:
+                self.started -= 1
+                if self.available is None:
+                    print("This pandoc can't run conversion workers, converting each page with its own pandoc run")
+                    self.available = False
+            return None
+        self.available = True
+        return worker
+
+    def convert(self, html):
+        """Convert an HTML string to RST on one of the pooled workers"""
+        worker = self._checkout()
+        if worker is None:
+            return convert_with_pandoc(html)
+        try:
+            result = worker.convert(html)
+        except PandocError:
+            self.idle.put(worker)
+            raise
+        except BaseException as e:
+            # the process died, or was left mid-answer; replace it
+            worker.close()
+            with self.lock:
+                self.started -= 1
+            if isinstance(e, BrokenPipeError):
+                return convert_with_pandoc(html)
+            raise
+        self.idle.put(worker)
+        return result
+
+    def close(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
+            with self.lock:
+                self.started -= 1
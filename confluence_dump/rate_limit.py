@@ -0,0 +1,137 @@
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+"""
+Client-side rate limiting for the Confluence API
+
+One RateLimiter is shared by every request of an export, whichever engine
+runs it. It combines a token bucket (requests per second) with a window of
+requests allowed in flight. Both grow additively while requests succeed and
+are halved whenever Atlassian answers 429 or 503, which also pauses all
+requests for the Retry-After delay (AIMD, as in TCP congestion control).
+"""
+
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 5
+SLOT_WAIT = 0.05        # how long to wait before re-checking for a free slot in the window
+
+
+def retry_after_seconds(arg_retry_after, arg_attempt):
+    """Seconds to wait before retrying, from a Retry-After header or exponential backoff
+
+    Args:
+        arg_retry_after: Value of the Retry-After header (seconds or HTTP date), or None
+        arg_attempt: Number of retries already made for this request
+
+    Returns:
+        seconds (float): Delay before the next attempt
+    """
+    if arg_retry_after:
+        try:
+            return max(0.0, float(arg_retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(arg_retry_after)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return min(60.0, 2 ** arg_attempt) + random.uniform(0, 1)
+
+
+class RateLimiter:
+    def __init__(self, host, max_rate=50.0, max_concurrency=8, min_rate=1.0, min_concurrency=1):
+        self.host = host                    # only requests to this host are limited
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        # start at half the ceiling and let additive increase find the limit
+        self.rate = max(self.min_rate, max_rate / 2)
+        self.concurrency = max(self.min_concurrency, max_concurrency / 2)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled_responses = 0
+        self.throttled_seconds = 0.0       # summed over all waiting requests
+        self.condition = threading.Condition()
+
+    def _reserve(self):
+        """Take a token and a slot if both are available, otherwise return how long to wait"""
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.concurrency):
+            return SLOT_WAIT
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        self.requests += 1
+        return 0
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        with self.condition:
+            started = None
+            while True:
+                delay = self._reserve()
+                if delay == 0:
+                    break
+                if started is None:
+                    started = time.monotonic()
+                self.condition.wait(delay)
+            if started is not None:
+                self.throttled_seconds += time.monotonic() - started
+
+    async def acquire_async(self):
+        """Wait on the event loop until a request may be sent"""
+        started = None
+        while True:
+            with self.condition:
+                delay = self._reserve()
+                if delay == 0:
+                    if started is not None:
+                        self.throttled_seconds += time.monotonic() - started
+                    return
+            if started is None:
+                started = time.monotonic()
+            await asyncio.sleep(min(delay, SLOT_WAIT))
+
+    def release(self, throttled=False, retry_after=0.0):
+        """Hand back the slot of a finished request and adapt the limits
+
+        Args:
+            throttled: The server answered 429 or 503
+            retry_after: Seconds the server asked us to wait
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled_responses += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def metrics(self):
+        """Counters for reporting how much the export was held back"""
+        with self.condition:
+            return {
+                "requests": self.requests,
+                "throttled_responses": self.throttled_responses,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "rate": round(self.rate, 2),
+                "concurrency": int(self.concurrency),
+            }
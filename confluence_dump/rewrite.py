@@ -0,0 +1,65 @@
+from bs4 import BeautifulSoup as bs
+
+try:
+    import lxml     # optional, a faster parser for BeautifulSoup
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+"""
+One-pass rewriting of the page HTML
+
+dump_html used to search the whole page once per kind of element it
+rewrites. A PageRewriter walks the page once instead and hands every
+element to the handlers registered for its tag name. Handlers run in the
+order they were registered, and an element removed by one of them is
+skipped along with everything inside it.
+
+Pages are parsed with lxml when it is installed, html.parser otherwise.
+"""
+
+
+def parse_html(html, parse_only=None):
+    """Parse a page body with the fastest available parser"""
+    return bs(html, HTML_PARSER, parse_only=parse_only)
+
+
+def serialize_html(soup):
+    """Pretty-print a page parsed by parse_html
+
+    lxml wraps a fragment in html, head and body elements. Only their
+    contents are printed, so the result is the same as with html.parser.
+    """
+    if HTML_PARSER != "lxml" or soup.html is None:
+        return soup.prettify()
+    return "".join(part.decode_contents(indent_level=0) for part in (soup.head, soup.body) if part is not None)
+
+
+def class_matches(element, match):
+    """Same test as BeautifulSoup's class_ filter, for a string or a compiled regex"""
+    classes = element.get('class') or []
+    if isinstance(match, str):
+        return match in classes or " ".join(classes) == match
+    return any(match.search(c) for c in classes) or bool(classes and match.search(" ".join(classes)))
+
+
+class PageRewriter:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, tag_name, handler, class_=None):
+        """Call handler(element) for each element with this tag name and, if given, class (a string or regex)"""
+        self.handlers.setdefault(tag_name, []).append((class_, handler))
+
+    def rewrite(self, soup):
+        # walking the tree directly is much cheaper than find_all's filters
+        elements = [element for element in soup.descendants if element.name in self.handlers]
+        for element in elements:
+            # decompose() leaves an element, and all elements inside it, without a name;
+            # Tag.decomposed can't be used here, as it is slow to look up on a live Tag
+            for class_, handler in self.handlers.get(element.name, ()):
+                if class_ is None or class_matches(element, class_):
+                    handler(element)
+                    if not element.name:
+                        break
+        return soup
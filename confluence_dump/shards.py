@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import os.path
+import re
+import shutil
+import threading
+from dataclasses import dataclass, field
+from confluence_dump.asset_registry import ASSETS_FILE_NAME, AssetRegistry
+from confluence_dump.blob_store import BLOBS_DIR_NAME, BlobStore
+from confluence_dump.export_state import file_sha256
+from confluence_dump.myModules import set_variables
+from confluence_dump.page_archive import PageArchive, read_page_archive
+
+"""
+Sharding of an export across machines, and merging of the shards
+
+With shard K/N, an export only writes the pages whose id hashes to shard K
+out of N, so N machines can export disjoint parts of the same spaces into
+separate output folders. The hash of a page id doesn't depend on the run,
+the machine or the other pages, so the same page always lands in the same
+shard. Each shard lists what it wrote in a manifest in its output folder.
+
+merge_shards combines the output folders of the shards into one: the
+pages and shared files are copied over, the attachment stores are merged
+by content hash, so a file downloaded by several shards is stored once,
+and the attachment names of each shard are linked again into the merged
+`_images` folders. When two shards used the same name for different
+files, the second one gets a hash-prefixed name, as within one export, and
+the pages of that shard are pointed to it. The page archives are merged
+too, so the merged folder can be rendered again. Any other file two shards
+wrote differently is a conflict: the copy of the first shard is kept, and
+the conflict is listed in the result.
+"""
+
+MANIFEST_FILE_NAME = ".confluence_dump_shard.json"
+METADATA_PREFIX = ".confluence_dump"     # state, cache, journals, archive, registry and manifest of an output folder
+
+
+def parse_shard(value):
+    """Parse "K/N" into (K, N), with 1 <= K <= N"""
+    try:
+        shard, shards = (int(n) for n in value.split("/"))
+    except ValueError:
+        raise ValueError(f"shard {value!r} isn't of the form K/N") from None
+    if not 1 <= shard <= shards:
+        raise ValueError(f"shard {value!r} needs 1 <= K <= N")
+    return shard, shards
+
+
+def page_shard(page_id, shards):
+    """Shard, from 1 to shards, a page belongs to"""
+    digest = hashlib.sha256(str(page_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards + 1
+
+
+@dataclass
+class MergeResult:
+    pages: int = 0
+    conflicts: list = field(default_factory=list)   # paths, relative to the merged folder, that differ between the shards
+
+
+class ShardManifest:
+    def __init__(self, outdir, shard, shards):
+        self.outdir = outdir
+        self.path = os.path.join(outdir, MANIFEST_FILE_NAME)
+        self.shard = shard
+        self.shards = shards
+        self.pages = {}
+        self.lock = threading.Lock()
+        manifest = read_manifest(outdir)
+        if manifest is not None and (manifest['shard'], manifest['shards']) == (shard, shards):
+            self.pages = manifest['pages']     # pages written by earlier runs of the same shard
+
+    def record(self, page_id, space_id, output_paths):
+        """Add a page written to disk, with its files"""
+        with self.lock:
+            self.pages[str(page_id)] = {
+                'space_id': space_id,
+                'paths': [os.path.relpath(path, self.outdir) for path in output_paths],
+            }
+
+    def write(self):
+        with self.lock:
+            os.makedirs(self.outdir, exist_ok=True)
+            with open(f"{self.path}.tmp", 'w') as f:
+                json.dump({'shard': self.shard, 'shards': self.shards, 'pages': self.pages}, f, indent=1)
+            os.replace(f"{self.path}.tmp", self.path)
+
+
+def read_manifest(outdir):
+    """Shard manifest of an output folder, or None if it has none"""
+    try:
+        with open(os.path.join(outdir, MANIFEST_FILE_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _link_or_copy(source_path, file_path):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    try:
+        os.link(source_path, file_path)
+    except OSError:
+        shutil.copyfile(source_path, file_path)
+
+
+def _blob_store_dirs(shard_dir):
+    """Folders of a shard holding an attachment store, relative to the shard"""
+    for folder, dirs, files in os.walk(shard_dir):
+        if BLOBS_DIR_NAME in dirs:
+            yield os.path.relpath(folder, shard_dir)
+        dirs[:] = [d for d in dirs if d != BLOBS_DIR_NAME and not d.startswith(METADATA_PREFIX)]
+
+
+def _merge_attachments(shard_dir, outdir, base):
+    """Merge the attachment store of a shard folder and link its attachments into the merged folder
+
+    Returns:
+        (paths of the shard linked from its store, {old name: new name} of the attachments renamed)
+    """
+    shard_store = BlobStore(os.path.join(shard_dir, base))
+    merged_store = BlobStore(os.path.join(outdir, base))
+    linked = set()
+    renamed = {}
+    try:
+        for path, sha256 in shard_store.linked_files():
+            shard_path = os.path.join(shard_dir, base, path)
+            if not os.path.exists(shard_path):
+                continue
+            source_path = shard_store.blob_path(sha256)
+            merged_store.import_blob(sha256, source_path if os.path.exists(source_path) else shard_path)
+            folder, name = os.path.split(path)
+            os.makedirs(os.path.join(outdir, base, folder), exist_ok=True)
+            merged_name = merged_store.link(sha256, os.path.join(outdir, base, folder), name)
+            if merged_name != name:
+                renamed[name] = merged_name
+            linked.add(os.path.normpath(os.path.join(base, path)))
+        merged_store.import_file_ids(shard_store)
+    finally:
+        shard_store.close()
+        merged_store.close()
+    return linked, renamed
+
+
+def _rename_attachments_in_page(file_path, renamed):
+    """Point the links of a page to the attachments renamed by the merge"""
+    attach_dir = set_variables()['attach_dir']
+    pattern = re.compile(
+        f"(?<={re.escape(attach_dir)})({'|'.join(re.escape(name) for name in renamed)})(?![\\w.-])"
+    )
+    with open(file_path, encoding='utf-8') as f:
+        text = f.read()
+    text, count = pattern.subn(lambda m: renamed[m.group(1)], text)
+    if count:
+        # replaced rather than written over, the file can be a hard link to the one of the shard
+        with open(f"{file_path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(f"{file_path}.tmp", file_path)
+
+
+def _rename_attachments_in_record(record, renamed):
+    """Same as _rename_attachments_in_page, for a record of the page archive"""
+    assets = record['assets']
+    original_names = {name: title for title, name in assets['renamed'].items()}
+    for name in assets['attachments']:
+        if name in renamed:
+            assets['renamed'][original_names.get(name, name)] = renamed[name]
+    assets['attachments'] = [renamed.get(name, name) for name in assets['attachments']]
+    assets['embed_widths'] = {renamed.get(name, name): width for name, width in assets['embed_widths'].items()}
+
+
+def _base_of(path, bases):
+    """Folder of the attachment store a page path (or folder) is under, the deepest one"""
+    path = os.path.normpath(path)
+    under = [base for base in bases if base in (".", path) or path.startswith(f"{base}{os.sep}")]
+    return max(under, key=len) if under else None
+
+
+def merge_shards(shard_dirs, outdir):
+    """Combine the output folders of the shards of an export into outdir
+
+    Returns:
+        MergeResult with the number of pages merged and the conflicting files
+    """
+    manifests = {}
+    for shard_dir in shard_dirs:
+        manifest = read_manifest(shard_dir)
+        if manifest is None:
+            raise ValueError(f"{shard_dir} has no shard manifest, it wasn't exported with a shard")
+        manifests[shard_dir] = manifest
+    shard_counts = {manifest['shards'] for manifest in manifests.values()}
+    if len(shard_counts) != 1:
+        raise ValueError(f"The folders were exported with different shard counts: {sorted(shard_counts)}")
+    shards = shard_counts.pop()
+    seen = [manifest['shard'] for manifest in manifests.values()]
+    if len(set(seen)) != len(seen):
+        raise ValueError("The same shard is given twice")
+    missing = sorted(set(range(1, shards + 1)) - set(seen))
+    if missing:
+        logging.warning(f"Shards {', '.join(map(str, missing))} of {shards} are missing, their pages won't be in {outdir}")
+
+    os.makedirs(outdir, exist_ok=True)
+    registry = AssetRegistry()
+    archive = PageArchive(outdir, keep_previous=True)
+    result = MergeResult()
+    try:
+        for shard_dir, manifest in manifests.items():
+            logging.info(f"Merging shard {manifest['shard']}/{shards} from {shard_dir}")
+            linked = set()
+            renamed = {}    # by attachment store folder
+            for base in _blob_store_dirs(shard_dir):
+                base_linked, renamed[base] = _merge_attachments(shard_dir, outdir, base)
+                linked |= base_linked
+
+            for folder, dirs, files in os.walk(shard_dir):
+                dirs[:] = [d for d in dirs if d != BLOBS_DIR_NAME and not d.startswith(METADATA_PREFIX)]
+                rel_folder = os.path.relpath(folder, shard_dir)
+                for name in files:
+                    rel_path = os.path.normpath(os.path.join(rel_folder, name))
+                    if name.startswith(METADATA_PREFIX) or rel_path in linked:
+                        continue
+                    file_path = os.path.join(outdir, rel_path)
+                    if not os.path.exists(file_path):
+                        _link_or_copy(os.path.join(shard_dir, rel_path), file_path)
+                    elif file_sha256(file_path) != file_sha256(os.path.join(shard_dir, rel_path)):
+                        logging.error(f"{rel_path} differs between the shards, the one of {shard_dir} is left out")
+                        result.conflicts.append(rel_path)
+                if ASSETS_FILE_NAME in files:
+                    with open(os.path.join(folder, ASSETS_FILE_NAME)) as f:
+                        for asset in json.load(f)['files']:
+                            if os.path.exists(os.path.join(outdir, rel_folder, asset)):
+                                registry.add(os.path.join(outdir, rel_folder), asset)
+
+            for page_id, page in manifest['pages'].items():
+                for path in page['paths']:
+                    base = _base_of(path, renamed)
+                    if base is not None and renamed[base] and os.path.exists(os.path.join(outdir, path)):
+                        _rename_attachments_in_page(os.path.join(outdir, path), renamed[base])
+            for record in read_page_archive(shard_dir):
+                base = _base_of(record['outdir_content'], renamed)
+                if base is not None and renamed[base]:
+                    _rename_attachments_in_record(record, renamed[base])
+                archive.add(record)
+            result.pages += len(manifest['pages'])
+    finally:
+        archive.close()
+    logging.info(f"Merged {result.pages} pages of {len(manifests)} shards into {outdir}")
+    if result.conflicts:
+        logging.error(f"{len(result.conflicts)} files differ between the shards, see the errors above")
+    return result
@@ -15,9 +15,10 @@ parser.add_argument('--page', '-p', type=int,
                     help='Page ID')
 args = parser.parse_args()
 atlassian_site = args.site
+session = myModules.get_session(atlassian_site,user_name,api_token)
 
 if args.page:
-    page_editor_version = myModules.get_editor_version(atlassian_site,args.page,user_name,api_token).json()
+    page_editor_version = myModules.get_editor_version(atlassian_site,args.page,user_name,api_token,session).json()
     try:
         page_editor_version['metadata']['properties']['editor']['value'] == "v2"
     except KeyError:
@@ -28,7 +29,7 @@ if args.page:
 elif args.space:
     space_key = args.space
     ## get all spaces in order to find the space ID based on the key
-    all_spaces_full = myModules.get_spaces_all(atlassian_site,user_name,api_token)         # get a dump of all spaces
+    all_spaces_full = myModules.get_spaces_all(atlassian_site,user_name,api_token,session)         # get a dump of all spaces
     all_spaces_short = []                                                             # initialize list for less detailed list of spaces
     i = 0
     for n in all_spaces_full:
@@ -52,7 +53,7 @@ elif args.space:
         #
         # get list of pages from space
         #
-        all_pages_full = myModules.get_pages_from_space(atlassian_site,space_id,user_name,api_token)
+        all_pages_full = myModules.get_pages_from_space(atlassian_site,space_id,user_name,api_token,session)
         all_pages_short = []
         i = 0
         for n in all_pages_full:
@@ -70,7 +71,7 @@ elif args.space:
     for my_page in all_pages_short:
         try:
             print(f"Checking page {my_page['pageTitle']} ({my_page['page_id']})")
-            page_editor_version = myModules.get_editor_version(atlassian_site,my_page['page_id'],user_name,api_token).json()
+            page_editor_version = myModules.get_editor_version(atlassian_site,my_page['page_id'],user_name,api_token,session).json()
         except KeyError:
             print(f"Key Error with {my_page}")
             break
@@ -5,7 +5,8 @@ setup(
     version='0.0.1',
     url='https://github.com/jgoldin-skillz/confluenceDumpWithPython.git',
     packages=find_packages(),
-    install_requires=['beautifulsoup4', 'Pillow', 'pandoc', 'pypandoc', 'requests'],
-    package_data={'': ['styles/confluence.css', 'styles/confluencedefaultpdf.css']},
+    install_requires=['beautifulsoup4', 'Pillow', 'pandoc', 'pypandoc', 'requests', 'python-dateutil', 'humanfriendly'],
+    extras_require={'async': ['aiohttp'], 'lxml': ['lxml'], 'zstd': ['zstandard']},
+    package_data={'': ['styles/confluence.css', 'styles/confluencedefaultpdf.css', 'pandoc_worker.lua']},
     include_package_data=True,
 )
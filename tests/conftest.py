@@ -0,0 +1,150 @@
+import json
+import re
+from urllib.parse import unquote, urlparse
+
+import pytest
+from requests.adapters import HTTPAdapter
+from requests.models import Request, Response
+
+try:
+    import aiohttp
+except ImportError:     # optional, the async backend tests are skipped without it
+    aiohttp = None
+
+"""
+Fake Confluence Cloud site for the tests
+
+Answers the requests of an export from memory: one space, DOC, with pages
+1 to 5, and a Page Properties report, page 9, listing pages 3 and 5. The
+pages have no attachments, but any attachment a test adds to page_content
+can be downloaded: its content is attachment_content of its page and name.
+The requests of the async backend get the same answers.
+"""
+
+SITE = "acme"
+BASE = f"https://{SITE}.atlassian.net/wiki"
+SPACE = {"id": 100, "key": "DOC", "name": "Docs", "homepageId": 1, "description": None}
+PAGE_IDS = [1, 2, 3, 4, 5]
+REPORT_PAGE_ID = 9
+REPORT_CHILDREN = [3, 5]
+
+
+def page_body(page_id):
+    if page_id == REPORT_PAGE_ID:
+        return "<table>" + "".join(
+            f'<tr><td class="title" data-content-id="{child}"><a href="x">Page {child}</a></td></tr>'
+            for child in REPORT_CHILDREN
+        ) + "</table>"
+    return f"<p>Body of page {page_id}</p>"
+
+
+def page_content(page_id):
+    return {
+        "id": str(page_id),
+        "type": "page",
+        "title": f"Page {page_id}",
+        "space": {"key": SPACE["key"], "id": SPACE["id"]},
+        "version": {"number": 1},
+        "history": {"createdDate": "2024-01-01T00:00:00.000Z", "lastUpdated": {"when": "2024-05-01T10:00:00.000Z"}},
+        "ancestors": [{"id": "1"}] if page_id != 1 else [],
+        "metadata": {"labels": {"results": [{"name": "alpha"}, {"name": f"p{page_id}"}], "_links": {}}},
+        "children": {"attachment": {"results": [], "_links": {}}},
+        "body": {"export_view": {"value": page_body(page_id)}},
+        "_links": {"base": BASE, "webui": f"/spaces/DOC/pages/{page_id}"},
+    }
+
+
+def attachment_content(page_id, name):
+    return f"{name} of page {page_id}".encode()
+
+
+def listed_page(page_id):
+    return {
+        "id": str(page_id), "title": f"Page {page_id}", "parentId": "1" if page_id != 1 else None,
+        "spaceId": str(SPACE["id"]), "version": {"number": 1},
+    }
+
+
+def respond(request, payload, status=200):
+    response = Response()
+    response.status_code = status
+    response.url = request.url
+    response.request = request
+    response._content = json.dumps(payload).encode()
+    response.headers["Content-Type"] = "application/json"
+    response.encoding = "utf-8"
+    return response
+
+
+def respond_file(request, content):
+    response = Response()
+    response.status_code = 200
+    response.url = request.url
+    response.request = request
+    response._content = content
+    response._content_consumed = True       # so iter_content serves _content to streamed downloads
+    response.headers["Content-Length"] = str(len(content))
+    return response
+
+
+def route(request):
+    url = urlparse(request.url)
+    path = url.path
+    if re.search(r"/api/v2/spaces/?$", path):
+        return respond(request, {"results": [SPACE], "_links": {}})
+    if path.endswith(f"/api/v2/spaces/{SPACE['id']}/pages"):
+        return respond(request, {"results": [listed_page(i) for i in PAGE_IDS], "_links": {}})
+    m = re.search(r"/rest/api/content/(\d+)$", path)
+    if m:
+        return respond(request, page_content(int(m.group(1))))
+    if path.endswith("/rest/api/content/search"):
+        m = re.search(r"id in \(([\d,]+)\)", unquote(url.query))
+        page_ids = [int(i) for i in m.group(1).split(",")] if m else []
+        return respond(request, {"results": [page_content(i) for i in page_ids], "_links": {"base": BASE}})
+    m = re.search(r"/download/attachments/(\d+)/([^/]+)$", path)
+    if m:
+        return respond_file(request, attachment_content(int(m.group(1)), unquote(m.group(2))))
+    return respond(request, {"path": path}, status=404)
+
+
+class AiohttpResponse:
+    """What the async backend reads of an aiohttp.ClientResponse, for a response of route"""
+    def __init__(self, response):
+        self.status = response.status_code
+        self.headers = response.headers
+        self.body = response.content
+        self.content = self
+
+    @property
+    def content_length(self):
+        return len(self.body)
+
+    async def read(self):
+        return self.body
+
+    async def json(self):
+        return json.loads(self.body)
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)
+
+    def release(self):
+        pass
+
+
+async def aiohttp_get(session, url, headers=None, **kwargs):
+    return AiohttpResponse(route(Request("GET", url, headers=headers).prepare()))
+
+
+@pytest.fixture
+def fake_site(monkeypatch):
+    """Send the requests of the tests to the fake site instead of the network"""
+    monkeypatch.setattr(HTTPAdapter, "send", lambda self, request, **kwargs: route(request))
+    if aiohttp is not None:
+        monkeypatch.setattr(aiohttp.ClientSession, "get", aiohttp_get)
+    return SITE
@@ -0,0 +1,73 @@
+import asyncio
+import os.path
+
+import pytest
+
+import conftest
+from confluence_dump.async_exporter import AsyncConfluenceExporter
+from confluence_dump.confluence_exporter import ConfluenceExporter
+from conftest import PAGE_IDS, attachment_content, respond
+
+aiohttp = pytest.importorskip("aiohttp")
+
+
+def exporter(site, outdir, **kwargs):
+    return ConfluenceExporter(
+        site, "DOC", outdir=str(outdir), api_username="u", api_token="t", backend="async", concurrency=4, **kwargs
+    )
+
+
+def test_async_export_downloads_the_attachments_on_the_loop(fake_site, tmp_path, monkeypatch):
+    page_content = conftest.page_content
+
+    def page_with_notes(page_id):
+        content = page_content(page_id)
+        content["children"]["attachment"]["results"].append({
+            "id": f"att{page_id}", "title": f"notes{page_id}.txt", "version": {"number": 1},
+            "extensions": {"fileId": f"file{page_id}", "fileSize": len(attachment_content(page_id, f"notes{page_id}.txt"))},
+            "_links": {"download": f"/download/attachments/{page_id}/notes{page_id}.txt"},
+        })
+        return content
+
+    monkeypatch.setattr(conftest, "page_content", page_with_notes)
+    sync_downloads = []
+    monkeypatch.setattr("confluence_dump.myModules.download_file", lambda *args: sync_downloads.append(args))
+
+    results = exporter(fake_site, tmp_path).export_space()
+    assert sorted(int(page_id) for page_id, url, rst_path, space_key, site in results.values()) == PAGE_IDS
+    assert sync_downloads == []
+    for page_id, url, rst_path, space_key, site in results.values():
+        assert os.path.exists(rst_path)
+        attachment_path = os.path.join(os.path.dirname(rst_path), "_images", f"notes{page_id}.txt")
+        with open(attachment_path, "rb") as f:
+            assert f.read() == attachment_content(page_id, f"notes{page_id}.txt")
+
+
+def test_listing_error_stops_the_workers_before_the_session_closes(fake_site, tmp_path, monkeypatch):
+    route = conftest.route
+
+    def failing_listing(request):
+        if "cursor=" in request.url:
+            return respond(request, {}, status=500)
+        response = route(request)
+        if request.url.split("?")[0].endswith("/pages"):
+            listing = response.json()
+            listing["_links"]["next"] = "/wiki/api/v2/spaces/100/pages?cursor=next"
+            response = respond(request, listing)
+        return response
+
+    monkeypatch.setattr(conftest, "route", failing_listing)
+    cancelled_with_open_session = []
+
+    async def slow_page(self, p, *args):
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled_with_open_session.append(not self.http.closed)
+            raise
+
+    monkeypatch.setattr(AsyncConfluenceExporter, "_export_space_page", slow_page)
+    with pytest.raises(aiohttp.ClientResponseError):
+        exporter(fake_site, tmp_path).export_space()
+    assert cancelled_with_open_session == [True] * len(cancelled_with_open_session)
+    assert cancelled_with_open_session
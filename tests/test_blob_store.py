@@ -0,0 +1,66 @@
+import os
+
+from confluence_dump.blob_store import HASH_PREFIX_LENGTH, BlobStore
+
+
+def writer(content, downloads):
+    def download(path):
+        downloads.append(path)
+        with open(path, "wb") as f:
+            f.write(content)
+    return download
+
+
+def test_same_content_is_stored_once_and_hard_linked(tmp_path):
+    images = tmp_path / "_images"
+    images.mkdir()
+    downloads = []
+    store = BlobStore(str(tmp_path))
+    try:
+        sha256 = store.fetch("att1", writer(b"diagram", downloads))
+        assert store.fetch("att2", writer(b"diagram", downloads)) == sha256
+        assert store.fetch("att1", writer(b"diagram", downloads)) == sha256      # known file id, not downloaded again
+        assert len(downloads) == 2
+        assert os.listdir(tmp_path / "_blobs" / sha256[:2]) == [sha256]
+
+        assert store.link(sha256, str(images), "diagram.png") == "diagram.png"
+        assert store.link(sha256, str(images), "diagram.png") == "diagram.png"
+        assert store.link(sha256, str(images), "copy.png") == "copy.png"
+        for name in ("diagram.png", "copy.png"):
+            assert os.path.samefile(images / name, store.blob_path(sha256))
+    finally:
+        store.close()
+
+
+def test_another_file_with_a_taken_name_gets_a_hash_prefix(tmp_path):
+    images = tmp_path / "_images"
+    images.mkdir()
+    (images / "old.png").write_bytes(b"exported before the store")
+    store = BlobStore(str(tmp_path))
+    try:
+        first = store.fetch("att1", writer(b"first", []))
+        second = store.fetch("att2", writer(b"second", []))
+        assert store.link(first, str(images), "diagram.png") == "diagram.png"
+        assert store.link(second, str(images), "diagram.png") == f"{second[:HASH_PREFIX_LENGTH]}-diagram.png"
+        assert (images / "diagram.png").read_bytes() == b"first"
+
+        third = store.fetch("att3", writer(b"third", []))
+        assert store.link(third, str(images), "old.png") == f"{third[:HASH_PREFIX_LENGTH]}-old.png"
+        assert (images / "old.png").read_bytes() == b"exported before the store"
+    finally:
+        store.close()
+
+
+def test_a_later_run_finds_the_downloaded_file_ids(tmp_path):
+    store = BlobStore(str(tmp_path))
+    sha256 = store.fetch("att1", writer(b"diagram", []))
+    store.close()
+
+    downloads = []
+    store = BlobStore(str(tmp_path))
+    try:
+        assert store.lookup("att1") == sha256
+        assert store.fetch("att1", writer(b"diagram", downloads)) == sha256
+        assert downloads == []
+    finally:
+        store.close()
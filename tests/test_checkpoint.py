@@ -0,0 +1,27 @@
+from confluence_dump.confluence_exporter import ConfluenceExporter
+from confluence_dump.page_archive import read_page_archive
+from conftest import PAGE_IDS
+
+
+def exporter(site, outdir, **kwargs):
+    return ConfluenceExporter(site, "DOC", outdir=str(outdir), api_username="u", api_token="t", workers=1, **kwargs)
+
+
+def test_interrupted_export_resumes_and_rerenders_every_page(fake_site, tmp_path):
+    interrupted = exporter(fake_site, tmp_path)
+    record_space_page = interrupted._record_space_page
+
+    def record_then_interrupt(*args):
+        record_space_page(*args)
+        if len(args[-1].results) == 3:
+            interrupted.interrupted = True     # as the Ctrl+C handler does
+
+    interrupted._record_space_page = record_then_interrupt
+    assert len(interrupted.export_space()) == 3
+
+    resumed = exporter(fake_site, tmp_path, resume=True)
+    assert len(resumed.export_space()) == len(PAGE_IDS) - 3
+
+    assert sorted(int(r["page_id"]) for r in read_page_archive(str(tmp_path))) == PAGE_IDS
+    rerendered = exporter(fake_site, tmp_path, cache_size_mb=0).rerender()
+    assert len(rerendered) == len(PAGE_IDS)
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+from confluence_dump.confluence_exporter import ConfluenceExporter
+
+
+def exporter_with_closes(site, outdir, space, closed, **kwargs):
+    exporter = ConfluenceExporter(site, space, outdir=str(outdir), api_username="u", api_token="t", workers=1, **kwargs)
+    exporter.pandoc.close = lambda: closed.append("pandoc")
+    exporter.downloader.close = lambda: closed.append("downloader")
+    return exporter
+
+
+def test_single_page_out_of_date_range_closes_workers(fake_site, tmp_path):
+    closed = []
+    exporter = exporter_with_closes(fake_site, tmp_path, "DOC", closed, start_date=datetime(2025, 1, 1, tzinfo=timezone.utc))
+    assert exporter.export_single_page(2) is None
+    assert closed == ["pandoc", "downloader"]
+
+
+def test_space_not_found_closes_workers(fake_site, tmp_path):
+    closed = []
+    exporter = exporter_with_closes(fake_site, tmp_path, "NOPE", closed)
+    assert exporter.export_space() == {}
+    assert closed == ["pandoc", "downloader"]
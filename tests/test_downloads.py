@@ -0,0 +1,112 @@
+import collections
+import os.path
+import threading
+import time
+from urllib.parse import urlparse
+
+import pytest
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+
+from conftest import BASE, SITE
+from confluence_dump.downloads import AssetDownloader
+from confluence_dump.myModules import download_part_file, get_session
+
+FILE = bytes(range(256)) * 40
+FILE_URL = f"{BASE}/download/attachments/1/file.bin"
+
+
+def file_server(monkeypatch, honor_range=True):
+    """Serve FILE, with Range requests answered 206 or 416 like Confluence; returns the Range headers received"""
+    ranges = []
+
+    def send(self, request, **kwargs):
+        response = Response()
+        response.request = request
+        response.url = request.url
+        requested = request.headers.get("Range")
+        ranges.append(requested)
+        start = int(requested[len("bytes="):-1]) if requested and honor_range else 0
+        if start >= len(FILE):
+            response.status_code = 416
+            response._content = b""
+        else:
+            response.status_code = 206 if start else 200
+            response._content = FILE[start:]
+            if start:
+                response.headers["Content-Range"] = f"bytes {start}-{len(FILE) - 1}/{len(FILE)}"
+        response.headers["Content-Length"] = str(len(response._content))
+        response._content_consumed = True
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    return ranges
+
+
+def download(tmp_path, expected_size=None, part=None):
+    file_path = str(tmp_path / "file.bin")
+    if part is not None:
+        with open(f"{file_path}.part", "wb") as f:
+            f.write(part)
+    download_part_file(FILE_URL, file_path, arg_session=get_session(SITE, "u", "t"), arg_expected_size=expected_size)
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def test_resumes_a_part_file_with_a_range_request(tmp_path, monkeypatch):
+    ranges = file_server(monkeypatch)
+    assert download(tmp_path, part=FILE[:1000]) == FILE
+    assert ranges == ["bytes=1000-"]
+    assert not os.path.exists(tmp_path / "file.bin.part")
+
+
+def test_starts_over_when_the_server_ignores_the_range(tmp_path, monkeypatch):
+    file_server(monkeypatch, honor_range=False)
+    assert download(tmp_path, expected_size=len(FILE), part=b"stale bytes") == FILE
+
+
+def test_complete_part_file_is_only_renamed(tmp_path, monkeypatch):
+    ranges = file_server(monkeypatch)
+    assert download(tmp_path, expected_size=len(FILE), part=FILE) == FILE
+    assert ranges == [f"bytes={len(FILE)}-"]
+
+
+def test_part_file_larger_than_expected_is_downloaded_again(tmp_path, monkeypatch):
+    ranges = file_server(monkeypatch)
+    assert download(tmp_path, expected_size=len(FILE), part=FILE + b"garbage") == FILE
+    assert ranges == [None]
+
+
+def test_short_download_keeps_the_part_file(tmp_path, monkeypatch):
+    file_server(monkeypatch)
+    with pytest.raises(IOError):
+        download(tmp_path, expected_size=len(FILE) + 1)
+    assert os.path.getsize(tmp_path / "file.bin.part") == len(FILE)
+    assert not os.path.exists(tmp_path / "file.bin")
+
+
+def test_downloads_are_limited_per_host():
+    running = collections.Counter()
+    most_running = collections.Counter()
+    lock = threading.Lock()
+
+    def fake_download(url, index):
+        host = urlparse(url).hostname
+        with lock:
+            running[host] += 1
+            most_running[host] = max(most_running[host], running[host])
+        time.sleep(0.02)
+        with lock:
+            running[host] -= 1
+        if index == 3:
+            raise IOError("broken link")
+
+    hosts = ["img.example.com", "cdn.example.org", f"{SITE}.atlassian.net"]
+    downloads = [(f"https://{host}/file{index}.png", (index,)) for index in range(6) for host in hosts]
+    with AssetDownloader(max_workers=16, per_host=2, unlimited_hosts=[f"{SITE}.atlassian.net"]) as downloader:
+        errors = downloader.download_all(downloads, fake_download)
+
+    assert most_running["img.example.com"] == most_running["cdn.example.org"] == 2
+    assert most_running[f"{SITE}.atlassian.net"] > 2
+    assert [str(error) for error in errors if error is not None] == ["broken link"] * len(hosts)
+    assert all((error is not None) == (args == (3,)) for error, (url, args) in zip(errors, downloads))
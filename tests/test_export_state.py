@@ -0,0 +1,24 @@
+import os.path
+
+from confluence_dump.export_state import ExportState, file_sha256
+from confluence_dump.myModules import PageRecord
+
+
+def test_record_page_hashes_renamed_attachments(tmp_path):
+    attachments_dir = tmp_path / "_images"
+    attachments_dir.mkdir()
+    (attachments_dir / "diagram.png").write_bytes(b"file of another page")
+    (attachments_dir / "1a2b_diagram.png").write_bytes(b"file of this page")
+    page = PageRecord(
+        id="7", title="Page 7", html="", url="", space_key="DOC", version=1,
+        attachments=[{"id": "att7", "title": "diagram.png", "version": {"number": 2}}],
+    )
+
+    state = ExportState(str(tmp_path))
+    try:
+        state.record_page(page, "100", [], str(attachments_dir), {"diagram.png": "1a2b_diagram.png"})
+        rows = state.db.execute("SELECT file_path, sha256 FROM attachments WHERE page_id = '7'").fetchall()
+    finally:
+        state.close()
+    renamed_path = os.path.join(attachments_dir, "1a2b_diagram.png")
+    assert rows == [(renamed_path, file_sha256(renamed_path))]
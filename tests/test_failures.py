@@ -0,0 +1,17 @@
+from confluence_dump.confluence_exporter import ConfluenceExporter
+
+
+def test_failed_pages_are_counted(fake_site, tmp_path, caplog):
+    exporter = ConfluenceExporter(fake_site, "DOC", outdir=str(tmp_path), api_username="u", api_token="t", workers=2)
+    record_space_page = exporter._record_space_page
+
+    def record_or_fail(p, *args):
+        if p["page_id"] == "3":
+            raise OSError("disk full")
+        record_space_page(p, *args)
+
+    exporter._record_space_page = record_or_fail
+    results = exporter.export_space()
+    assert len(results) == 4
+    assert exporter.failed_pages == 1
+    assert "disk full" in caplog.text
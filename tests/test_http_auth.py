@@ -0,0 +1,22 @@
+from requests.adapters import HTTPAdapter
+
+from conftest import BASE, SITE, respond
+from confluence_dump.myModules import get_session, http_get
+
+
+def test_credentials_only_go_to_the_site(monkeypatch):
+    sent = {}
+
+    def send(self, request, **kwargs):
+        sent[request.url] = request.headers.get("Authorization")
+        return respond(request, {})
+
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    session = get_session(SITE, "u", "t")
+    site_url = f"{BASE}/rest/api/content/1"
+    external_url = "https://img.example.com/picture.png"
+    http_get(site_url, "u", "t", session)
+    http_get(external_url, "u", "t", session)
+
+    assert sent[site_url].startswith("Basic ")
+    assert sent[external_url] is None
@@ -0,0 +1,16 @@
+from confluence_dump.http_cache import ResponseCache
+
+
+def test_hits_are_written_with_the_next_put(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_size=20)
+    try:
+        cache.put("https://a", {}, b"a" * 8)
+        cache.put("https://b", {}, b"b" * 8)
+        assert cache.get("https://a").body == b"a" * 8
+        assert cache.db.execute("SELECT last_used FROM responses WHERE url = 'https://a'").fetchone()[0] < \
+            cache.db.execute("SELECT last_used FROM responses WHERE url = 'https://b'").fetchone()[0]
+        cache.put("https://c", {}, b"c" * 8)    # evicts b, used before a
+        assert cache.get("https://b") is None
+        assert cache.get("https://a") is not None
+    finally:
+        cache.close()
@@ -0,0 +1,55 @@
+import io
+
+import pytest
+from PIL import Image, features
+
+from confluence_dump import image_size
+from confluence_dump.image_size import ImageSizeCache, sniff_image_size
+
+FORMATS = ["PNG", "GIF", "JPEG"] + (["WEBP"] if features.check("webp") else [])
+
+
+def image_bytes(image_format, size=(123, 45), **kwargs):
+    data = io.BytesIO()
+    Image.new("RGB", size, "white").save(data, image_format, **kwargs)
+    return data.getvalue()
+
+
+@pytest.mark.parametrize("image_format", FORMATS)
+def test_sniffs_the_size_from_the_header(image_format):
+    assert sniff_image_size(image_bytes(image_format)) == (123, 45)
+
+
+def test_sniffs_progressive_jpeg_and_lossless_webp():
+    assert sniff_image_size(image_bytes("JPEG", progressive=True)) == (123, 45)
+    if features.check("webp"):
+        assert sniff_image_size(image_bytes("WEBP", lossless=True)) == (123, 45)
+
+
+def test_sniffs_svg_sizes_and_view_box():
+    assert sniff_image_size(b'<?xml version="1.0"?><svg width="300px" height="150" xmlns="x"></svg>') == (300, 150)
+    assert sniff_image_size(b'<svg viewBox="0 0 640.5 480" xmlns="x"></svg>') == (640, 480)
+    assert sniff_image_size(b'<svg width="50%" height="50%"></svg>') is None
+
+
+def test_unknown_format_goes_through_pillow(tmp_path):
+    bmp_path = tmp_path / "picture.bmp"
+    bmp_path.write_bytes(image_bytes("BMP"))
+    assert sniff_image_size(bmp_path.read_bytes()) is None
+    assert ImageSizeCache().size_of_file(str(bmp_path)) == (123, 45)
+
+    not_an_image = tmp_path / "notes.png"
+    not_an_image.write_bytes(b"not an image")
+    with pytest.raises(ValueError):
+        ImageSizeCache().size_of_file(str(not_an_image))
+
+
+def test_same_content_is_sniffed_once(tmp_path, monkeypatch):
+    sniffed = []
+    monkeypatch.setattr(image_size, "sniff_image_size", lambda data: sniffed.append(data) or sniff_image_size(data))
+    for name in ("a.png", "b.png"):
+        (tmp_path / name).write_bytes(image_bytes("PNG"))
+    cache = ImageSizeCache()
+    for name in ("a.png", "b.png", "a.png"):
+        assert cache.size_of_file(str(tmp_path / name)) == (123, 45)
+    assert len(sniffed) == 1
@@ -0,0 +1,15 @@
+from confluence_dump.confluence_exporter import ConfluenceExporter
+from conftest import REPORT_CHILDREN, REPORT_PAGE_ID
+
+
+def test_page_properties_show_labels(fake_site, tmp_path):
+    exporter = ConfluenceExporter(
+        fake_site, "DOC", outdir=str(tmp_path), api_username="u", api_token="t", workers=2, showlabels=True
+    )
+    results = exporter.export_page_properties(str(REPORT_PAGE_ID))
+    assert sorted(int(page_id) for page_id, url, rst_path, space_key, site in results.values()) == sorted(
+        REPORT_CHILDREN + [REPORT_PAGE_ID]
+    )
+    for page_id, url, rst_path, space_key, site in results.values():
+        with open(rst_path, encoding="utf-8") as f:
+            assert f"**Page labels**: alpha, p{page_id}" in f.read()
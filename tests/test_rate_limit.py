@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from requests.adapters import HTTPAdapter
+
+from conftest import BASE, SITE, respond
+from confluence_dump.myModules import get_session, http_get
+from confluence_dump.rate_limit import RateLimiter, retry_after_seconds
+
+
+def test_retry_after_seconds_reads_seconds_and_dates():
+    assert retry_after_seconds("3", 0) == 3.0
+    in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < retry_after_seconds(in_a_minute, 0) <= 60
+    assert 4 <= retry_after_seconds(None, 2) < 5     # exponential backoff without the header
+
+
+def test_token_bucket_spaces_out_requests():
+    limiter = RateLimiter("acme.atlassian.net", max_rate=2)
+    assert limiter._reserve() == 0
+    limiter.release()
+    assert limiter._reserve() > 0.1      # the bucket holds a single token at this rate
+
+
+def test_limits_grow_on_success_and_halve_when_throttled():
+    limiter = RateLimiter("acme.atlassian.net", max_rate=50, max_concurrency=8)
+    rate, concurrency = limiter.rate, limiter.concurrency
+    limiter.acquire()
+    limiter.release()
+    assert limiter.rate > rate and limiter.concurrency > concurrency
+
+    rate, concurrency = limiter.rate, limiter.concurrency
+    limiter.acquire()
+    limiter.release(throttled=True, retry_after=30)
+    assert limiter.rate == rate / 2 and limiter.concurrency == concurrency / 2
+    assert limiter._reserve() > 25       # every request waits for Retry-After
+
+
+def test_throttled_requests_are_retried_through_the_limiter(monkeypatch):
+    statuses = [429, 200]
+
+    def send(self, request, **kwargs):
+        response = respond(request, {}, status=statuses.pop(0))
+        response.headers["Retry-After"] = "0"
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    limiter = RateLimiter(f"{SITE}.atlassian.net")
+    session = get_session(SITE, "u", "t", arg_rate_limiter=limiter)
+    assert http_get(f"{BASE}/rest/api/content/1", "u", "t", session).status_code == 200
+    assert limiter.metrics()["requests"] == 2
+    assert limiter.metrics()["throttled_responses"] == 1
+    assert limiter.in_flight == 0
@@ -0,0 +1,44 @@
+import os.path
+
+import conftest
+from confluence_dump.confluence_exporter import ConfluenceExporter
+from conftest import PAGE_IDS
+
+
+def exporter(site, outdir, **kwargs):
+    return ConfluenceExporter(site, "DOC", outdir=str(outdir), api_username="u", api_token="t", workers=1, **kwargs)
+
+
+def test_rerender_shows_labels(fake_site, tmp_path):
+    results = exporter(fake_site, tmp_path).export_space()
+    for page_id, url, rst_path, space_key, site in results.values():
+        with open(rst_path, encoding="utf-8") as f:
+            assert "**Page labels**" not in f.read()
+
+    results = exporter(fake_site, tmp_path, showlabels=True, cache_size_mb=0).rerender()
+    assert results
+    for page_id, url, rst_path, space_key, site in results.values():
+        with open(rst_path, encoding="utf-8") as f:
+            assert f"**Page labels**: alpha, p{page_id}" in f.read()
+
+
+def test_rerender_refuses_another_sphinx_layout(fake_site, tmp_path, caplog):
+    exporter(fake_site, tmp_path).export_space()
+
+    rerendered = exporter(fake_site, tmp_path, sphinx=True, cache_size_mb=0)
+    assert rerendered.rerender() == {}
+    assert rerendered.failed_pages == len(PAGE_IDS)
+    assert "exported without --sphinx" in caplog.text
+
+
+def test_rerender_leaves_out_pruned_pages(fake_site, tmp_path, monkeypatch):
+    results = exporter(fake_site, tmp_path, incremental=True).export_space()
+    pruned_path = next(rst_path for page_id, url, rst_path, space_key, site in results.values() if page_id == str(PAGE_IDS[-1]))
+
+    monkeypatch.setattr(conftest, "PAGE_IDS", PAGE_IDS[:-1])
+    exporter(fake_site, tmp_path, incremental=True, prune_deleted=True).export_space()
+    assert not os.path.exists(pruned_path)
+
+    results = exporter(fake_site, tmp_path, cache_size_mb=0).rerender()
+    assert sorted(int(page_id) for page_id, url, rst_path, space_key, site in results.values()) == PAGE_IDS[:-1]
+    assert not os.path.exists(pruned_path)
@@ -0,0 +1,68 @@
+import os.path
+import re
+
+import conftest
+from confluence_dump.confluence_exporter import ConfluenceExporter
+from confluence_dump.page_archive import read_page_archive
+from confluence_dump.shards import merge_shards, page_shard
+from conftest import PAGE_IDS, attachment_content
+
+
+def export_shards(site, tmp_path, shards=2):
+    shard_dirs = []
+    for shard in range(1, shards + 1):
+        outdir = tmp_path / f"shard{shard}"
+        ConfluenceExporter(
+            site, "DOC", outdir=str(outdir), api_username="u", api_token="t", workers=1, html=True, shard=(shard, shards)
+        ).export_space()
+        shard_dirs.append(str(outdir))
+    return shard_dirs
+
+
+def test_merge_reports_conflicting_files(fake_site, tmp_path):
+    shard_dirs = export_shards(fake_site, tmp_path)
+    for shard_dir, text in zip(shard_dirs, ("first", "second")):
+        with open(f"{shard_dir}/notes.txt", "w") as f:
+            f.write(text)
+
+    result = merge_shards(shard_dirs, str(tmp_path / "merged"))
+    assert result.pages == len(PAGE_IDS)
+    assert result.conflicts == ["notes.txt"]
+    with open(tmp_path / "merged" / "notes.txt") as f:
+        assert f.read() == "first"
+
+
+def test_merge_renames_attachment_names_taken_by_another_shard(fake_site, tmp_path, monkeypatch):
+    page_content = conftest.page_content
+
+    def page_with_notes(page_id):
+        content = page_content(page_id)
+        content["children"]["attachment"]["results"].append({
+            "id": f"att{page_id}", "title": "notes.txt", "version": {"number": 1},
+            "extensions": {"fileId": f"file{page_id}", "fileSize": len(attachment_content(page_id, "notes.txt"))},
+            "_links": {"download": f"/download/attachments/{page_id}/notes.txt"},
+        })
+        return content
+
+    monkeypatch.setattr(conftest, "page_content", page_with_notes)
+    assert {page_shard(page_id, 2) for page_id in PAGE_IDS} == {1, 2}
+    shard_dirs = export_shards(fake_site, tmp_path)
+    merged = tmp_path / "merged"
+    assert merge_shards(shard_dirs, str(merged)).conflicts == []
+
+    # every page of the merged archive and every merged HTML file points to the notes of its own page
+    names = {}
+    for record in read_page_archive(str(merged)):
+        name = record["assets"]["attachments"][0]
+        with open(merged / record["outdir_content"] / "_images" / name, "rb") as f:
+            assert f.read() == attachment_content(record["page_id"], "notes.txt")
+        names[record["page_id"]] = name
+    assert sorted(int(page_id) for page_id in names) == PAGE_IDS
+    assert len(set(names.values())) == len(PAGE_IDS)
+    for folder, dirs, files in os.walk(merged):
+        for file_name in files:
+            if file_name.endswith(".html"):
+                with open(os.path.join(folder, file_name), encoding="utf-8") as f:
+                    html = f.read()
+                page_id = re.search(r'name="ConfluencePageID" content="(\d+)"', html).group(1)
+                assert f"_images/{names[page_id]}" in html